@@ -0,0 +1,253 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import candles
+import config
+import metrics
+import universe
+
+
+# Replays the live strategy over a CandleStore (symbols x days of opens and
+# closes) in one vectorized pass:
+#
+#   - slope / prior_slope are the calc_trade_metrics values, computed over each
+#     symbol's own bars (gaps are skipped, not decayed, like the groupby did)
+#   - find_trades: buy when slope >= 0 and the prior slope was negative and we
+#     don't hold it, sell when slope < 0 and we do
+#   - orders fill at that day's open for a fixed number of shares, the same 30
+#     orders.build_order sends; a symbol without an opening price isn't traded
+#   - positions are marked at the close (last known close when a bar is missing)
+#
+# The live bot starts its EMA at the beginning of the get_dates() window while
+# the backtest starts it at the first bar, after the first few dozen bars the
+# difference is far below the price tick.
+
+BACKTEST_QUANTITY = 30
+
+
+
+###############
+#  Signals    #
+###############
+
+def signal_matrices(store, span=metrics.EMA_SPAN, window=metrics.SLOPE_WINDOW):
+    # (slope, prior_slope) on the store's symbols x days grid, NaN where undefined
+    present = store.present()
+    rows, cols = np.nonzero(present)
+    (codes, order, rowIdx, colIdx, width) = metrics.align_by_symbol(rows, cols)
+    openM = metrics.to_matrix(store.open[rows, cols], order, rowIdx, colIdx, len(codes), width)
+
+    slope = metrics.slope_matrix(metrics.ema_matrix(openM, span)[0], window)
+    priorSlope = metrics.shift_right(slope)
+
+    target = (codes[rowIdx], cols[order])
+    slopeGrid = np.full(store.open.shape, np.nan)
+    priorGrid = np.full(store.open.shape, np.nan)
+    slopeGrid[target] = slope[rowIdx, colIdx]
+    priorGrid[target] = priorSlope[rowIdx, colIdx]
+    return (slopeGrid, priorGrid)
+
+
+def holdings_matrix(buySignal, sellSignal, initial=None):
+    # Held or not at the end of each day. Buying something we hold and selling
+    # something we don't are no-ops, so the latest signal decides: forward fill
+    # the last buy (1) / sell (0) along the days.
+    nSymbols, nDays = buySignal.shape
+    events = np.where(buySignal, 1, np.where(sellSignal, 0, -1)).astype('int8')
+    lastEvent = np.where(events >= 0, np.arange(nDays), -1)
+    np.maximum.accumulate(lastEvent, axis=1, out=lastEvent)
+    held = np.take_along_axis(events, np.maximum(lastEvent, 0), axis=1) == 1
+    start = np.zeros(nSymbols, dtype='bool') if initial is None else np.asarray(initial, dtype='bool')
+    return np.where(lastEvent >= 0, held, start[:, None])
+
+
+def mark_prices(store):
+    # Close, or the open when a bar has no close, carried forward over gaps
+    marks = np.where(np.isfinite(store.close), store.close, store.open)
+    return pd.DataFrame(marks).ffill(axis=1).fillna(0.0).values
+
+
+
+##############
+#  Results   #
+##############
+
+class BacktestResult:
+    # Daily series are indexed by date. Money is in dollars, pnl starts at 0.
+    #   equity      pnl of the strategy (cash + positions - starting cash)
+    #   benchmark   pnl of buying `quantity` shares of every symbol at its first open and holding
+    #   exposure    market value of the positions at the close
+    #   traded      notional bought + sold at the open
+    #   buys, sells orders per day
+    #   held        symbols x days bool matrix
+
+    def __init__(self, symbols, dates, equity, benchmark, exposure, traded, buys, sells, fees, held):
+        self.symbols = symbols
+        self.dates = dates
+        self.equity = pd.Series(equity, index=dates, name='equity')
+        self.benchmark = pd.Series(benchmark, index=dates, name='benchmark')
+        self.exposure = pd.Series(exposure, index=dates, name='exposure')
+        self.traded = pd.Series(traded, index=dates, name='traded')
+        self.buys = pd.Series(buys, index=dates, name='buys')
+        self.sells = pd.Series(sells, index=dates, name='sells')
+        self.fees = pd.Series(fees, index=dates, name='fees')
+        self.held = held
+
+    def to_frame(self):
+        return pd.concat([self.equity, self.benchmark, self.exposure, self.traded,
+                          self.buys, self.sells, self.fees], axis=1)
+
+    def summary(self):
+        peakExposure = float(self.exposure.max()) if len(self.exposure) > 0 else 0.0
+        drawdown = (self.equity - self.equity.cummax()).min() if len(self.equity) > 0 else 0.0
+        daily = self.equity.diff().dropna()
+        sharpe = np.nan
+        if len(daily) > 1 and daily.std() > 0:
+            sharpe = float(daily.mean() / daily.std() * np.sqrt(252))
+        return {'days': len(self.dates),
+                'symbols': len(self.symbols),
+                'pnl': round(float(self.equity.iloc[-1]), 2) if len(self.equity) > 0 else 0.0,
+                'buy_and_hold_pnl': round(float(self.benchmark.iloc[-1]), 2) if len(self.benchmark) > 0 else 0.0,
+                'orders': int(self.buys.sum() + self.sells.sum()),
+                'fees': round(float(self.fees.sum()), 2),
+                'peak_exposure': round(peakExposure, 2),
+                'return_on_peak_exposure': round(float(self.equity.iloc[-1]) / peakExposure, 4) if peakExposure > 0 else np.nan,
+                'max_drawdown': round(float(drawdown), 2),
+                'sharpe': round(sharpe, 3) if np.isfinite(sharpe) else None,
+                'turnover': round(float(self.traded.sum() / self.exposure.mean()), 2) if self.exposure.mean() > 0 else np.nan}
+
+
+
+#################
+#  The engine   #
+#################
+
+def run_backtest(store, quantity=BACKTEST_QUANTITY, span=metrics.EMA_SPAN, window=metrics.SLOPE_WINDOW,
+                 initial_positions=None, cost_per_share=0.0, slippage_bps=0.0,
+                 entry_threshold=0.0, exit_threshold=0.0, prior_filter=True,
+                 dollars_per_position=None, signals=None, members=None):
+    # The defaults are the live rules. Variations for parameter sweeps:
+    #   entry_threshold / exit_threshold: buy when slope >= entry, sell when slope < exit
+    #   prior_filter: only buy when the prior slope was negative
+    #   dollars_per_position: size each buy as floor(dollars / open) shares instead of `quantity`
+    #   signals: (slope, prior_slope) from signal_matrices, to reuse them across runs
+    #   members: symbols x days bool from universe.membership_matrix, only buy
+    #            members and sell anything held the day it leaves the index
+    # initial_positions: symbols held (quantity shares each) before the first day
+    (slope, priorSlope) = signals if signals is not None else signal_matrices(store, span, window)
+    opens = store.open
+    nSymbols, nDays = opens.shape
+    tradable = np.isfinite(opens) & (opens > 0)
+    with np.errstate(invalid='ignore'):
+        buySignal = tradable & (slope >= entry_threshold)
+        if prior_filter:
+            buySignal &= np.sign(priorSlope) < 0
+        exitSignal = slope < exit_threshold
+        if members is not None:
+            buySignal &= members
+            exitSignal |= ~members
+        sellSignal = tradable & exitSignal & ~buySignal
+
+    initial = np.zeros(nSymbols, dtype='bool')
+    if initial_positions is not None:
+        initial = np.isin(store.symbols, list(initial_positions))
+    held = holdings_matrix(buySignal, sellSignal, initial)
+    before = np.concatenate([initial[:, None], held[:, :-1]], axis=1)
+    bought = held & ~before
+    sold = before & ~held
+
+    # Shares per position, fixed when it's bought and kept until it's sold
+    fillOpens = np.where(tradable, opens, 0.0)
+    if dollars_per_position is None:
+        entryShares = np.where(bought, float(quantity), np.nan)
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            entryShares = np.where(bought, np.floor(dollars_per_position / fillOpens), np.nan)
+    entryShares[:, 0] = np.where(initial & ~bought[:, 0], quantity, entryShares[:, 0])
+    shares = held * pd.DataFrame(entryShares).ffill(axis=1).fillna(0.0).values
+    sharesBefore = np.concatenate([np.where(initial, float(quantity), 0.0)[:, None], shares[:, :-1]], axis=1)
+
+    slip = slippage_bps / 10000.0
+    buyCash = (bought * fillOpens * shares).sum(axis=0) * (1 + slip)
+    sellCash = (sold * fillOpens * sharesBefore).sum(axis=0) * (1 - slip)
+    fees = ((bought * shares).sum(axis=0) + (sold * sharesBefore).sum(axis=0)) * cost_per_share
+
+    marks = mark_prices(store)
+    exposure = (shares * marks).sum(axis=0)
+    # Positions held coming in are valued at the first mark, so pnl starts at 0
+    startValue = (sharesBefore[:, 0] * marks[:, 0]).sum() if nDays > 0 else 0.0
+    cash = np.cumsum(sellCash - buyCash - fees)
+    equity = cash + exposure - startValue
+
+    # Buy and hold, sized the same way, from each symbol's first open
+    hasOpen = tradable.any(axis=1)
+    firstOpen = np.argmax(tradable, axis=1)
+    entry = np.where(hasOpen, opens[np.arange(nSymbols), firstOpen], 0.0)
+    if dollars_per_position is None:
+        holdShares = np.where(hasOpen, float(quantity), 0.0)
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            holdShares = np.where(hasOpen, np.floor(dollars_per_position / np.where(hasOpen, entry, 1.0)), 0.0)
+    owned = np.arange(nDays)[None, :] >= firstOpen[:, None]
+    benchmark = (owned * (marks - entry[:, None]) * holdShares[:, None]).sum(axis=0)
+
+    dates = pd.DatetimeIndex(candles.day_to_datetime(store.days))
+    return BacktestResult(store.symbols, dates, equity, benchmark, exposure, buyCash + sellCash,
+                          bought.sum(axis=0), sold.sum(axis=0), fees, held)
+
+
+def synthetic_store(nSymbols, nDays, seed=0):
+    # Random walk opens / closes on business days ending yesterday, for trying things out
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range(end=pd.Timestamp.now().normalize() - pd.Timedelta(days=1), periods=nDays)
+    closes = rng.uniform(20, 400, (nSymbols, 1)) * np.exp(np.cumsum(rng.normal(0.0003, 0.018, (nSymbols, nDays)), axis=1))
+    opens = closes * np.exp(rng.normal(0, 0.006, (nSymbols, nDays)))
+    symbols = np.array(['S{:05d}'.format(i) for i in range(nSymbols)])
+    return candles.CandleStore(symbols, np.array([candles.date_to_day(d) for d in days]), opens, closes)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backtest the EMA slope strategy')
+    parser.add_argument('--tickers', default=None, help='defaults to every symbol ever in the universe')
+    parser.add_argument('--point-in-time', action='store_true',
+                        help='only trade symbols while they are in the index, from the stored snapshots')
+    parser.add_argument('--years', type=float, default=5)
+    parser.add_argument('--quantity', type=int, default=BACKTEST_QUANTITY)
+    parser.add_argument('--cost-per-share', type=float, default=0.0)
+    parser.add_argument('--slippage-bps', type=float, default=0.0)
+    parser.add_argument('--synthetic', type=int, default=None, metavar='SYMBOLS',
+                        help='random walk data for this many symbols instead of the candle cache')
+    parser.add_argument('--output', default=None, help='write the daily curves to this CSV')
+    args = parser.parse_args()
+
+    nDays = int(args.years * 252)
+    if args.synthetic:
+        store = synthetic_store(args.synthetic, nDays)
+    else:
+        if args.tickers:
+            tickers = pd.read_csv(args.tickers)['tickers'].values.tolist()
+        else:
+            tickers = universe.ever_members()
+        endDay = candles.date_to_day(pd.Timestamp.now().normalize()) - 1
+        store = candles.CandleStore.from_cache(candles.CandleCache(config.CANDLE_CACHE_DIR), tickers,
+                                               endDay - int(args.years * 365.25), endDay)
+        if len(store.symbols) == 0:
+            raise SystemExit('No cached candles in {}, run the Trading flow (or the simulator) first'.format(
+                config.CANDLE_CACHE_DIR))
+
+    members = universe.membership_matrix(store.symbols, store.days) if args.point_in_time else None
+
+    t1 = time.time()
+    result = run_backtest(store, quantity=args.quantity, cost_per_share=args.cost_per_share,
+                          slippage_bps=args.slippage_bps, members=members)
+    t2 = time.time()
+    for k, v in result.summary().items():
+        print('{:<24} {}'.format(k, v))
+    print('Backtest took: ', round(t2-t1, 3), ' seconds')
+    if args.output:
+        result.to_frame().to_csv(args.output)
+        print('Daily curves written to ', args.output)
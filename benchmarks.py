@@ -0,0 +1,391 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import candles
+import metrics
+import reconcile
+import utils
+
+
+# Reproducible timings for every stage of the Trading and MorningTrades flows
+# on synthetic data:
+#
+#   candle_decode        price history responses to day / open / close arrays
+#                        (candle_decode_json is the old json.loads path, for the speedup)
+#   candle_cache_update  merging the decoded candles into the on-disk cache
+#   quote_decode         a quotes response for the whole universe to arrays
+#                        (quote_decode_json is the old read_json round trip)
+#   candle_assembly      CandleStore from the cache + todays quotes + frame view
+#   calc_trade_metrics   EMA / slope metrics over the whole history
+#   ema_state_sync       rebuilding the persisted EMA state from the history
+#   ema_state_step       todays one-step metrics from the state
+#   find_trades          buy / sell selection against current positions
+#   reconcile            exact share counts against an account snapshot
+#   parse_transactions   get_historical_trades_DF minus the HTTP call
+#   format_trades_for_db db._formatTradesForDB
+#   cold_import          a fresh interpreter importing main + one message's modules
+#
+# Each stage records the best wall time over --repeat runs and the peak
+# traced memory of one extra run. Results are written as JSON so runs can be
+# compared with --compare.
+#
+#   python benchmarks.py                       # full grid
+#   python benchmarks.py --symbols 500 --months 3 --orders 1000
+#   python benchmarks.py --compare bench_results/old.json
+#   python benchmarks.py --symbols --orders --messages 'Refresh Token'   # startup cost only
+
+DEFAULT_SYMBOLS = [500, 1500, 5000]
+DEFAULT_MONTHS = [3, 12, 60]
+DEFAULT_ORDERS = [1000, 10000, 50000]
+TRADING_DAYS_PER_MONTH = 21
+
+# Per-symbol stages are measured on at most this many bars and scaled up
+MAX_SAMPLE_BARS = 2000000
+
+
+
+#####################
+#  Synthetic data   #
+#####################
+
+def synthetic_days(nDays):
+    # Business day numbers ending yesterday, plus today
+    today = pd.Timestamp.now().normalize()
+    days = pd.bdate_range(end=today - pd.Timedelta(days=1), periods=nDays)
+    return (candles.date_to_day(today), np.array([candles.date_to_day(d) for d in days]))
+
+
+def synthetic_symbols(nSymbols):
+    return ['S{:05d}'.format(i) for i in range(nSymbols)]
+
+
+def candle_response(symbol, days, rng):
+    # Raw bytes shaped like a TDA pricehistory response
+    closes = rng.uniform(20, 400) * np.exp(np.cumsum(rng.normal(0, 0.018, len(days))))
+    opens = closes * np.exp(rng.normal(0, 0.006, len(days)))
+    stamps = days.astype('int64')*candles.MS_PER_DAY + 5*3600*1000
+    bars = [{'open': round(float(o), 2), 'high': round(float(max(o, c)), 2), 'low': round(float(min(o, c)), 2),
+             'close': round(float(c), 2), 'volume': 1000000, 'datetime': int(s)}
+            for o, c, s in zip(opens, closes, stamps)]
+    return json.dumps({'candles': bars, 'symbol': symbol, 'empty': False}, separators=(',', ':')).encode()
+
+
+def quote_response(symbols, opens, lasts):
+    # Raw bytes shaped like a TDA quotes response
+    quotes = {}
+    for s, o, l in zip(symbols, opens, lasts):
+        quotes[s] = {'assetType': 'EQUITY', 'symbol': s, 'description': s, 'bidPrice': round(float(l), 2),
+                     'askPrice': round(float(l), 2), 'lastPrice': round(float(l), 2), 'openPrice': round(float(o), 2),
+                     'highPrice': round(float(max(o, l)), 2), 'lowPrice': round(float(min(o, l)), 2),
+                     'closePrice': round(float(o), 2), 'netChange': 0.0, 'totalVolume': 1000000,
+                     'quoteTimeInLong': 0, 'tradeTimeInLong': 0, 'exchange': 'n', 'exchangeName': 'NYSE'}
+    return json.dumps(quotes, separators=(',', ':')).encode()
+
+
+def synthetic_orders(nOrders, symbols, seed=0):
+    # Filled orders shaped like the TDA /orders response
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp.now(tz='UTC').normalize() - pd.Timedelta(days=365)
+    out = []
+    for i in range(nOrders):
+        symbol = symbols[rng.integers(len(symbols))]
+        instruction = 'BUY' if rng.random() < 0.5 else 'SELL'
+        entered = (start + pd.Timedelta(seconds=int(rng.integers(365*86400)))).strftime('%Y-%m-%dT%H:%M:%S+0000')
+        price = round(float(rng.uniform(20, 400)), 2)
+        out.append({
+            'session': 'NORMAL', 'duration': 'DAY', 'orderType': 'MARKET', 'complexOrderStrategyType': 'NONE',
+            'quantity': 30.0, 'filledQuantity': 30.0, 'remainingQuantity': 0.0,
+            'orderLegCollection': [{'orderLegType': 'EQUITY', 'legId': 1,
+                                    'instrument': {'assetType': 'EQUITY', 'cusip': '', 'symbol': symbol},
+                                    'instruction': instruction,
+                                    'positionEffect': 'OPENING' if instruction == 'BUY' else 'CLOSING',
+                                    'quantity': 30.0}],
+            'orderStrategyType': 'SINGLE', 'orderId': 1000000 + i, 'status': 'FILLED',
+            'enteredTime': entered, 'closeTime': entered, 'accountId': 123456789,
+            'orderActivityCollection': [{'activityType': 'EXECUTION', 'executionType': 'FILL', 'quantity': 30.0,
+                                         'executionLegs': [{'legId': 1, 'quantity': 30.0, 'price': price,
+                                                            'time': entered}]}]})
+    return out
+
+
+
+##################
+#  Measurement   #
+##################
+
+def measure(fn, repeat=3):
+    # (best wall seconds, peak traced MB). Prints from the bot are swallowed.
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t1 = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - t1
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (best, peak/1e6)
+
+
+def record(results, stage, params, seconds, peak_mb, **extra):
+    row = {'stage': stage, 'params': params, 'seconds': round(seconds, 6), 'peak_mb': round(peak_mb, 3)}
+    row.update(extra)
+    results.append(row)
+    print('{:<22} {:<40} {:>10.4f}s {:>10.1f}MB'.format(stage, json.dumps(params), seconds, peak_mb))
+
+
+
+###############
+#   Stages    #
+###############
+
+def bench_history(results, nSymbols, nMonths, repeat):
+    params = {'symbols': nSymbols, 'months': nMonths}
+    nDays = nMonths*TRADING_DAYS_PER_MONTH
+    today, days = synthetic_days(nDays)
+    symbols = synthetic_symbols(nSymbols)
+    rng = np.random.default_rng(nSymbols*1000 + nMonths)
+
+    # Decode + cache update on a sample that fits in memory, scaled to the universe
+    nSample = max(1, min(nSymbols, MAX_SAMPLE_BARS // nDays))
+    scale = nSymbols / nSample
+    raw = [candle_response(s, days, rng) for s in symbols[:nSample]]
+    decoded = [candles.decode_candles(r) for r in raw]
+    sampled = {'sampled_symbols': nSample} if nSample < nSymbols else {}
+
+    # The old path for comparison: a dict per bar, then arrays built from the dicts
+    # Results are dropped as they come, so the peak is what decoding one response costs
+    def decode_json():
+        for r in raw:
+            candles.candles_to_arrays(json.loads(r)['candles'])
+    def decode():
+        for r in raw:
+            candles.decode_candles(r)
+    seconds, peak = measure(decode_json, repeat)
+    record(results, 'candle_decode_json', params, seconds*scale, peak, **sampled)
+    jsonSeconds, jsonPeak = seconds, peak
+    seconds, peak = measure(decode, repeat)
+    record(results, 'candle_decode', params, seconds*scale, peak,
+           speedup=round(jsonSeconds/seconds, 2), memory_saved_mb=round(jsonPeak-peak, 3), **sampled)
+
+    workdir = tempfile.mkdtemp(prefix='bench_candles_')
+    try:
+        def update():
+            cache = candles.CandleCache(os.path.join(workdir, str(time.perf_counter_ns())))
+            for s, bars in zip(symbols, decoded):
+                cache.update(s, bars, fetched_from=int(days[0]))
+        seconds, peak = measure(update, repeat)
+        record(results, 'candle_cache_update', params, seconds*scale, peak, **sampled)
+
+        # Fill the cache for the whole universe by reusing the sampled responses
+        cache = candles.CandleCache(os.path.join(workdir, 'full'))
+        for i, s in enumerate(symbols):
+            cache.update(s, decoded[i % nSample], fetched_from=int(days[0]))
+        quoteOpen = rng.uniform(20, 400, nSymbols)
+        quoteClose = quoteOpen * (1 + rng.normal(0, 0.002, nSymbols))
+
+        quotesRaw = quote_response(symbols, quoteOpen, quoteClose)
+        def quotes_json():
+            # What get_todays_quotes used to do
+            quoteDF = pd.read_json(io.StringIO(json.dumps(json.loads(quotesRaw))), orient='index')
+            return quoteDF[['openPrice', 'lastPrice', 'symbol']].reset_index(drop=True)
+        seconds, peak = measure(quotes_json, repeat)
+        record(results, 'quote_decode_json', params, seconds, peak)
+        jsonSeconds, jsonPeak = seconds, peak
+        seconds, peak = measure(lambda: candles.decode_quotes(quotesRaw), repeat)
+        record(results, 'quote_decode', params, seconds, peak,
+               speedup=round(jsonSeconds/seconds, 2), memory_saved_mb=round(jsonPeak-peak, 3))
+
+        def assemble():
+            warm = candles.CandleCache(cache.cache_dir)
+            store = candles.CandleStore.from_cache(warm, symbols, int(days[0]), int(days[-1]), extra_days=[today])
+            store.set_day(today, symbols, quoteOpen, quoteClose)
+            return store.to_frame()
+        seconds, peak = measure(assemble, repeat)
+        record(results, 'candle_assembly', params, seconds, peak)
+        frame = assemble()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    seconds, peak = measure(lambda: metrics.calc_trade_metrics(frame), repeat)
+    record(results, 'calc_trade_metrics', params, seconds, peak)
+
+    todayTs = candles.day_to_datetime([today])[0]
+    history = frame[frame['datetime'] < todayTs]
+    todays = frame[frame['datetime'] == todayTs]
+    seconds, peak = measure(lambda: metrics.sync_ema_state(None, history), repeat)
+    record(results, 'ema_state_sync', params, seconds, peak)
+
+    state = metrics.build_ema_state(history)
+    seconds, peak = measure(lambda: metrics.step_ema_state(state, todays), repeat)
+    record(results, 'ema_state_step', params, seconds, peak)
+
+    todaysMetrics = metrics.step_ema_state(state, todays)
+    todaysMetrics['datetime'] = pd.to_datetime('today').strftime('%Y-%m-%d')
+    positions = [s for i, s in enumerate(symbols) if i % 5 == 0]
+    seconds, peak = measure(lambda: utils.find_trades(todaysMetrics, token=None, tickers=symbols,
+                                                      current_positions=positions), repeat)
+    record(results, 'find_trades', params, seconds, peak)
+
+    snapshot = reconcile.AccountSnapshot({s: 30.0 for s in positions}, {(s, 'SELL'): 30 for s in positions[::7]},
+                                         buying_power=1e9)
+    with contextlib.redirect_stdout(io.StringIO()):
+        (buys, sells) = utils.find_trades(todaysMetrics, token=None, tickers=symbols,
+                                          current_positions=snapshot.positions)
+    prices = dict(zip(todays['symbol'], todays['open']))
+    seconds, peak = measure(lambda: reconcile.Reconciler(snapshot).orders(buys, sells, prices), repeat)
+    record(results, 'reconcile', params, seconds, peak, buys=len(buys), sells=len(sells))
+
+
+def bench_orders(results, nOrders, repeat):
+    params = {'orders': nOrders}
+    orders = synthetic_orders(nOrders, synthetic_symbols(500))
+
+    seconds, peak = measure(lambda: utils.parse_transactions(orders), repeat)
+    record(results, 'parse_transactions', params, seconds, peak)
+
+    try:
+        import db
+    except ImportError as e:
+        print('Skipping format_trades_for_db, db dependencies missing: ', e)
+        return
+    parsed = utils.parse_transactions(orders)
+    seconds, peak = measure(lambda: db._formatTradesForDB(parsed.copy()), repeat)
+    record(results, 'format_trades_for_db', params, seconds, peak)
+
+
+
+# Run in a fresh interpreter with -X importtime, prints a JSON summary on stdout
+COLD_IMPORT_SCRIPT = """
+import importlib, json, os, resource, time
+t1 = time.perf_counter()
+import main
+for m in main.HANDLER_MODULES[{message!r}]:
+    importlib.import_module(m)
+seconds = time.perf_counter() - t1
+# ru_maxrss survives exec on Linux and would report the parent's peak, VmHWM doesn't
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+if os.path.exists('/proc/self/status'):
+    peak = [int(l.split()[1])/1024 for l in open('/proc/self/status') if l.startswith('VmHWM')][0]
+print(json.dumps({{'seconds': seconds, 'max_rss_mb': peak}}))
+"""
+
+
+def bench_cold_import(results, message, repeat, top=5):
+    # Startup cost of one Pub/Sub message: wall time and peak RSS of the
+    # imports, plus the packages with the largest cumulative import time
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', COLD_IMPORT_SCRIPT.format(message=message)],
+                              capture_output=True, text=True, cwd=here)
+        if proc.returncode != 0:
+            print('Cold import failed for {}: {}'.format(message, proc.stderr.strip().splitlines()[-1:]))
+            return
+        run = json.loads(proc.stdout.strip().splitlines()[-1])
+        if best is None or run['seconds'] < best[0]['seconds']:
+            best = (run, proc.stderr)
+
+    # importtime lines: "import time: self [us] | cumulative | imported package"
+    packages = {}
+    for line in best[1].splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[0].strip().startswith('import time:') or 'cumulative' in parts[1]:
+            continue
+        package = parts[2].strip().split('.')[0]
+        if package != 'main':
+            packages[package] = max(packages.get(package, 0), int(parts[1]) / 1e6)
+    slowest = sorted(packages.items(), key=lambda kv: -kv[1])[:top]
+    record(results, 'cold_import', {'message': message}, best[0]['seconds'], best[0]['max_rss_mb'],
+           slowest_imports={k: round(v, 4) for k, v in slowest})
+
+
+
+#################
+#  Comparison   #
+#################
+
+def compare(results, baselinePath, threshold):
+    # Prints the ratio against a previous run, returns the stages slower than threshold
+    with open(baselinePath) as f:
+        baseline = json.load(f)
+    key = lambda r: (r['stage'], json.dumps(r['params'], sort_keys=True))
+    previous = {key(r): r for r in baseline['results']}
+    regressions = []
+    print('\nCompared with ', baselinePath)
+    for r in results:
+        old = previous.get(key(r))
+        if old is None or old['seconds'] == 0:
+            continue
+        ratio = r['seconds'] / old['seconds']
+        flag = '  REGRESSION' if ratio > threshold else ''
+        print('{:<22} {:<40} {:>8.2f}x time {:>8.2f}x memory{}'.format(
+            r['stage'], json.dumps(r['params']), ratio, r['peak_mb'] / max(old['peak_mb'], 1e-9), flag))
+        if flag:
+            regressions.append(r)
+    return regressions
+
+
+def run_metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'timestamp': pd.Timestamp.now(tz='UTC').isoformat(), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the trading bot stages on synthetic data')
+    parser.add_argument('--symbols', type=int, nargs='*', default=DEFAULT_SYMBOLS)
+    parser.add_argument('--months', type=int, nargs='*', default=DEFAULT_MONTHS)
+    parser.add_argument('--orders', type=int, nargs='*', default=DEFAULT_ORDERS)
+    parser.add_argument('--messages', nargs='*', default=None, help='Pub/Sub messages to time cold imports for, default all')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='JSON results path, defaults to bench_results/<timestamp>.json')
+    parser.add_argument('--compare', default=None, help='previous results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio flagged as a regression')
+    args = parser.parse_args()
+
+    results = []
+    for nSymbols in args.symbols:
+        for nMonths in args.months:
+            bench_history(results, nSymbols, nMonths, args.repeat)
+    for nOrders in args.orders:
+        bench_orders(results, nOrders, args.repeat)
+    import main
+    for message in (list(main.HANDLER_MODULES) if args.messages is None else args.messages):
+        bench_cold_import(results, message, args.repeat)
+
+    output = args.output or os.path.join('bench_results', pd.Timestamp.now().strftime('%Y%m%d_%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'meta': run_metadata(), 'results': results}, f, indent=2)
+    print('Results written to ', output)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if len(regressions) > 0:
+            raise SystemExit('{} stages regressed'.format(len(regressions)))
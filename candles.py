@@ -0,0 +1,330 @@
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+
+# Daily candles from TDA are stamped in epoch milliseconds. Everything in
+# the cache is keyed by the UTC day number (days since 1970-01-01), which is
+# the same date the old strftime('%Y-%m-%d') conversion produced.
+MS_PER_DAY = 86400000
+
+
+def epoch_ms_to_day(epoch_ms):
+    return int(epoch_ms) // MS_PER_DAY
+
+
+def day_to_epoch_ms(day):
+    return int(day) * MS_PER_DAY
+
+
+def date_to_day(date):
+    return int(np.datetime64(pd.Timestamp(date).strftime('%Y-%m-%d'), 'D').astype('int64'))
+
+
+def day_to_datetime(days):
+    return pd.to_datetime(np.asarray(days, dtype='int64').astype('datetime64[D]'))
+
+
+def epoch_ms_to_days(epoch_ms):
+    # Vectorized epoch_ms_to_day, integer floor division on the raw stamps
+    return (np.asarray(epoch_ms, dtype='int64') // MS_PER_DAY).astype('int32')
+
+
+def has_weekday(first_day, last_day):
+    # 1970-01-01 was a Thursday, so (day + 3) % 7 gives Monday=0 .. Sunday=6
+    for day in range(first_day, last_day + 1):
+        if (day + 3) % 7 < 5:
+            return True
+    return False
+
+
+
+#############################
+#  Response decoding        #
+#############################
+
+# A pricehistory response is {"candles": [{"open": .., "high": .., "low": ..,
+# "close": .., "volume": .., "datetime": ..}, ...], "symbol": .., "empty": ..}.
+# Instead of building a dict per bar, the three fields we keep are pulled out
+# of the raw bytes in one regex scan and parsed straight into a float array.
+# Anything the scan doesn't expect (nulls, a field missing from a bar, a last
+# bar laid out unlike the first) falls back to json.loads.
+CANDLE_FIELDS = ('open', 'close', 'datetime')
+_CANDLE_VALUES = re.compile(rb'"(?:open|close|datetime)": ?([^,}\]]*)')
+
+
+def candles_to_arrays(bars):
+    # [{'datetime', 'open', 'close', ...}] -> (days int32, open float64, close float64)
+    days = epoch_ms_to_days(np.array([c['datetime'] for c in bars], dtype='int64'))
+    opens = np.array([c['open'] for c in bars], dtype='float64')
+    closes = np.array([c['close'] for c in bars], dtype='float64')
+    return (days, opens, closes)
+
+
+def _scan_candles(raw, start, end):
+    # The fast path, None when the layout isn't the one we expect
+    nBars = raw.count(b'{', start, end)
+    keys = [b'"' + k.encode() + b'"' for k in CANDLE_FIELDS]
+    if nBars == 0:
+        return (np.zeros(0, dtype='int32'), np.zeros(0), np.zeros(0))
+    # Column order from the first bar. A serializer lays every bar out the
+    # same way, the last bar is checked against it (checking each one costs
+    # as much as json.loads).
+    firstEnd = raw.find(b'}', start, end)
+    firstPos = [raw.find(k, start, firstEnd) for k in keys]
+    lastStart = raw.rfind(b'{', start, end)
+    lastPos = [raw.find(k, lastStart, end) for k in keys]
+    if min(firstPos) < 0 or min(lastPos) < 0:
+        return None
+    layout = np.argsort(np.argsort(firstPos))
+    if not np.array_equal(layout, np.argsort(np.argsort(lastPos))):
+        return None
+    (openCol, closeCol, dayCol) = layout
+
+    values = _CANDLE_VALUES.findall(raw, start, end)
+    if len(values) != 3*nBars:
+        return None
+    try:
+        table = np.fromiter(map(float, values), dtype='float64', count=len(values)).reshape(nBars, 3)
+    except ValueError:
+        return None
+    return (epoch_ms_to_days(table[:, dayCol]), table[:, openCol].copy(), table[:, closeCol].copy())
+
+
+def decode_candles(raw):
+    # Raw pricehistory response -> (days, opens, closes), None when it has no candles
+    if isinstance(raw, str):
+        raw = raw.encode()
+    start = raw.find(b'"candles"')
+    if start < 0:
+        return None
+    end = raw.find(b']', start)
+    decoded = _scan_candles(raw, start, end) if end >= 0 else None
+    if decoded is not None:
+        return decoded
+    try:
+        body = json.loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(body, dict) or not isinstance(body.get('candles'), list):
+        return None
+    return candles_to_arrays(body['candles'])
+
+
+def decode_quotes(raw):
+    # Raw quotes response (or the parsed dict) -> (symbols, opens, lasts), NaN
+    # where a quote has no price yet
+    quotes = json.loads(raw) if isinstance(raw, (bytes, str)) else raw
+    symbols = [s for s, q in quotes.items() if isinstance(q, dict)]
+    opens = np.array([quotes[s].get('openPrice') for s in symbols], dtype='float64')
+    lasts = np.array([quotes[s].get('lastPrice') for s in symbols], dtype='float64')
+    return (symbols, opens, lasts)
+
+
+
+#############################
+#  Incremental candle cache #
+#############################
+
+# TDA adjusts the whole price history after a split or dividend, so bars
+# cached before one are on the old scale. Every incremental fetch asks for
+# the last CANDLE_OVERLAP_BARS cached bars again and update() compares them;
+# when they moved the symbol is refetched in full (and its EMA state rebuilt).
+CANDLE_OVERLAP_BARS = 1
+CANDLE_ADJUST_TOLERANCE = 1e-4     # relative price change that counts as an adjustment
+
+
+class CandleCache:
+    # One small .npz file per symbol holding int32 day numbers and float64
+    # open/close arrays sorted by day. `fetched_from` records the earliest
+    # day we've asked the API for, so symbols with a short listing history
+    # aren't refetched in full every morning.
+    #
+    # The saving needs CANDLE_CACHE_DIR to outlive the run: the daemon or a
+    # local run. A Cloud Function's /tmp starts empty on every cold start, so
+    # there it only helps the runs a warm instance happens to serve.
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._data = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, symbol):
+        return os.path.join(self.cache_dir, '{}.npz'.format(symbol))
+
+    def load(self, symbol):
+        if symbol not in self._data:
+            try:
+                with np.load(self._path(symbol)) as f:
+                    self._data[symbol] = (f['days'], f['open'], f['close'], int(f['fetched_from']))
+            except (OSError, KeyError, ValueError):
+                self._data[symbol] = None
+        return self._data[symbol]
+
+    def save(self, symbol, days, opens, closes, fetched_from):
+        # Write to a temp file and swap it in so a killed run can't leave a torn file
+        path = self._path(symbol)
+        tmpPath = path + '.tmp.npz'
+        np.savez(tmpPath, days=days, open=opens, close=closes, fetched_from=fetched_from)
+        os.replace(tmpPath, path)
+        self._data[symbol] = (days, opens, closes, fetched_from)
+
+    def update(self, symbol, candles, fetched_from, replace=False):
+        # Merge freshly downloaded candles into the cached arrays, new bars win.
+        # candles: (days, opens, closes) from decode_candles, or the list of bar dicts
+        # replace: drop what was cached, e.g. for a full refetch after an adjustment
+        # Returns False, without touching the cache, when bars we already had
+        # came back with different prices: the history was adjusted since.
+        if isinstance(candles, tuple):
+            (newDays, newOpen, newClose) = candles
+        else:
+            (newDays, newOpen, newClose) = candles_to_arrays(candles)
+
+        cached = None if replace else self.load(symbol)
+        if cached is not None:
+            days, opens, closes, cachedFrom = cached
+            if _adjusted(days, opens, closes, newDays, newOpen, newClose):
+                return False
+            keep = ~np.isin(days, newDays)
+            newDays = np.concatenate([days[keep], newDays])
+            newOpen = np.concatenate([opens[keep], newOpen])
+            newClose = np.concatenate([closes[keep], newClose])
+            fetched_from = min(fetched_from, cachedFrom)
+
+        order = np.argsort(newDays, kind='stable')
+        self.save(symbol, newDays[order], newOpen[order], newClose[order], fetched_from)
+        return True
+
+    def plan_fetch(self, tickers, start_day, end_day, refresh=False, repair=False):
+        # Returns {symbol: first day to request}. Symbols already up to date are left out.
+        # refresh: ignore the cache and pull the whole window again
+        # repair: also pull the whole window for symbols missing a day other symbols have
+        marketDays = set()
+        if repair:
+            for symbol in tickers:
+                cached = self.load(symbol)
+                if cached is not None:
+                    days = cached[0]
+                    marketDays.update(days[(days >= start_day) & (days <= end_day)].tolist())
+
+        plan = {}
+        for symbol in tickers:
+            cached = self.load(symbol)
+            if refresh or cached is None or len(cached[0]) == 0 or cached[3] > start_day:
+                plan[symbol] = start_day
+                continue
+
+            days = cached[0]
+            if repair:
+                inWindow = days[(days >= start_day) & (days <= end_day)]
+                if len(inWindow) > 0:
+                    expected = [d for d in marketDays if inWindow[0] <= d <= inWindow[-1]]
+                    if len(expected) > len(inWindow):
+                        print('Repairing gaps for: ', symbol)
+                        plan[symbol] = start_day
+                        continue
+
+            nextDay = int(days[-1]) + 1
+            if has_weekday(nextDay, end_day):
+                plan[symbol] = int(days[-min(CANDLE_OVERLAP_BARS, len(days))])
+        return plan
+
+
+def _adjusted(days, opens, closes, newDays, newOpen, newClose):
+    # Did any bar present in both come back with a different open or close?
+    (common, cachedIdx, newIdx) = np.intersect1d(days, newDays, return_indices=True)
+    if len(common) == 0:
+        return False
+    old = np.concatenate([opens[cachedIdx], closes[cachedIdx]])
+    new = np.concatenate([newOpen[newIdx], newClose[newIdx]])
+    return not np.allclose(new, old, rtol=CANDLE_ADJUST_TOLERANCE, atol=0, equal_nan=True)
+
+
+# One CandleCache per directory for the whole process, so a resident process
+# (daemon.py) keeps the arrays in memory from one morning to the next
+_caches = {}
+
+
+def get_cache(cache_dir):
+    cache = _caches.get(cache_dir)
+    if cache is None:
+        cache = _caches.setdefault(cache_dir, CandleCache(cache_dir))
+    return cache
+
+
+
+
+###########################
+#  Dense candle container #
+###########################
+
+class CandleStore:
+    # symbols x trading days layout for the whole universe:
+    #   symbols: sorted symbol names, a symbol's row is its code
+    #   days:    sorted int32 day numbers shared by every symbol
+    #   open, close: float64 (n symbols, n days) arrays, NaN where a symbol has no bar
+    # Built with one allocation per array and already in order, so nothing
+    # downstream needs to sort or deduplicate it again.
+
+    def __init__(self, symbols, days, opens, closes):
+        self.symbols = np.asarray(symbols)
+        self.days = np.asarray(days, dtype='int32')
+        self.open = opens
+        self.close = closes
+
+    @classmethod
+    def from_arrays(cls, pieces, extra_days=()):
+        # pieces: {symbol: (days, opens, closes)}, extra_days reserves empty
+        # columns (e.g. today, to be filled in from the opening quotes)
+        symbols = np.array(sorted(pieces), dtype='str')
+        dayArrays = [np.asarray(pieces[s][0], dtype='int32') for s in symbols]
+        days = np.unique(np.concatenate(dayArrays + [np.asarray(extra_days, dtype='int32')]))
+
+        opens = np.full((len(symbols), len(days)), np.nan)
+        closes = np.full((len(symbols), len(days)), np.nan)
+        for row, symbol in enumerate(symbols):
+            cols = np.searchsorted(days, dayArrays[row])
+            opens[row, cols] = pieces[symbol][1]
+            closes[row, cols] = pieces[symbol][2]
+        return cls(symbols, days, opens, closes)
+
+    @classmethod
+    def from_cache(cls, cache, tickers, start_day, end_day, extra_days=()):
+        pieces = {}
+        for symbol in tickers:
+            cached = cache.load(symbol)
+            if cached is None:
+                continue
+            days, opens, closes, _ = cached
+            inWindow = (days >= start_day) & (days <= end_day)
+            pieces[symbol] = (days[inWindow], opens[inWindow], closes[inWindow])
+        return cls.from_arrays(pieces, extra_days=extra_days)
+
+    def set_day(self, day, symbols, opens, closes):
+        # Fill one day's column in place, symbols we don't hold are ignored
+        col = np.searchsorted(self.days, day)
+        if col == len(self.days) or self.days[col] != day:
+            raise ValueError('Day {} is not in the store'.format(day))
+        rows = np.searchsorted(self.symbols, symbols)
+        rows = np.minimum(rows, len(self.symbols) - 1)
+        known = self.symbols[rows] == np.asarray(symbols)
+        self.open[rows[known], col] = np.asarray(opens, dtype='float64')[known]
+        self.close[rows[known], col] = np.asarray(closes, dtype='float64')[known]
+
+    def present(self):
+        return ~(np.isnan(self.open) & np.isnan(self.close))
+
+    def to_frame(self):
+        # The open, close, datetime, symbol frame the rest of the bot expects,
+        # newest bar first within each symbol and symbols in descending order
+        nSymbols, nDays = self.open.shape
+        r, c = np.nonzero(self.present()[::-1, ::-1])
+        rows = nSymbols - 1 - r
+        cols = nDays - 1 - c
+        return pd.DataFrame({'open': self.open[rows, cols],
+                             'close': self.close[rows, cols],
+                             'datetime': day_to_datetime(self.days[cols]),
+                             'symbol': pd.Categorical.from_codes(rows, categories=self.symbols)})
@@ -18,3 +18,18 @@ BQ_CREDS={
   "auth_provider_x509_cert_url": "",
   "client_x509_cert_url": ""
 }
+CANDLE_CACHE_DIR='/tmp/candles'
+EMA_STATE_PATH='/tmp/ema_state.npz'
+TD_API_URL='https://api.tdameritrade.com/v1'
+GBQ_ORDER_INDEX_PATH='/tmp/order_index.npy'
+STORAGE_URL='sqlite:////tmp/trading_bot.db'
+TRACE_PATH='/tmp/traces.jsonl'
+UNIVERSE_URL='https://en.wikipedia.org/wiki/List_of_S%26P_500_companies'
+UNIVERSE_CACHE_DIR='/tmp/universe'
+PUBSUB_TOPIC=''
+SHARD_DIR='/tmp/shards'
+TRADING_SHARD_SIZE=500
+DAEMON_HOST='127.0.0.1'
+DAEMON_PORT=8090
+ORDERS_STORAGE_URL='bigquery'
+DAEMON_SECRET=''
@@ -0,0 +1,331 @@
+import argparse
+import base64
+import datetime
+import hmac
+import importlib
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+from pandas.tseries.holiday import (AbstractHolidayCalendar, GoodFriday, Holiday, USLaborDay,
+                                    USMartinLutherKingJr, USMemorialDay, USPresidentsDay,
+                                    USThanksgivingDay, nearest_workday, sunday_to_monday)
+
+import config
+import main
+import ratelimit
+import tokens
+
+
+# Resident alternative to one Cloud Function invocation per Pub/Sub message:
+# one process dispatches the same main.py handlers from its own schedule of
+# NYSE trading days, and keeps between runs what every invocation otherwise
+# rebuilds from nothing (imports, the access token, the connection to TDA,
+# the candle cache and the EMA state). A few minutes before each job it
+# refreshes the token and loads the caches, so 9:30 starts warm.
+#
+#   python daemon.py --port 8090
+#   curl localhost:8090/health                      200 while the scheduler is alive
+#   curl localhost:8090/metrics                     runs, warm up, token, rate limits, caches
+#   curl -X POST -H "X-Daemon-Secret: $SECRET" 'localhost:8090/run?message=Kill'   run a handler now
+#
+# The endpoint listens on DAEMON_HOST, keep it off public interfaces. POST
+# /run can place orders, so it needs the X-Daemon-Secret header to match
+# DAEMON_SECRET and is off while that is empty. A header also means a browser
+# page can't send it without a CORS preflight, which gets no answer here.
+
+DAEMON_TIMEZONE = 'America/New_York'
+DAEMON_WARMUP = 300              # seconds before a job to refresh the token and load the caches
+DAEMON_MISFIRE_GRACE = 120       # a job more than this late (host asleep, long run before it) is skipped
+
+
+
+##########################
+### Market calendar   ####
+##########################
+
+class NYSEHolidayCalendar(AbstractHolidayCalendar):
+    # Full day closures. Early closes still open at 9:30, so they don't matter here.
+    rules = [
+        Holiday('New Years Day', month=1, day=1, observance=sunday_to_monday),
+        USMartinLutherKingJr,
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday('Juneteenth', month=6, day=19, start_date='2022-01-01', observance=nearest_workday),
+        Holiday('Independence Day', month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USThanksgivingDay,
+        Holiday('Christmas', month=12, day=25, observance=nearest_workday),
+    ]
+
+_holidays = {}
+
+
+def is_market_day(date):
+    if date.weekday() >= 5:
+        return False
+    if date.year not in _holidays:
+        days = NYSEHolidayCalendar().holidays('{}-01-01'.format(date.year), '{}-12-31'.format(date.year))
+        _holidays[date.year] = {d.date() for d in days}
+    return datetime.date(date.year, date.month, date.day) not in _holidays[date.year]
+
+
+def first_sunday(date):
+    return date.weekday() == 6 and date.day <= 7
+
+
+# (message, Eastern time, days it runs on)
+SCHEDULE = [
+    ('Trading', '09:25', is_market_day),
+    ('MorningTrades', '10:00', is_market_day),
+    ('Ticker', '20:00', is_market_day),
+    ('Refresh Token', '12:00', first_sunday),     # refresh tokens last 90 days
+]
+
+
+def next_run(at, days, after):
+    # First `at` (HH:MM Eastern) on a day `days` accepts, strictly after `after`
+    (hour, minute) = (int(x) for x in at.split(':'))
+    date = after.date()
+    for _ in range(400):
+        when = pd.Timestamp(datetime.datetime(date.year, date.month, date.day, hour, minute)).tz_localize(DAEMON_TIMEZONE)
+        if when > after and days(date):
+            return when
+        date += datetime.timedelta(days=1)
+    raise ValueError('No run of {} within a year'.format(at))
+
+
+
+################
+### Daemon  ####
+################
+
+class Daemon:
+
+    def __init__(self, schedule=None, warmup=DAEMON_WARMUP, misfire_grace=DAEMON_MISFIRE_GRACE):
+        self.jobs = {message: (at, days) for (message, at, days) in (schedule or SCHEDULE)}
+        self.warmup = warmup
+        self.misfire_grace = misfire_grace
+        self.started = time.time()
+        self.runs = {}               # message -> counts and the last run
+        self.warmed = None           # the last warm up
+        self.running = None
+        self._next = {}
+        self._warmedFor = None
+        self._manual = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def now(self):
+        return pd.Timestamp.now(tz=DAEMON_TIMEZONE)
+
+    def preload(self):
+        # Every handler's imports, once. Handlers whose modules can't be
+        # imported here (e.g. BigQuery, SendGrid) still fail when they run.
+        for message, modules in main.HANDLER_MODULES.items():
+            for module in modules:
+                try:
+                    importlib.import_module(module)
+                except ImportError as e:
+                    print('Could not preload {} for {}: {}'.format(module, message, e))
+
+    def warm(self):
+        # Fresh token, every universe symbol's candles and the EMA state in memory
+        import candles
+        import trading
+        import universe
+        import utils
+
+        t1 = time.time()
+        error = None
+        try:
+            utils.get_access_token()
+            cache = candles.get_cache(config.CANDLE_CACHE_DIR)
+            for symbol in universe.load_universe():
+                cache.load(symbol)
+            trading.load_state(config.EMA_STATE_PATH)
+        except Exception as e:
+            error = repr(e)
+            print('Warm up failed: ', error)
+        self.warmed = {'at': time.time(), 'seconds': round(time.time() - t1, 3), 'error': error}
+
+    def _stats(self, message):
+        return self.runs.setdefault(message, {'runs': 0, 'failures': 0, 'skipped': 0, 'last_started': None,
+                                              'last_seconds': None, 'last_error': None})
+
+    def dispatch(self, message):
+        # One handler run, the same event a Pub/Sub trigger would deliver
+        stats = self._stats(message)
+        print('Running: ', message)
+        self.running = message
+        t1 = time.time()
+        error = None
+        try:
+            main.main({'data': base64.b64encode(message.encode('utf-8'))}, None)
+        except Exception as e:
+            error = repr(e)
+            print('{} failed: {}'.format(message, error))
+        finally:
+            self.running = None
+        stats['runs'] += 1
+        stats['failures'] += error is not None
+        stats['last_started'] = t1
+        stats['last_seconds'] = round(time.time() - t1, 3)
+        stats['last_error'] = error
+
+    def trigger(self, message):
+        # Runs `message` as soon as the scheduler is free
+        if message not in main.HANDLERS:
+            return False
+        self._manual.put(message)
+        return True
+
+    def loop(self):
+        self.preload()
+        self.warm()
+        now = self.now()
+        self._next = {message: next_run(at, days, now) for message, (at, days) in self.jobs.items()}
+
+        while not self._stop.is_set():
+            (message, when) = min(self._next.items(), key=lambda item: item[1])
+            now = self.now()
+            if now >= when:
+                (at, days) = self.jobs[message]
+                self._next[message] = next_run(at, days, when)
+                if (now - when).total_seconds() > self.misfire_grace:
+                    print('Skipping {} due at {}, now {}'.format(message, when, now))
+                    self._stats(message)['skipped'] += 1
+                else:
+                    self.dispatch(message)
+                continue
+
+            warmAt = when - pd.Timedelta(seconds=self.warmup)
+            if now >= warmAt and self._warmedFor != (message, when):
+                self._warmedFor = (message, when)
+                self.warm()
+                continue
+
+            wake = warmAt if now < warmAt else when
+            try:
+                manual = self._manual.get(timeout=max(0.0, min(60.0, (wake - now).total_seconds())))
+            except queue.Empty:
+                continue
+            if manual is not None:
+                self.dispatch(manual)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.loop, name='scheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # Lets a running job finish, then the loop exits
+        self._stop.set()
+        self._manual.put(None)
+
+    def health(self):
+        alive = self._thread is not None and self._thread.is_alive()
+        return {'ok': alive,
+                'uptime': round(time.time() - self.started, 3),
+                'running': self.running,
+                'next': {message: str(when) for message, when in self._next.items()},
+                'failing': sorted(m for m, stats in self.runs.items() if stats['last_error'] is not None)}
+
+    def metrics(self):
+        import candles
+        import trading
+
+        cached = candles._caches.get(config.CANDLE_CACHE_DIR)
+        state = trading._states.get(config.EMA_STATE_PATH)
+        return {'uptime': round(time.time() - self.started, 3),
+                'runs': self.runs,
+                'warm': self.warmed,
+                'token': {'fresh': tokens.TOKENS.fresh(), 'expires_in': tokens.TOKENS.expires_in()},
+                'rate_limits': {b.name: b.stats() for b in (ratelimit.MARKET_DATA, ratelimit.ORDERS)},
+                'cached_symbols': 0 if cached is None else sum(v is not None for v in cached._data.values()),
+                'ema_state_symbols': 0 if state is None else len(state[1])}
+
+
+
+#######################
+### Health endpoint ###
+#######################
+
+class HealthServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, bot):
+        super().__init__(address, HealthHandler)
+        self.bot = bot
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            health = self.server.bot.health()
+            self._reply(200 if health['ok'] else 503, health)
+        elif path == '/metrics':
+            self._reply(200, self.server.bot.metrics())
+        else:
+            self._reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/run':
+            self._reply(404, {'error': 'Not found'})
+            return
+        if not config.DAEMON_SECRET:
+            self._reply(403, {'error': 'POST /run is off, DAEMON_SECRET is not set'})
+            return
+        secret = self.headers.get('X-Daemon-Secret', '')
+        if not hmac.compare_digest(secret.encode('utf-8'), config.DAEMON_SECRET.encode('utf-8')):
+            self._reply(403, {'error': 'Wrong or missing X-Daemon-Secret'})
+            return
+        message = parse_qs(url.query).get('message', [''])[0]
+        if self.server.bot.trigger(message):
+            self._reply(202, {'queued': message})
+        else:
+            self._reply(404, {'error': 'No handler for message: ' + message})
+
+
+def serve(bot, host=None, port=None):
+    server = HealthServer((host or config.DAEMON_HOST, port or config.DAEMON_PORT), bot)
+    threading.Thread(target=server.serve_forever, name='health', daemon=True).start()
+    return server
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the bot as a resident process on its own schedule')
+    parser.add_argument('--host', default=None, help='health endpoint address, DAEMON_HOST by default')
+    parser.add_argument('--port', type=int, default=None, help='health endpoint port, DAEMON_PORT by default')
+    args = parser.parse_args()
+
+    bot = Daemon().start()
+    server = serve(bot, args.host, args.port)
+    print('Health endpoint on {}:{}'.format(*server.server_address))
+    try:
+        while bot._thread.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    bot.stop()
+    server.shutdown()
@@ -1,9 +1,12 @@
 import config
 import pandas as pd
-import json
+import numpy as np
+import os
 
+import tracing
+
+from google.cloud import bigquery
 from google.oauth2 import service_account
-import pandas_gbq
 
 
 
@@ -25,26 +28,125 @@ def _formatTradesForDB(ordersDF):
     return ordersDF
 
 
-def save_trades_gbq(ordersDF):
+########################
+### Order id index   ###
+########################
+
+class OrderIdIndex:
+    # orderIds we know are already in GBQ_ORDERS_TABLE, kept on disk as a
+    # sorted int64 array. Only ever holds ids that were written or seen in the
+    # table, so a hit means the order can be skipped without asking BigQuery.
+    # A miss still has to be checked, another machine may have saved it.
+
+    def __init__(self, path=None):
+        self.path = path or config.GBQ_ORDER_INDEX_PATH
+        self.ids = np.array([], dtype='int64')
+        if self.path and os.path.exists(self.path):
+            try:
+                self.ids = np.load(self.path).astype('int64')
+            except (OSError, ValueError) as e:
+                print('Ignoring unreadable order index {}: {}'.format(self.path, e))
+
+    def contains(self, orderIds):
+        return np.isin(np.asarray(orderIds, dtype='int64'), self.ids)
+
+    def add(self, orderIds):
+        self.ids = np.union1d(self.ids, np.asarray(orderIds, dtype='int64'))
+
+    def save(self):
+        if not self.path:
+            return
+        tmpPath = self.path + '.tmp.npy'
+        np.save(tmpPath, self.ids)
+        os.replace(tmpPath, self.path)
+
+
+
+########################
+### BigQuery helpers ###
+########################
+
+def _client(credentials):
+    return bigquery.Client(credentials=credentials, project=credentials.project_id)
+
+
+def _time_window(ordersDF):
+    # enteredTime range of the batch, the table is only searched inside it
+    times = pd.to_datetime(ordersDF['enteredTime'], utc=True)
+    return (times.min().to_pydatetime(), times.max().to_pydatetime())
+
+
+def _existing_order_ids(client, ordersDF, table=None):
+    # orderIds of this batch already in the table, looking only at the batch's enteredTime window
+    table = table or config.GBQ_ORDERS_TABLE
+    (start, end) = _time_window(ordersDF)
+    query = ('select distinct orderId from `{}` '
+             'where enteredTime between @start and @end and orderId in unnest(@ids)').format(table)
+    jobConfig = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('start', 'TIMESTAMP', start),
+        bigquery.ScalarQueryParameter('end', 'TIMESTAMP', end),
+        bigquery.ArrayQueryParameter('ids', 'INT64', [int(i) for i in ordersDF['orderId'].unique()]),
+    ])
+    rows = client.query(query, job_config=jobConfig).result()
+    return [row['orderId'] for row in rows]
+
+
+def _load_dataframe(client, ordersDF, table, write_disposition):
+    # One load job instead of to_gbq's chunked appends
+    jobConfig = bigquery.LoadJobConfig(write_disposition=write_disposition)
+    client.load_table_from_dataframe(ordersDF, table, job_config=jobConfig).result()
+
+
+def save_trades_gbq(ordersDF, index=None):
+    # Saves the orders not already in GBQ_ORDERS_TABLE: checks the batch's
+    # enteredTime window for existing orderIds, then appends the rest in one load job.
+    # Orders in the local orderId index are dropped up front, so a batch that's
+    # all been saved before never touches BigQuery. Returns the rows written.
+
+    index = index if index is not None else OrderIdIndex()
+    ordersDF = ordersDF[~index.contains(ordersDF['orderId'])].reset_index(drop=True)
+    if ordersDF.shape[0] == 0:
+        print('All trades are already in the DB')
+        return 0
 
     # Need GBQ creds
     credentials = service_account.Credentials.from_service_account_info(config.BQ_CREDS)
-    
-    # Before we submit, let's make sure we haven't already submitted these trades
-    # If there are trades we've submitted, we'll ignore them. 
-    query = 'select orderId from {}'.format(config.GBQ_ORDERS_TABLE)
-    checkDB = pd.read_gbq(query=query, credentials=credentials)
-    
-    # Find existing orders in the DB and exclude them from the DB submission
-    existInDB = ordersDF.loc[ordersDF['orderId'].isin(checkDB['orderId']),'orderId'].values.tolist()
-    ordersDF = ordersDF[~ordersDF['orderId'].isin(existInDB)].reset_index(drop=True)
+    client = _client(credentials)
     ordersForDB = _formatTradesForDB(ordersDF)
 
-    if ordersForDB.shape[0] > 0:
-        print('Submitting {} trades to DB..'.format(ordersForDB.shape[0]))
-        
-        ordersForDB.to_gbq(destination_table='{}'.format(config.GBQ_ORDERS_TABLE),
-                        credentials = credentials, if_exists='append')
-        
+    # Find existing orders in the DB and exclude them from the DB submission
+    with tracing.span('db_dedup_query'):
+        existInDB = _existing_order_ids(client, ordersForDB)
+    index.add(existInDB)
+    ordersForDB = ordersForDB[~ordersForDB['orderId'].isin(existInDB)].reset_index(drop=True)
+    written = ordersForDB.shape[0]
+    if written > 0:
+        print('Submitting {} trades to DB..'.format(written))
+        with tracing.span('db_write'):
+            _load_dataframe(client, ordersForDB, config.GBQ_ORDERS_TABLE, bigquery.WriteDisposition.WRITE_APPEND)
     else:
         print('All trades are already in the DB')
+
+    tracing.count('db_rows_written', written)
+    index.add(ordersForDB['orderId'])
+    index.save()
+    return written
+
+
+def load_trades_gbq(start, end, symbols=None):
+    # Orders entered between start and end (inclusive dates or timestamps, UTC)
+    credentials = service_account.Credentials.from_service_account_info(config.BQ_CREDS)
+    client = _client(credentials)
+    start = pd.Timestamp(start, tz='UTC')
+    end = pd.Timestamp(end, tz='UTC')
+    if end == end.normalize():
+        end = end + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+
+    query = 'select * from `{}` where enteredTime between @start and @end'.format(config.GBQ_ORDERS_TABLE)
+    params = [bigquery.ScalarQueryParameter('start', 'TIMESTAMP', start.to_pydatetime()),
+              bigquery.ScalarQueryParameter('end', 'TIMESTAMP', end.to_pydatetime())]
+    if symbols is not None:
+        query += ' and symbol in unnest(@symbols)'
+        params.append(bigquery.ArrayQueryParameter('symbols', 'STRING', list(symbols)))
+    jobConfig = bigquery.QueryJobConfig(query_parameters=params)
+    return client.query(query, job_config=jobConfig).to_dataframe()
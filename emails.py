@@ -4,12 +4,16 @@ from sendgrid.helpers.mail import Mail, Email
 from python_http_client.exceptions import HTTPError
 import config 
 import pandas as pd
+import time
+import tracing
 
 def ticker_check_email(addTicker, removeTicker):
-    html_content = '''<h1> Ticker Changes Required </h1>
+    html_content = '''<h1> Ticker Changes Proposed </h1>
 
     <br>
 
+    <p> Nothing changes until they are approved, publish 'Approve Tickers' to apply them. </p>
+
     <h2> Add the following tickers </h2>
         {}
 
@@ -45,10 +49,15 @@ def send_email(request, html_content, subject):
         html_content=html_content
         )
 
+    t1 = time.perf_counter()
     try:
-        response = sg.send(message)
+        with tracing.span('email'):
+            response = sg.send(message)
+        tracing.record_http('POST', 'sendgrid/mail/send', response.status_code, time.perf_counter() - t1)
         return f"email.status_code={response.status_code}"
         #expected 202 Accepted
 
     except HTTPError as e:
+        tracing.record_http('POST', 'sendgrid/mail/send', e.status_code, time.perf_counter() - t1)
+        tracing.count('email_failures')
         return e.message
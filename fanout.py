@@ -0,0 +1,211 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import candles
+import config
+import metrics
+import pubsub
+import ratelimit
+import tracing
+import trading
+import utils
+
+
+# Sharded Trading run, for universes too big for one instance before the open:
+#
+#   'Trading Fanout'   the coordinator splits the universe into shards of
+#                      TRADING_SHARD_SIZE, writes a manifest to SHARD_DIR and
+#                      publishes one 'Trading Shard' message per shard
+#   'Trading Shard'    each worker fetches the history for its shard and
+#                      brings the EMA / slope state up to yesterday, then
+#                      writes that compact state to SHARD_DIR/<run>/
+#   merge              the coordinator (which pulled the account snapshot
+#                      meanwhile) waits for the shards, concatenates their
+#                      states and trades the whole universe at the open as usual
+#
+# SHARD_DIR has to be storage every instance can see (a mounted bucket in the
+# cloud), a /tmp SHARD_DIR is refused unless the shards run in this process
+# (pubsub.use_local). The merged state is kept there too, as next run's
+# starting point.
+#
+# TDA's request budget is per account, so each of n workers gets 1/n of it
+# and the history fetch takes as long as on one instance with the whole
+# budget: fanning out doesn't make a quota bound fetch any faster. What it
+# splits is the memory and the EMA work, and the coordinator gets the
+# account meanwhile. The coordinator waits at most until the open.
+
+FANOUT_SHARD_MESSAGE = 'Trading Shard'
+FANOUT_WAIT = 480               # seconds the coordinator waits for the shards, at most until the open
+FANOUT_POLL_INTERVAL = 0.5
+
+
+
+######################
+#  Layout on disk    #
+######################
+
+def split_shards(tickers, shard_size=None):
+    # Balanced consecutive chunks of at most shard_size symbols, and no more
+    # shards than requests per minute, each shard needs one of them
+    shard_size = shard_size or config.TRADING_SHARD_SIZE
+    nShards = max(1, -(-len(tickers) // shard_size))
+    if nShards > ratelimit.TD_REQUESTS_PER_MINUTE:
+        print('{} shards of {} would leave less than a request a minute each, using {}'.format(
+            nShards, shard_size, ratelimit.TD_REQUESTS_PER_MINUTE))
+        nShards = ratelimit.TD_REQUESTS_PER_MINUTE
+    return [list(chunk) for chunk in np.array_split(np.asarray(tickers, dtype='object'), nShards)]
+
+
+def run_dir(run):
+    return os.path.join(config.SHARD_DIR, run)
+
+
+def merged_state_path():
+    return os.path.join(config.SHARD_DIR, 'ema_state.npz')
+
+
+def _shard_paths(run, shard):
+    base = os.path.join(run_dir(run), 'shard-{:04d}'.format(shard))
+    return (base + '.npz', base + '.json')
+
+
+def _write_json(path, payload):
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(payload, f)
+    os.replace(tmpPath, path)
+
+
+def write_manifest(run, shards):
+    os.makedirs(run_dir(run), exist_ok=True)
+    _write_json(os.path.join(run_dir(run), 'manifest.json'), {'run': run, 'shards': shards})
+
+
+def read_manifest(run):
+    with open(os.path.join(run_dir(run), 'manifest.json')) as f:
+        return json.load(f)
+
+
+def prune_runs(keep):
+    # Earlier runs' shard files, nothing reads them once merged
+    for name in os.listdir(config.SHARD_DIR):
+        path = os.path.join(config.SHARD_DIR, name)
+        if name != keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+
+################
+#  Worker      #
+################
+
+def run_shard(run, shard, token, expires_in, dayWindow=3):
+    # History + EMA state for one shard. The .json marker is written last, so
+    # the coordinator never reads a half written state.
+    t1 = time.time()
+    shards = read_manifest(run)['shards']
+    tickers = shards[shard]
+    print('Shard {} of {}: {} symbols'.format(shard + 1, len(shards), len(tickers)))
+    quota = ratelimit.TokenBucket('market_data', max(1, ratelimit.TD_REQUESTS_PER_MINUTE // len(shards)))
+
+    (store, today_day, failure_list, adjusted) = utils.get_history_store(token, tickers, expires_in, quota=quota)
+    with tracing.span('ema_state'):
+        previous = trading.load_state(merged_state_path(), dayWindow=dayWindow)
+        if previous is not None:
+            rows = previous.index_of(tickers)
+            previous = previous.take(rows[rows >= 0])
+        state = metrics.sync_ema_state(previous, store.to_frame(), window=dayWindow, rebuild=adjusted)
+
+    (statePath, markerPath) = _shard_paths(run, shard)
+    state.save(statePath)
+    _write_json(markerPath, {'shard': shard, 'symbols': len(state), 'failures': failure_list,
+                             'seconds': round(time.time() - t1, 3)})
+    print('Shard {} done in {} seconds'.format(shard + 1, round(time.time() - t1, 3)))
+    return state
+
+
+
+#####################
+#  Coordinator      #
+#####################
+
+def wait_for_shards(run, nShards, timeout=FANOUT_WAIT, poll_interval=FANOUT_POLL_INTERVAL):
+    # Returns the shards still missing when every one reported or `timeout` passed
+    stopAt = time.monotonic() + timeout
+    missing = list(range(nShards))
+    while True:
+        missing = [k for k in missing if not os.path.exists(_shard_paths(run, k)[1])]
+        if len(missing) == 0 or time.monotonic() >= stopAt:
+            return missing
+        time.sleep(poll_interval)
+
+
+def merge_shards(run, nShards, dayWindow=3):
+    # Returns (state, failure_list, missing shards)
+    states = []
+    failures = []
+    missing = []
+    for k in range(nShards):
+        (statePath, markerPath) = _shard_paths(run, k)
+        if not os.path.exists(markerPath):
+            missing.append(k)
+            continue
+        with open(markerPath) as f:
+            failures.extend(json.load(f)['failures'])
+        states.append(metrics.EmaState.load(statePath, window=dayWindow))
+    return (metrics.EmaState.concat(states, window=dayWindow), failures, missing)
+
+
+def prepare_fanout(token, tickers, expires_in, dayWindow=3, quantity=30, shard_size=None,
+                   publisher=None, timeout=FANOUT_WAIT):
+    # The sharded prepare_trading. Returns a TradingPlan for execute_trading.
+    t1 = time.time()
+    publisher = publisher or pubsub.get_publisher()
+    local = isinstance(publisher, pubsub.LocalPubSub)
+    if not local and os.path.abspath(config.SHARD_DIR).startswith('/tmp/'):
+        raise ValueError('SHARD_DIR {} is local to this instance, the shards could not see it'.format(config.SHARD_DIR))
+
+    run = time.strftime('%Y%m%d-%H%M%S')
+    shards = split_shards(tickers, shard_size)
+    write_manifest(run, shards)
+    tracing.annotate('shards', len(shards))
+
+    with tracing.span('fanout_publish'):
+        for k in range(len(shards)):
+            publisher.publish(FANOUT_SHARD_MESSAGE, {'run': run, 'shard': k})
+        if not local:
+            # A message Pub/Sub didn't take fails here, not as a missing shard
+            publisher.drain(timeout=timeout)
+    print('Published {} shards for run {}'.format(len(shards), run))
+
+    # The account side doesn't depend on the shards, get it while they run
+    (positions, exits, reconciler, payloads) = trading.prepare_orders(token, tickers, quantity=quantity)
+
+    # Shards still missing at the open aren't worth the wait
+    untilOpen = utils.get_market_open(seconds_after=0).timestamp() - time.time()
+    with tracing.span('fanout_wait'):
+        wait_for_shards(run, len(shards), timeout=max(0, min(timeout, untilOpen)))
+    with tracing.span('fanout_merge'):
+        (state, failure_list, missing) = merge_shards(run, len(shards), dayWindow=dayWindow)
+        trading.save_state(state, merged_state_path())
+    prune_runs(keep=run)
+    if len(missing) > 0:
+        # Their symbols just aren't traded today
+        print('Shards that never reported: ', missing)
+        tracing.count('shards_missing', len(missing))
+        for k in missing:
+            failure_list.extend(shards[k])
+
+    today_day = candles.date_to_day(utils.get_dates()[0])
+    t2 = time.time()
+    print('Time spent preparing before the open: ', round(t2-t1, 3), ' seconds')
+    # The merged state also carries symbols whose history failed, leave them out
+    failedSet = set(failure_list)
+    tickerSet = set(tickers)
+    symbols = [s for s in state.symbols if s in tickerSet and s not in failedSet]
+    return trading.TradingPlan(symbols, None, today_day, state, positions, payloads,
+                               failure_list, exits, reconciler)
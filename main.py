@@ -1,13 +1,28 @@
 import base64
 
-import utils 
-import config
-import db
-import emails
-import pandas as pd
+import tracing
 
-import aiohttp
-import asyncio
+
+# Pub/Sub message -> handler. Each handler imports only what it needs, a cold
+# start for 'Refresh Token' shouldn't pay for pandas, aiohttp or BigQuery.
+# HANDLER_MODULES lists the heavy modules each message loads, directly or
+# through the modules it imports (e.g. pandas through trading). It is the one
+# list of what to preload: benchmarks.py and daemon.py both read it.
+# Handlers registered with_attributes also get the message attributes, e.g.
+# the run and shard of a 'Trading Shard' message.
+HANDLERS = {}
+HANDLER_MODULES = {}
+HANDLER_ATTRIBUTES = set()
+
+
+def handler(message, modules, with_attributes=False):
+    def register(fn):
+        HANDLERS[message] = fn
+        HANDLER_MODULES[message] = modules
+        if with_attributes:
+            HANDLER_ATTRIBUTES.add(message)
+        return fn
+    return register
 
 
 
@@ -19,157 +34,254 @@ def main(event, context):
     """
     pubsub_message = base64.b64decode(event['data']).decode('utf-8')
 
-    ####################################
-    ########## Check tickers ###########
-    ####################################
-    if pubsub_message == 'Ticker':
-        print('Getting list of predefined tickers')
-        defaultTickers = pd.read_csv('tickers.txt')
-        defaultTickerSet = set(defaultTickers['tickers'].values.tolist())
+    run = HANDLERS.get(pubsub_message)
+    if run is None:
+        print('No handler for message: ', pubsub_message)
+        return
+
+    # One structured trace record per invocation, see tracing.py
+    tracing.start(pubsub_message)
+    error = None
+    try:
+        if pubsub_message in HANDLER_ATTRIBUTES:
+            run(pubsub_message, event.get('attributes') or {})
+        else:
+            run(pubsub_message)
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        tracing.finish(error=error)
+
+
+
+####################################
+########## Check tickers ###########
+####################################
+@handler('Ticker', ['pandas', 'universe', 'emails'])
+def check_tickers(pubsub_message):
+    with tracing.span('imports'):
+        import pandas as pd
+        import universe
+        import emails
+
+    # Fetches the index page only if it changed since last night and compares
+    # it to the last snapshot (seeded from tickers.txt). A change is only
+    # proposed and emailed, 'Approve Tickers' applies it.
+    print("Checking Wikipedia for changes to the S&P500")
+    with tracing.span('ticker_scrape'):
+        (finalWikiTickers, added, removed) = universe.refresh_universe()
+
+    removeTicker = pd.DataFrame({'RemoveTickers': removed})
+
+    addTicker = pd.DataFrame({'AddTickers': added})
+
+    if ((len(removeTicker)>0) | (len(addTicker)>0)):
+        print('Proposed ticker changes, waiting for approval..')
+        html, subject = emails.ticker_check_email(addTicker.to_html(), removeTicker.to_html())
+        response = emails.send_email(request=pubsub_message, html_content=html, subject=subject)
+        print(response)
+    else:
+        print("No tickers to change")
+    print('Tickers in the universe: ', len(finalWikiTickers))
+
+
+
+@handler('Approve Tickers', ['universe'])
+def approve_tickers(pubsub_message):
+    with tracing.span('imports'):
+        import universe
+
+    # Applies the changes the last Ticker check proposed, Trading trades
+    # (and sells the names dropped by) the new membership from its next run
+    changes = universe.approve_universe()
+    if changes is None:
+        print('No ticker changes waiting for approval')
+        return
+    (added, removed) = changes
+    print('Added tickers: ', added)
+    print('Removed tickers: ', removed)
+
+
+
+########################################
+########## Run trading algo ###########
+########################################
+@handler('Trading', ['pandas', 'utils', 'trading', 'universe'])
+def run_trading(pubsub_message):
+    with tracing.span('imports'):
+        import utils
+        import trading
+        import universe
+
+    # Get Tickers:
+    print('getting tickers')
+    tickers = universe.load_universe()
+
+
+    print('getting access token')
+    with tracing.span('token'):
+        newAccess = utils.get_access_token()
+    access_token = newAccess['access_token']
+    expires_in = newAccess['expires_in']
 
-        print("Going to Wikipedia to get list of current tickers in S&P500")
-        wikiTickers = utils.get_sp500_tickers()
+    print('Preparing everything we can before the open..')
+    plan = trading.prepare_trading(token=access_token, tickers=tickers, expires_in=expires_in)
 
-        # Need to filter out anything with a period.
-        filteredWikiTickers = [x for x in wikiTickers if '.' not in x]
+    print('Waiting for the open, then finding and submitting the orders!')
+    # This is the old way - the slow way!
+    #(buys, sells) = utils.make_trades(positionsToBuy=algoBuys, positionsToSell=algoSells, token=access_token)
+    _execute_and_report(plan, access_token)
 
-        # Now double check to make sure there's a max of 4 letters, remove otherwise
-        finalWikiTickers = [x for x in filteredWikiTickers if len(x)<=4]
-        wikiTickerSet = set(finalWikiTickers)
 
-        # Check if website tickers are different:
-        defaultNotInWiki = defaultTickerSet.difference(wikiTickerSet)
-        wikiNotInDefault = wikiTickerSet.difference(defaultTickerSet)
+def _execute_and_report(plan, access_token):
+    import trading
 
-        removeTicker = pd.DataFrame({'RemoveTickers': list(defaultNotInWiki)})
+    with tracing.span('execute_trading') as timer:
+        (algoBuys, algoSells, todaysMetrics, orderResults) = trading.execute_trading(plan=plan, token=access_token)
+    print('Time took to quote, decide and send orders: ', round(timer.seconds, 3), ' seconds')
 
-        addTicker = pd.DataFrame({'AddTickers': list(wikiNotInDefault)})
+    buyToday = todaysMetrics[todaysMetrics['symbol'].isin(algoBuys)]['close'].sum()
+    sellToday = todaysMetrics[todaysMetrics['symbol'].isin(algoSells)]['close'].sum()
+    maxNeeded = todaysMetrics['close'].sum()
 
-        if ((len(removeTicker)>0) | (len(addTicker)>0)):
-            print('Need to change some tickers..')
-            html, subject = emails.ticker_check_email(addTicker.to_html(), removeTicker.to_html())
-            response = emails.send_email(request=pubsub_message, html_content=html, subject=subject)
-            print(response)
-        else:
-            print("No tickers to change")
-        
-    ########################################
-    ########## Run trading algo ###########
-    ########################################
-    if pubsub_message == 'Trading':
+    print('Approx amount bought today: ', round(buyToday,2))
+    print('Approx amount sold today: ', round(sellToday,2))
+    print('Maximum possible needed: ', round(maxNeeded,2))
+    print('Trading bot deployed')
+
+
+
+########################################
+######## Sharded trading algo #########
+########################################
+@handler('Trading Fanout', ['pandas', 'utils', 'trading', 'universe', 'fanout'])
+def run_trading_fanout(pubsub_message):
+    with tracing.span('imports'):
+        import utils
+        import trading
+        import universe
+        import fanout
+
+    # Same as 'Trading', but the history and EMA state are built by one
+    # 'Trading Shard' instance per TRADING_SHARD_SIZE tickers, see fanout.py
+    print('getting tickers')
+    tickers = universe.load_universe()
+
+    print('getting access token')
+    with tracing.span('token'):
+        newAccess = utils.get_access_token()
+    access_token = newAccess['access_token']
+    expires_in = newAccess['expires_in']
 
-        # Get Tickers: 
-        print('getting tickers')
-        tickers = pd.read_csv('tickers.txt')
-        tickers = tickers['tickers'].values.tolist()
+    print('Fanning out the preparation before the open..')
+    plan = fanout.prepare_fanout(token=access_token, tickers=tickers, expires_in=expires_in)
 
+    print('Waiting for the open, then finding and submitting the orders!')
+    _execute_and_report(plan, access_token)
 
-        print('getting access token')
+
+@handler('Trading Shard', ['utils', 'fanout'], with_attributes=True)
+def run_trading_shard(pubsub_message, attributes):
+    with tracing.span('imports'):
+        import utils
+        import fanout
+
+    run = attributes['run']
+    shard = int(attributes['shard'])
+    tracing.annotate('run', run)
+    tracing.annotate('shard', shard)
+
+    print('getting access token')
+    with tracing.span('token'):
         newAccess = utils.get_access_token()
-        access_token = newAccess['access_token']
-        expires_in = newAccess['expires_in']
-
-        print('Running the algo..')
-        hist_stock_data = utils.get_stocks(token=access_token, tickers=tickers, expires_in=expires_in)
-        print('Calculating trade metrics..')
-        trade_metric_df = utils.calc_trade_metrics(stock_data=hist_stock_data)
-        print('Shape of trade metrics: ', trade_metric_df.shape)
-
-        print("Getting buy/sell symbols...")
-        (algoBuys, algoSells) = utils.find_trades(data_frame=trade_metric_df, token=access_token, tickers=tickers)
-        
-        print('Submit the orders!')
-        # This is the old way - the slow way!
-        #(buys, sells) = utils.make_trades(positionsToBuy=algoBuys, positionsToSell=algoSells, token=access_token)
-
-        # Async order submissions
-        orderStart = pd.to_datetime('today')
-        asyncio.run(utils.make_trades_async(buySymbolsList=algoBuys, sellSymbolsList=algoSells, token=access_token))
-        orderEnd = pd.to_datetime('today')
-        print('Time took to send orders: ', (orderEnd - orderStart))
-        
-        buyToday = hist_stock_data[(hist_stock_data['symbol'].isin(algoBuys)  & 
-                (hist_stock_data['datetime']==pd.to_datetime('today').strftime('%Y-%m-%d')))]['close'].sum()
-
-        sellToday = hist_stock_data[(hist_stock_data['symbol'].isin(algoSells)  & 
-                (hist_stock_data['datetime']==pd.to_datetime('today').strftime('%Y-%m-%d')))]['close'].sum()
-
-        maxNeeded = hist_stock_data[(hist_stock_data['datetime']==pd.to_datetime('today').strftime('%Y-%m-%d'))]['close'].sum()
-                         
-        print('Approx amount bought today: ', round(buyToday,2))
-        print('Approx amount sold today: ', round(sellToday,2))
-        print('Maximum possible needed: ', round(maxNeeded,2))
-        print('Trading bot deployed')
-
-
-    #######################################
-    #      Save todays trades to DB       #
-    #######################################
-    if pubsub_message == 'MorningTrades':
-        
-        print('getting access token')
+
+    fanout.run_shard(run, shard, token=newAccess['access_token'], expires_in=newAccess['expires_in'])
+
+
+
+#######################################
+#      Save todays trades to DB       #
+#######################################
+@handler('MorningTrades', ['pandas', 'utils', 'storage', 'emails'])
+def save_morning_trades(pubsub_message):
+    with tracing.span('imports'):
+        import pandas as pd
+        import utils
+        import storage
+        import emails
+
+    print('getting access token')
+    with tracing.span('token'):
         newAccess = utils.get_access_token()
-        access_token = newAccess['access_token']
-        expires_in = newAccess['expires_in']
+    access_token = newAccess['access_token']
 
-        print('Pulling and saving todays trades...')
-        today = pd.to_datetime('today').strftime('%Y-%m-%d')
+    print('Pulling and saving todays trades...')
+    today = pd.to_datetime('today').strftime('%Y-%m-%d')
+    with tracing.span('transactions'):
         todaysTrades = utils.get_historical_trades_DF(start_date=today, end_date=today, token=access_token)
-        print('There were {} trades today..'.format(todaysTrades.shape[0]))
+    print('There were {} trades today..'.format(todaysTrades.shape[0]))
+
+    print('Saving trades to the DB..')
+    storage.get_storage('orders').save_orders(todaysTrades)
+    print('Done saving todays trades..')
 
-        print('Saving trades to the DB..')
-        db.save_trades_gbq(ordersDF=todaysTrades)
-        print('Done saving todays trades..')
+    html, subject = emails.daily_trades(tradesDF=todaysTrades)
+    response = emails.send_email(pubsub_message, html_content=html, subject=subject)
+    print('Email response: ', response)
+    print('Done saving and send todays trades...')
 
-        html, subject = emails.daily_trades(tradesDF=todaysTrades)
-        response = emails.send_email(pubsub_message, html_content=html, subject=subject)
-        print('Email response: ', response)
-        print('Done saving and send todays trades...')
-   
 
 
-    #######################################
-    #           Shut it down!             #
-    #######################################
-    if pubsub_message == 'Kill':    
+#######################################
+#           Shut it down!             #
+#######################################
+@handler('Kill', ['utils', 'universe'])
+def kill(pubsub_message):
+    with tracing.span('imports'):
+        import utils
+        import universe
 
-        # Get Tickers: 
-        print('getting tickers')
-        tickers = pd.read_csv('tickers.txt')
-        tickers = tickers['tickers'].values.tolist()
+    # Get Tickers: everything that has ever been in the universe, so names
+    # that have since left the index are sold too
+    print('getting tickers')
+    tickers = universe.ever_members()
 
-        print('getting access token')
+    print('getting access token')
+    with tracing.span('token'):
         newAccess = utils.get_access_token()
-        access_token = newAccess['access_token']
+    access_token = newAccess['access_token']
 
-        orderStart = pd.to_datetime('today')
+    with tracing.span('liquidation') as timer:
         failures = utils.shut_it_down(token=access_token, tickers=tickers)
-        orderEnd = pd.to_datetime('today')
-        print('Trades that failed: ', failures)
-        print('Time took to send orders: ', (orderEnd - orderStart))
+    print('Trades that failed: ', failures)
+    print('Time took to send orders: ', round(timer.seconds, 3), ' seconds')
 
 
-    #######################################
-    #        Update Refresh Token         #
-    #######################################
 
-    if pubsub_message == 'Refresh Token':
+#######################################
+#        Update Refresh Token         #
+#######################################
+@handler('Refresh Token', ['tokens', 'storage'])
+def refresh_token(pubsub_message):
+    with tracing.span('imports'):
+        import tokens
 
-        newAccess = utils.get_access_token()
-        access_token = newAccess['access_token']
-        
-        # Get a new token
-        newRefreshToken = utils.get_new_refresh_token(token=access_token)
-        print('New creds: ', newRefreshToken)
-
-        configFile = open("config.py").read().splitlines()
-        newString = "TD_REFRESH_TOKEN=\'{}\'".format(newRefreshToken['refresh_token'])
-        print(newString)
-
-        # Location of token string
-        configFile[1] = newString
-        with open('config.py', 'w') as f:
-            for item in configFile:
-                f.write("%s\n" % item)
+    # Get a new token
+    with tracing.span('token'):
+        newRefreshToken = tokens.request_new_refresh_token()
+    print('New creds: ', newRefreshToken)
+
+    configFile = open("config.py").read().splitlines()
+    newString = "TD_REFRESH_TOKEN=\'{}\'".format(newRefreshToken['refresh_token'])
+    print(newString)
+
+    # Location of token string
+    configFile[1] = newString
+    with open('config.py', 'w') as f:
+        for item in configFile:
+            f.write("%s\n" % item)
 
+    if tokens.save_token('refresh_token', newRefreshToken['refresh_token'],
+                         expires_in=newRefreshToken.get('refresh_token_expires_in')):
         print('Saved new refresh token')
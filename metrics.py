@@ -0,0 +1,413 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+EMA_SPAN = 9
+SLOPE_WINDOW = 3
+
+
+
+##############################
+#  Symbols x days alignment  #
+##############################
+
+def align_by_symbol(symbols, days):
+    # Lays the rows out as a symbols x bars grid, right aligned so every
+    # symbol's latest bar sits in the last column and short histories are
+    # padded with NaN on the left. Each symbol only uses the bars it has, the
+    # same as the old groupby('symbol') did.
+    # Returns (uniqueSymbols, order, rowIdx, colIdx, width) where order sorts
+    # the input by symbol then day and (rowIdx, colIdx) is each sorted row's cell.
+    codes, uniqueSymbols = pd.factorize(np.asarray(symbols), sort=True)
+    order = np.lexsort((np.asarray(days), codes))
+    rowIdx = codes[order]
+
+    counts = np.bincount(codes, minlength=len(uniqueSymbols))
+    width = int(counts.max()) if len(counts) > 0 else 0
+    starts = np.cumsum(counts) - counts
+    colIdx = width - counts[rowIdx] + (np.arange(len(order)) - starts[rowIdx])
+    return (uniqueSymbols, order, rowIdx, colIdx, width)
+
+
+def to_matrix(values, order, rowIdx, colIdx, nSymbols, width):
+    matrix = np.full((nSymbols, width), np.nan)
+    matrix[rowIdx, colIdx] = np.asarray(values, dtype='float64')[order]
+    return matrix
+
+
+
+####################
+#  Metric kernels  #
+####################
+
+def ema_matrix(values, span=EMA_SPAN, num=None, den=None, present=None):
+    # Same weights as pandas ewm(span=span, adjust=True).mean(), one pass over
+    # the columns for every symbol at once. NaNs decay the weights without
+    # adding an observation, just like ignore_na=False.
+    # Returns (ema, numerator, denominator), the last two being the running
+    # state after the final column. Pass num/den to continue from a saved state,
+    # with `present` marking real bars so alignment padding doesn't decay it.
+    decay = 1 - 2.0/(span + 1)
+    nSymbols, width = values.shape
+    num = np.zeros(nSymbols) if num is None else np.array(num, dtype='float64')
+    den = np.zeros(nSymbols) if den is None else np.array(den, dtype='float64')
+    ema = np.full((nSymbols, width), np.nan)
+    for j in range(width):
+        x = values[:, j]
+        valid = ~np.isnan(x)
+        if present is None:
+            num = decay*num + np.where(valid, x, 0.0)
+            den = decay*den + valid
+        else:
+            num = np.where(present[:, j], decay*num + np.where(valid, x, 0.0), num)
+            den = np.where(present[:, j], decay*den + valid, den)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ema[:, j] = num/den
+    return (ema, num, den)
+
+
+def slope_weights(window=SLOPE_WINDOW):
+    # OLS slope against x = 0..window-1 is a fixed linear combination of the
+    # window. For the 3 day window it's just (y2 - y0) / 2.
+    x = np.arange(window, dtype='float64')
+    x = x - x.mean()
+    return x / (x**2).sum()
+
+
+def slope_matrix(values, window=SLOPE_WINDOW):
+    # Rolling slope of each row, NaN until a full window is available
+    nSymbols, width = values.shape
+    slope = np.full((nSymbols, width), np.nan)
+    if width < window:
+        return slope
+    weights = slope_weights(window)
+    acc = np.zeros((nSymbols, width - window + 1))
+    for k in range(window):
+        acc += weights[k] * values[:, k:width - window + 1 + k]
+    slope[:, window - 1:] = acc
+    return slope
+
+
+def shift_right(values):
+    shifted = np.full(values.shape, np.nan)
+    shifted[:, 1:] = values[:, :-1]
+    return shifted
+
+
+
+#############################
+#       Trade Metrics       #
+#############################
+
+def calc_trade_metrics(stock_data, dayWindow=SLOPE_WINDOW, span=EMA_SPAN):
+    # Vectorized version of the groupby / ewm / rolling(linregress) pipeline.
+    # Adds EMA_Close, EMA_Open, slope, prior_slope and prior_slope_sign and
+    # returns the rows sorted by symbol and datetime, both descending.
+    days = pd.to_datetime(stock_data['datetime']).values
+    (uniqueSymbols, order, rowIdx, colIdx, width) = align_by_symbol(stock_data['symbol'].values, days)
+    nSymbols = len(uniqueSymbols)
+
+    openM = to_matrix(stock_data['open'].values, order, rowIdx, colIdx, nSymbols, width)
+    closeM = to_matrix(stock_data['close'].values, order, rowIdx, colIdx, nSymbols, width)
+
+    emaOpen = ema_matrix(openM, span)[0]
+    emaClose = ema_matrix(closeM, span)[0]
+    slope = slope_matrix(emaOpen, dayWindow)
+    priorSlope = shift_right(slope)
+
+    # Back to rows, newest first
+    descending = order[::-1]
+    cells = (rowIdx[::-1], colIdx[::-1])
+    metrics = stock_data.iloc[descending].reset_index(drop=True)
+    metrics['datetime'] = pd.to_datetime(metrics['datetime'])
+    metrics['EMA_Close'] = emaClose[cells]
+    metrics['EMA_Open'] = emaOpen[cells]
+    metrics['slope'] = slope[cells]
+    metrics['prior_slope'] = priorSlope[cells]
+    metrics['prior_slope_sign'] = np.sign(metrics['prior_slope'])
+    return metrics
+
+
+
+##########################
+#   Persisted EMA state  #
+##########################
+
+def to_day_numbers(datetimes):
+    # Days since 1970-01-01, the same key the candle cache uses
+    return pd.to_datetime(datetimes).values.astype('datetime64[D]').astype('int64')
+
+
+class EmaState:
+    # Everything needed to roll the metrics forward one bar per symbol, as of
+    # each symbol's last history bar (last_day):
+    #   open_num/open_den, close_num/close_den: running ewm weight sums
+    #   open_tail: the last window-1 EMA_Open values, oldest first
+    #   last_slope: slope on last_day, which becomes today's prior_slope
+
+    def __init__(self, symbols, last_day, open_num, open_den, close_num, close_den,
+                 open_tail, last_slope, span=EMA_SPAN, window=SLOPE_WINDOW):
+        self.symbols = np.asarray(symbols, dtype='str')
+        self.last_day = np.asarray(last_day, dtype='int64')
+        self.open_num = np.asarray(open_num, dtype='float64')
+        self.open_den = np.asarray(open_den, dtype='float64')
+        self.close_num = np.asarray(close_num, dtype='float64')
+        self.close_den = np.asarray(close_den, dtype='float64')
+        self.open_tail = np.asarray(open_tail, dtype='float64').reshape(len(self.symbols), window - 1)
+        self.last_slope = np.asarray(last_slope, dtype='float64')
+        self.span = span
+        self.window = window
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def index_of(self, symbols):
+        # Row of each symbol in the state, -1 when we have no state for it
+        return pd.Index(self.symbols).get_indexer(np.asarray(symbols))
+
+    def take(self, rows):
+        return EmaState(self.symbols[rows], self.last_day[rows], 
+                        self.open_num[rows], self.open_den[rows], 
+                        self.close_num[rows], self.close_den[rows], 
+                        self.open_tail[rows], self.last_slope[rows], 
+                        span=self.span, window=self.window)
+
+    @staticmethod
+    def concat(states, span=EMA_SPAN, window=SLOPE_WINDOW):
+        states = [s for s in states if s is not None and len(s) > 0]
+        if len(states) == 0:
+            return empty_ema_state(span, window)
+        return EmaState(np.concatenate([s.symbols for s in states]),
+                        np.concatenate([s.last_day for s in states]),
+                        np.concatenate([s.open_num for s in states]),
+                        np.concatenate([s.open_den for s in states]),
+                        np.concatenate([s.close_num for s in states]),
+                        np.concatenate([s.close_den for s in states]),
+                        np.concatenate([s.open_tail for s in states]),
+                        np.concatenate([s.last_slope for s in states]),
+                        span=span, window=window)
+
+    def save(self, path):
+        tmpPath = path + '.tmp.npz'
+        np.savez(tmpPath, symbols=self.symbols, last_day=self.last_day, 
+                 open_num=self.open_num, open_den=self.open_den, 
+                 close_num=self.close_num, close_den=self.close_den, 
+                 open_tail=self.open_tail, last_slope=self.last_slope, 
+                 span=self.span, window=self.window)
+        os.replace(tmpPath, path)
+
+    @staticmethod
+    def load(path, span=EMA_SPAN, window=SLOPE_WINDOW):
+        # None when there's no usable state, including one saved with other parameters
+        try:
+            with np.load(path) as f:
+                if int(f['span']) != span or int(f['window']) != window:
+                    print('Saved EMA state has different parameters, ignoring it')
+                    return None
+                return EmaState(f['symbols'], f['last_day'], f['open_num'], f['open_den'],
+                                f['close_num'], f['close_den'], f['open_tail'], f['last_slope'],
+                                span=span, window=window)
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+def empty_ema_state(span=EMA_SPAN, window=SLOPE_WINDOW):
+    return EmaState([], [], [], [], [], [], np.empty((0, window - 1)), [], span=span, window=window)
+
+
+def build_ema_state(history, span=EMA_SPAN, window=SLOPE_WINDOW):
+    # Full rebuild from the candle history (open, close, datetime, symbol)
+    if len(history) == 0:
+        return empty_ema_state(span, window)
+    days = to_day_numbers(history['datetime'])
+    (uniqueSymbols, order, rowIdx, colIdx, width) = align_by_symbol(history['symbol'].values, days)
+    nSymbols = len(uniqueSymbols)
+
+    openM = to_matrix(history['open'].values, order, rowIdx, colIdx, nSymbols, width)
+    closeM = to_matrix(history['close'].values, order, rowIdx, colIdx, nSymbols, width)
+    dayM = to_matrix(days, order, rowIdx, colIdx, nSymbols, width)
+
+    (emaOpen, openNum, openDen) = ema_matrix(openM, span)
+    (emaClose, closeNum, closeDen) = ema_matrix(closeM, span)
+    padded = np.concatenate([np.full((nSymbols, window - 1), np.nan), emaOpen], axis=1)
+    slope = slope_matrix(emaOpen, window)
+
+    return EmaState(uniqueSymbols, dayM[:, -1], openNum, openDen, closeNum, closeDen,
+                    padded[:, padded.shape[1] - (window - 1):], slope[:, -1], span=span, window=window)
+
+
+def advance_ema_state(state, history):
+    # Roll symbols forward through the bars they haven't seen yet, starting
+    # from the saved sums instead of the start of the history. Only valid for
+    # symbols whose last_day is still in the history, see sync_ema_state.
+    window = state.window
+    days = to_day_numbers(history['datetime'])
+    rows = state.index_of(history['symbol'].values)
+    newBars = days > state.last_day[rows]
+    if not newBars.any():
+        return state
+
+    history = history[newBars]
+    days = days[newBars]
+    rows = rows[newBars]
+    (stateRows, order, rowIdx, colIdx, width) = align_by_symbol(rows, days)
+    nSymbols = len(stateRows)
+    moving = state.take(stateRows)
+
+    openM = to_matrix(history['open'].values, order, rowIdx, colIdx, nSymbols, width)
+    closeM = to_matrix(history['close'].values, order, rowIdx, colIdx, nSymbols, width)
+    dayM = to_matrix(days, order, rowIdx, colIdx, nSymbols, width)
+    present = np.zeros((nSymbols, width), dtype='bool')
+    present[rowIdx, colIdx] = True
+    (emaOpen, openNum, openDen) = ema_matrix(openM, state.span, moving.open_num, moving.open_den, present)
+    (emaClose, closeNum, closeDen) = ema_matrix(closeM, state.span, moving.close_num, moving.close_den, present)
+
+    # Put each symbol's saved tail immediately before its first new bar so the
+    # slope window runs across the boundary
+    nNew = np.bincount(rowIdx, minlength=nSymbols)
+    combined = np.full((nSymbols, window - 1 + width), np.nan)
+    tailCols = (width - nNew)[:, None] + np.arange(window - 1)
+    combined[np.arange(nSymbols)[:, None], tailCols] = moving.open_tail
+    combined[rowIdx, colIdx + window - 1] = emaOpen[rowIdx, colIdx]
+    slope = slope_matrix(combined, window)
+
+    moving = EmaState(moving.symbols, dayM[:, -1], openNum, openDen, closeNum, closeDen,
+                      combined[:, combined.shape[1] - (window - 1):], slope[:, -1],
+                      span=state.span, window=window)
+    untouched = np.setdiff1d(np.arange(len(state)), stateRows)
+    return EmaState.concat([state.take(untouched), moving], span=state.span, window=window)
+
+
+def sync_ema_state(state, history, span=EMA_SPAN, window=SLOPE_WINDOW, rebuild=None):
+    # Bring the state up to the end of the history for every symbol in it.
+    # Symbols with usable state are stepped forward through their new bars.
+    # Symbols that are new, or whose last_day is no longer in the history
+    # (gaps, a repaired cache, a state from another run), are rebuilt from
+    # their full candle history, as are the symbols in `rebuild` (e.g. prices
+    # adjusted for a split since the state was saved). State for symbols
+    # missing from the history is carried over untouched.
+    if state is None:
+        print('No saved EMA state, rebuilding from history')
+        return build_ema_state(history, span, window)
+
+    symbols = np.asarray(history['symbol'].values)
+    days = to_day_numbers(history['datetime'])
+    rows = state.index_of(symbols)
+    known = rows >= 0
+    anchored = np.zeros(len(state), dtype='bool')
+    anchored[rows[known][days[known] == state.last_day[rows[known]]]] = True
+    lastSeen = pd.Series(days).groupby(symbols).max()
+    stateEnd = pd.Series(state.last_day, index=state.symbols)
+    ahead = stateEnd.reindex(lastSeen.index) > lastSeen
+
+    # pandas isin hashes, np.isin on object / str arrays is quadratic-ish
+    usable = anchored & ~pd.Index(state.symbols).isin(lastSeen.index[ahead.values])
+    if rebuild is not None and len(rebuild) > 0:
+        usable &= ~pd.Index(state.symbols).isin(list(rebuild))
+    keep = pd.Index(symbols).isin(state.symbols[usable])
+    rebuild = ~keep
+    if rebuild.any():
+        print('Rebuilding EMA state for {} symbols'.format(len(np.unique(symbols[rebuild]))))
+
+    inHistory = pd.Index(state.symbols).isin(symbols)
+    advanced = advance_ema_state(state.take(np.flatnonzero(usable & inHistory)), history[keep])
+    rebuilt = build_ema_state(history[rebuild], span, window)
+    carried = state.take(np.flatnonzero(~inHistory))
+    return EmaState.concat([advanced, rebuilt, carried], span=span, window=window)
+
+
+def step_ema_state(state, todays, last_day=None):
+    # One recurrence step per symbol for today's open/close quotes. Returns
+    # todays rows with the same metric columns as calc_trade_metrics. Symbols
+    # without state start from empty sums, so their slope is NaN and they are
+    # never traded, the same as a symbol with a single bar of history.
+    # last_day: the day the state should be at (yesterday's bar). State that
+    # stops earlier is missing bars and is treated as no state at all.
+    window = state.window
+    decay = 1 - 2.0/(state.span + 1)
+    todays = todays.reset_index(drop=True).copy()
+    rows = state.index_of(todays['symbol'].values)
+    known = rows >= 0
+    if last_day is not None and len(state) > 0:
+        known &= state.last_day[np.where(known, rows, 0)] == last_day
+    rows = np.where(known, rows, 0)
+
+    def saved(values):
+        if len(state) == 0:
+            return np.zeros(len(todays))
+        return np.where(known, values[rows], 0.0)
+
+    def step(x, num, den):
+        valid = ~np.isnan(x)
+        num = decay*num + np.where(valid, x, 0.0)
+        den = decay*den + valid
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return num/den
+
+    emaOpen = step(todays['open'].values.astype('float64'), saved(state.open_num), saved(state.open_den))
+    emaClose = step(todays['close'].values.astype('float64'), saved(state.close_num), saved(state.close_den))
+
+    weights = slope_weights(window)
+    slope = weights[-1]*emaOpen
+    for k in range(window - 1):
+        slope = slope + weights[k]*np.where(known, saved(state.open_tail[:, k]), np.nan)
+
+    todays['datetime'] = pd.to_datetime(todays['datetime'])
+    todays['EMA_Close'] = emaClose
+    todays['EMA_Open'] = emaOpen
+    todays['slope'] = slope
+    todays['prior_slope'] = np.where(known, saved(state.last_slope), np.nan)
+    todays['prior_slope_sign'] = np.sign(todays['prior_slope'])
+    return todays.sort_values(by='symbol', ascending=False).reset_index(drop=True)
+
+
+
+#########################
+#   Parity reference    #
+#########################
+
+def reference_trade_metrics(stock_data, dayWindow=SLOPE_WINDOW):
+    # The original pandas + scipy implementation, kept only to check the
+    # vectorized engine against. Far too slow for the 9:30 path.
+    from scipy.stats import linregress
+
+    def get_slope(array):
+        y = np.array(array)
+        x = np.arange(len(y))
+        slope, intercept, r_value, p_value, std_err = linregress(x,y)
+        return slope
+
+    stock_data = stock_data.sort_values(by=['symbol', 'datetime'], ascending=True).reset_index(drop=True)
+    stock_data['EMA_Close'] = stock_data.groupby('symbol')['close'].apply(lambda x: x.ewm(span=EMA_SPAN).mean())
+    stock_data['EMA_Open'] = stock_data.groupby('symbol')['open'].apply(lambda x: x.ewm(span=EMA_SPAN).mean())
+    stock_data = stock_data.sort_values(by=['symbol', 'datetime'], ascending=False).reset_index(drop=True)
+    stock_data['slope'] = stock_data.sort_values(by=['symbol', 'datetime'], ascending=True
+                                       ).groupby('symbol')['EMA_Open'
+                                       ].rolling(window=dayWindow
+                                       ).apply(get_slope, raw=False
+                                       ).reset_index(0, drop=True)
+    stock_data['prior_slope'] = stock_data.groupby('symbol')['slope'].apply(lambda x: x.shift(-1))
+    stock_data['prior_slope_sign'] = np.sign(stock_data['prior_slope'])
+    return stock_data
+
+
+def check_parity(stock_data, dayWindow=SLOPE_WINDOW, rtol=1e-9, atol=1e-9):
+    # Runs both implementations on the same candles and reports the largest
+    # difference per metric column. Returns True when every column matches.
+    fast = calc_trade_metrics(stock_data, dayWindow=dayWindow)
+    slow = reference_trade_metrics(stock_data, dayWindow=dayWindow)
+    key = ['symbol', 'datetime']
+    fast = fast.sort_values(by=key).reset_index(drop=True)
+    slow = slow.sort_values(by=key).reset_index(drop=True)
+
+    matches = fast[key].equals(slow[key])
+    for col in ['EMA_Close', 'EMA_Open', 'slope', 'prior_slope', 'prior_slope_sign']:
+        a = fast[col].values.astype('float64')
+        b = slow[col].values.astype('float64')
+        same = np.allclose(a, b, rtol=rtol, atol=atol, equal_nan=True)
+        diff = np.nanmax(np.abs(a - b)) if np.isfinite(a - b).any() else 0.0
+        print('{}: max abs diff {}{}'.format(col, diff, '' if same else '  MISMATCH'))
+        matches = matches and same
+    return matches
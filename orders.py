@@ -0,0 +1,263 @@
+import asyncio
+import datetime
+import random
+import time
+
+import aiohttp
+
+import config
+import ratelimit
+import tokens
+import tracing
+
+
+TD_ORDER_CONCURRENCY = 10      # orders in flight at once
+TD_ORDER_RETRIES = 3           # extra attempts for transient failures
+TD_RETRY_BASE = 0.25           # seconds, backoff doubles each attempt
+TD_RETRY_CAP = 4.0
+
+TD_ORDER_LOOKUP_SKEW = 2.0     # seconds of clock difference allowed when matching enteredTime
+TD_ORDER_LOOKUPS = 3           # attempts at reading the account's orders before giving up on a resend
+
+# Market orders aren't idempotent. Only a 429 or a 401 certainly left nothing
+# on the book, those are sent again as is. A timeout, a dropped connection or
+# one of these may have placed the order anyway, so the account's orders are
+# checked first and the order is only sent again if nothing matches.
+UNCERTAIN_STATUSES = {408, 500, 502, 503, 504}
+# Token expired under us, tokens.TOKENS gets a new one before the retry
+UNAUTHORIZED = 401
+# Orders in these states never reached (or left) the book, they don't count as placed
+TD_DEAD_ORDER_STATUSES = {'REJECTED', 'CANCELED', 'EXPIRED'}
+
+
+
+########################
+### Order payloads  ####
+########################
+
+def get_orders_url():
+    return '{}/accounts/{}/orders'.format(config.TD_API_URL, config.TD_MARGIN_ACCOUNT)
+
+
+def build_order(ticker, trade_action, quantity=30):
+    return {"orderType": "MARKET",
+            "session": "NORMAL",
+            "duration": "DAY",
+            "orderStrategyType": "SINGLE",
+            "orderLegCollection": [{
+                  "instruction": trade_action,
+                  "quantity": quantity,
+                  "instrument": {
+                    "symbol": ticker,
+                    "assetType": "EQUITY"
+                  }
+            }]
+           }
+
+
+async def do_post(session, url, ticker, trade_action, token, order=None, timings=None, with_retry_after=False):
+    # Returns the HTTP status, 201 means TDA accepted the order.
+    # with_retry_after: return (status, Retry-After header) for the rate limiter
+    if order is None:
+        order = build_order(ticker, trade_action)
+    if timings is not None:
+        timings.setdefault('first_order_sent', time.time())
+    headers = await tokens.auth_header_async(token)
+    async with session.post(url,
+                            json=order,
+                            headers= headers
+                           ) as response:
+        if response.status == UNAUTHORIZED:
+            tracing.count('unauthorized')
+            tokens.TOKENS.invalidate(headers['Authorization'][len('Bearer '):])
+        if response.status != 201:
+            print("Failed to make trade for {}, had code: {}".format(ticker, response.status))
+        if with_retry_after:
+            return (response.status, response.headers.get('Retry-After'))
+        return response.status
+
+
+
+def _entered_at(order):
+    # enteredTime as epoch seconds, e.g. '2021-03-01T14:30:01+0000'
+    try:
+        return datetime.datetime.strptime(order['enteredTime'], '%Y-%m-%dT%H:%M:%S%z').timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def placed_order_in(accountOrders, ticker, trade_action, quantity, since):
+    # Is there a live or filled order for ticker / trade_action / quantity
+    # entered at or after `since` (epoch seconds)?
+    for order in accountOrders:
+        if order.get('status') in TD_DEAD_ORDER_STATUSES:
+            continue
+        entered = _entered_at(order)
+        if entered is None or entered < since - TD_ORDER_LOOKUP_SKEW:
+            continue
+        for leg in order.get('orderLegCollection', []):
+            if (leg.get('instrument', {}).get('symbol') == ticker and leg.get('instruction') == trade_action
+                    and float(leg.get('quantity', 0)) == float(quantity)):
+                return True
+    return False
+
+
+async def find_placed_order(session, token, ticker, trade_action, quantity, since, quota=None):
+    # True / False, or None when the account's orders couldn't be read
+    quota = quota or ratelimit.MARKET_DATA
+    day = datetime.datetime.utcfromtimestamp(since).strftime('%Y-%m-%d')
+    url = '{}/orders?accountId={}&fromEnteredTime={}&toEnteredTime={}'.format(
+        config.TD_API_URL, config.TD_MARGIN_ACCOUNT, day, datetime.datetime.utcnow().strftime('%Y-%m-%d'))
+    await quota.acquire_async()
+    try:
+        async with session.get(url, headers=await tokens.auth_header_async(token)) as response:
+            quota.observe(response.status, response.headers.get('Retry-After'))
+            if response.status != 200:
+                return None
+            accountOrders = await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        return None
+    return placed_order_in(accountOrders or [], ticker, trade_action, quantity, since)
+
+
+
+##########################
+### Submission engine ####
+##########################
+
+def backoff_delay(attempt, base=TD_RETRY_BASE, cap=TD_RETRY_CAP):
+    # Full jitter so a burst of 429s doesn't come back as another burst
+    return random.uniform(0, min(cap, base * 2**(attempt - 1)))
+
+
+class OrderSubmitter:
+    # Sends orders over one session with a cap on in-flight orders and a
+    # per-minute order budget. 429s and a first 401 are sent again as is,
+    # failures that may have reached the book are resent, after a jittered
+    # backoff, only if the account shows no such order. Buys don't start until every sell scheduled before them has
+    # finished, since buying power depends on the sells.
+    #
+    # Each order produces a result dict:
+    #   symbol, action, status (last HTTP status or None), ok, attempts,
+    #   latency (seconds from the first attempt to the final response), error,
+    #   found (the order was on the account after an uncertain failure)
+
+    def __init__(self, session, token, url=None, orders=None, timings=None,
+                 concurrency=TD_ORDER_CONCURRENCY, orders_per_minute=None,
+                 retries=TD_ORDER_RETRIES, quota=None):
+        self.session = session
+        self.token = token
+        self.url = url or get_orders_url()
+        self.orders = orders or {}
+        self.timings = timings
+        self.retries = retries
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # The process wide order budget unless told otherwise
+        if quota is None and orders_per_minute is not None:
+            quota = ratelimit.TokenBucket('orders', orders_per_minute)
+        self.quota = quota or ratelimit.ORDERS
+        self._sellTasks = []
+        self._buyTasks = []
+
+    def sell(self, tickers, quantities=None):
+        # quantities: {symbol: shares} for orders that aren't the prebuilt size
+        self._set_quantities('SELL', quantities)
+        for ticker in tickers:
+            self._sellTasks.append(asyncio.ensure_future(self._submit(ticker, 'SELL')))
+
+    def buy(self, tickers, quantities=None):
+        self._set_quantities('BUY', quantities)
+        pendingSells = list(self._sellTasks)
+        for ticker in tickers:
+            self._buyTasks.append(asyncio.ensure_future(self._submit(ticker, 'BUY', after=pendingSells)))
+
+    def _set_quantities(self, trade_action, quantities):
+        for ticker, quantity in (quantities or {}).items():
+            order = self.orders.get((ticker, trade_action))
+            if order is None or order['orderLegCollection'][0]['quantity'] != quantity:
+                self.orders[(ticker, trade_action)] = build_order(ticker, trade_action, quantity)
+
+    async def results(self):
+        return list(await asyncio.gather(*(self._sellTasks + self._buyTasks)))
+
+    async def _submit(self, ticker, trade_action, after=()):
+        if len(after) > 0:
+            await asyncio.gather(*after)
+
+        start = time.monotonic()
+        order = self.orders.get((ticker, trade_action))
+        quantity = order['orderLegCollection'][0]['quantity'] if order is not None else 30
+        firstSent = None
+        attempts = 0
+        status = None
+        error = None
+        found = False
+        while True:
+            attempts += 1
+            async with self.semaphore:
+                await self.quota.acquire_async()
+                if firstSent is None:
+                    firstSent = time.time()
+                try:
+                    (status, retryAfter) = await do_post(self.session, self.url, ticker, trade_action, self.token,
+                                                         order=order, timings=self.timings, with_retry_after=True)
+                    self.quota.observe(status, retryAfter)
+                    error = None
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status = None
+                    error = repr(e)
+
+            if status == 201:
+                break
+            if status == UNAUTHORIZED and attempts == 1:
+                continue
+            if attempts > self.retries:
+                break
+            if status == ratelimit.THROTTLED:
+                # Not placed, and the order bucket already holds everyone until Retry-After
+                tracing.count('order_retries')
+                continue
+            if status is not None and status not in UNCERTAIN_STATUSES:
+                break
+
+            # Might be on the book already: give TDA a moment, then look before resending
+            await asyncio.sleep(backoff_delay(attempts))
+            for lookup in range(TD_ORDER_LOOKUPS):
+                placed = await find_placed_order(self.session, self.token, ticker, trade_action, quantity, firstSent)
+                if placed is not None:
+                    break
+                await asyncio.sleep(backoff_delay(lookup + 1))
+            if placed is None:
+                error = 'not resent, could not check the account after {}'.format(error or status)
+                tracing.count('order_unconfirmed')
+                break
+            if placed:
+                found = True
+                tracing.count('orders_found_after_failure')
+                break
+            tracing.count('order_retries')
+
+        tracing.count('orders_sent')
+        ok = status == 201 or found
+        if not ok:
+            tracing.count('order_failures')
+        return {'symbol': ticker,
+                'action': trade_action,
+                'status': status,
+                'ok': ok,
+                'attempts': attempts,
+                'latency': time.monotonic() - start,
+                'error': None if found else error,
+                'found': found}
+
+
+def print_failures(results):
+    failures = [r for r in results if not r['ok']]
+    for r in failures:
+        print('Failed to {}: {}, had code: {}, after {} attempts {}'.format(
+            r['action'], r['symbol'], r['status'], r['attempts'], r['error'] or ''))
+    if len(results) > 0:
+        latencies = sorted(r['latency'] for r in results)
+        print('Orders sent: {}, failed: {}, median latency: {}s, max latency: {}s'.format(
+            len(results), len(failures), round(latencies[len(latencies)//2], 3), round(latencies[-1], 3)))
+    return failures
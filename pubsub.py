@@ -0,0 +1,94 @@
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import config
+
+
+# Publishing the bot's own Pub/Sub messages, e.g. the Trading fan-out sending
+# one 'Trading Shard' message per shard:
+#
+#   pubsub.get_publisher().publish('Trading Shard', {'run': run, 'shard': '3'})
+#
+# In the cloud that's a message on config.PUBSUB_TOPIC, which triggers another
+# instance of the function. use_local() swaps in LocalPubSub, which hands the
+# same event to main.main on a thread pool, so a whole fan-out / fan-in can
+# run in one process.
+
+_publisher = None
+
+
+
+class CloudPubSub:
+
+    def __init__(self, topic=None):
+        from google.cloud import pubsub_v1
+
+        self.topic = topic or config.PUBSUB_TOPIC
+        self.client = pubsub_v1.PublisherClient()
+        self.futures = []
+
+    def publish(self, message, attributes=None):
+        attributes = {k: str(v) for k, v in (attributes or {}).items()}
+        future = self.client.publish(self.topic, message.encode('utf-8'), **attributes)
+        self.futures.append(future)
+        return future
+
+    def drain(self, timeout=None):
+        # Blocks until every message published so far is accepted by Pub/Sub
+        for future in self.futures:
+            future.result(timeout=timeout)
+        self.futures = []
+
+
+class LocalPubSub:
+    # Delivers each message as a Cloud Functions style event on its own
+    # thread, up to max_workers at a time, like that many function instances
+
+    def __init__(self, deliver=None, max_workers=8):
+        self.deliver = deliver
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pubsub')
+        self.futures = []
+        self.delivered = []
+        self._lock = threading.Lock()
+
+    def publish(self, message, attributes=None):
+        event = {'data': base64.b64encode(message.encode('utf-8')),
+                 'attributes': {k: str(v) for k, v in (attributes or {}).items()}}
+        future = self.executor.submit(self._deliver, event)
+        with self._lock:
+            self.futures.append(future)
+        return future
+
+    def _deliver(self, event):
+        deliver = self.deliver
+        if deliver is None:
+            import main
+            deliver = main.main
+        try:
+            return deliver(event, None)
+        finally:
+            with self._lock:
+                self.delivered.append(event)
+
+    def drain(self, timeout=None):
+        # Waits for every message published so far to be handled, re-raising the first failure
+        with self._lock:
+            futures = list(self.futures)
+        (done, notDone) = wait(futures, timeout=timeout)
+        for future in done:
+            future.result()
+        return len(notDone) == 0
+
+
+def use_local(deliver=None, max_workers=8):
+    global _publisher
+    _publisher = LocalPubSub(deliver=deliver, max_workers=max_workers)
+    return _publisher
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        _publisher = CloudPubSub()
+    return _publisher
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+
+import tracing
+
+
+# TDA allows 120 requests per rolling minute, keep a little headroom
+TD_REQUESTS_PER_MINUTE = 110
+TD_ORDERS_PER_MINUTE = 110      # order placement has its own per-account budget
+TD_BURST = 10                   # requests that may go out back to back before pacing kicks in
+TD_THROTTLE_RETRIES = 3         # extra attempts after a 429 for the request helpers
+TD_THROTTLE_BACKOFF = 2.0       # seconds to pause everyone after a 429 without Retry-After
+TD_RECOVERY = 0.02              # fraction of the full rate won back per successful call
+
+THROTTLED = 429
+
+
+# One token bucket per budget, shared by every request helper in the process,
+# sync (acquire) and async (acquire_async) alike:
+#
+#   ratelimit.MARKET_DATA   quotes, price history, accounts, transactions
+#   ratelimit.ORDERS        order placement
+#
+# A bucket lets `burst` calls through at once and then one every 1/rate
+# seconds, with the rate picked so no rolling `period` ever sees more than
+# `per_minute` calls. Waits are reserved under a lock and slept outside it,
+# so callers queue in order without holding anything.
+#
+# After each response the caller reports the status with observe(). A 429
+# halves the rate and holds every caller until Retry-After (or
+# TD_THROTTLE_BACKOFF) has passed, successes win the rate back gradually.
+# Time spent waiting and throttles are counted per bucket, in stats() and in
+# the current trace.
+#
+# A bucket for one request a minute has no burst at all, every call is paced.
+# `clock` is only there for tests.
+
+class TokenBucket:
+
+    def __init__(self, name, per_minute, burst=TD_BURST, period=60.0, clock=time.monotonic):
+        if per_minute < 1:
+            raise ValueError('A {} bucket needs at least one call per minute, not {}'.format(name, per_minute))
+        self.name = name
+        self.per_minute = per_minute
+        # At least one of the per_minute calls is paced, so the rate is never 0
+        self.burst = max(0, min(burst, per_minute - 1))
+        self.period = period
+        self.full_rate = (per_minute - self.burst) / period
+        self.clock = clock
+        self.rate = self.full_rate
+        self._tat = 0.0                # theoretical arrival time of the next call at the current rate
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.throttled = 0
+
+    def _reserve(self):
+        # Seconds the caller has to wait before its call may start
+        with self._lock:
+            now = self.clock()
+            interval = 1.0 / self.rate
+            start = max(now, self._tat - self.burst*interval, self._blocked_until)
+            self._tat = max(self._tat, start) + interval
+            wait = start - now
+            self.calls += 1
+            if wait > 0:
+                self.waits += 1
+                self.wait_seconds += wait
+        if wait > 0:
+            tracing.count(self.name + '_waits')
+            tracing.count(self.name + '_wait_seconds', round(wait, 6))
+        return wait
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def observe(self, status, retry_after=None):
+        # Feed back the status of a response that went through this bucket
+        with self._lock:
+            if status == THROTTLED:
+                self.throttled += 1
+                self.rate = max(self.full_rate / 16, self.rate / 2)
+                pause = _parse_retry_after(retry_after)
+                self._blocked_until = max(self._blocked_until,
+                                          self.clock() + (pause if pause is not None else TD_THROTTLE_BACKOFF))
+            elif status is not None and status < 400 and self.rate < self.full_rate:
+                self.rate = min(self.full_rate, self.rate + self.full_rate*TD_RECOVERY)
+        if status == THROTTLED:
+            tracing.count(self.name + '_throttled')
+
+    def stats(self):
+        return {'calls': self.calls, 'waits': self.waits, 'wait_seconds': round(self.wait_seconds, 6),
+                'throttled': self.throttled, 'rate_per_minute': round(self.rate*self.period + self.burst, 2)}
+
+
+def _parse_retry_after(value):
+    # Retry-After is either seconds or an HTTP date, only the seconds form is worth honouring here
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+MARKET_DATA = TokenBucket('market_data', TD_REQUESTS_PER_MINUTE)
+ORDERS = TokenBucket('orders', TD_ORDERS_PER_MINUTE)
+
+
+def configure(requests_per_minute=None, orders_per_minute=None):
+    # Fresh buckets, e.g. to match a simulator's limits
+    global MARKET_DATA, ORDERS
+    MARKET_DATA = TokenBucket('market_data', requests_per_minute or TD_REQUESTS_PER_MINUTE)
+    ORDERS = TokenBucket('orders', orders_per_minute or TD_ORDERS_PER_MINUTE)
+
+
+_session = None
+
+
+def session():
+    # One requests.Session per process, so back to back calls (and every run
+    # of a resident process) reuse the open connection to TDA
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
+
+
+def send(bucket, method, url, retries=TD_THROTTLE_RETRIES, **kwargs):
+    # A request through `bucket` on the shared session, retried while TDA says 429
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        r = session().request(method, url, hooks=tracing.REQUESTS_HOOKS, **kwargs)
+        bucket.observe(r.status_code, r.headers.get('Retry-After'))
+        if r.status_code != THROTTLED:
+            break
+    return r
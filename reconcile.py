@@ -0,0 +1,156 @@
+import math
+
+
+# Turns the strategy's buy / sell symbols into exact order quantities against
+# one snapshot of the account (positions with quantities, open orders and
+# buying power), fetched in a single call by utils.get_account_snapshot.
+#
+#   snapshot = utils.get_account_snapshot(token)
+#   reconciler = reconcile.Reconciler(snapshot, quantity=30)
+#   (buyOrders, sellOrders) = reconciler.orders(buys, sells, prices)   # {symbol: shares}
+#   exitOrders = reconciler.exit_orders(universe.dropped_members(snapshot.symbols()))
+#   utils.cancel_orders(token, reconciler.open_buys(exitOrders))      # nothing bought back in
+#
+# Buys aim at `quantity` net of shares held, open and sent. Sells only count
+# settled shares (held, less open and sent sells): an open BUY isn't shares
+# we can sell yet, so exits and Kill cancel those instead.
+#
+# Every symbol is a dict lookup, so a universe of thousands of names costs the
+# same per symbol as a handful. The reconciler keeps what it has already sent,
+# so calling orders() once per batch of opening prices never orders a symbol twice.
+
+# TDA order statuses that will not fill any more shares
+TD_CLOSED_ORDER_STATUSES = {'FILLED', 'CANCELED', 'REJECTED', 'EXPIRED', 'REPLACED'}
+
+
+
+class AccountSnapshot:
+    #   positions       {symbol: long shares}
+    #   open_orders     {(symbol, 'BUY' / 'SELL'): shares still to fill}
+    #   open_order_ids  {(symbol, 'BUY' / 'SELL'): [orderId, ...]} of those orders
+    #   buying_power    dollars, None when the account doesn't report it
+
+    def __init__(self, positions=None, open_orders=None, buying_power=None, open_order_ids=None):
+        self.positions = positions or {}
+        self.open_orders = open_orders or {}
+        self.open_order_ids = open_order_ids or {}
+        self.buying_power = buying_power
+
+    @classmethod
+    def from_account(cls, accountInfo):
+        # accountInfo: GET /accounts/{id}?fields=positions,orders
+        account = accountInfo.get('securitiesAccount', {})
+        positions = {}
+        for p in account.get('positions', []):
+            if p.get('longQuantity', 0) > 0:
+                symbol = p['instrument']['symbol']
+                positions[symbol] = positions.get(symbol, 0) + p['longQuantity']
+
+        openOrders = {}
+        openOrderIds = {}
+        for order in _walk_open_orders(account.get('orderStrategies', [])):
+            legs = order.get('orderLegCollection', [])
+            remaining = order.get('remainingQuantity')
+            for leg in legs:
+                instruction = leg.get('instruction', '')
+                action = 'BUY' if instruction.startswith('BUY') else 'SELL' if instruction.startswith('SELL') else None
+                if action is None:
+                    continue
+                shares = remaining if remaining is not None and len(legs) == 1 else leg.get('quantity', 0)
+                key = (leg['instrument']['symbol'], action)
+                openOrders[key] = openOrders.get(key, 0) + shares
+                if order.get('orderId') is not None and order['orderId'] not in openOrderIds.get(key, []):
+                    openOrderIds.setdefault(key, []).append(order['orderId'])
+
+        balances = account.get('currentBalances', {})
+        buyingPower = balances.get('buyingPower', balances.get('cashAvailableForTrading'))
+        return cls(positions, openOrders, buyingPower, openOrderIds)
+
+    def symbols(self):
+        return list(self.positions)
+
+    def held(self, symbol):
+        return self.positions.get(symbol, 0)
+
+    def pending(self, symbol, action):
+        return self.open_orders.get((symbol, action), 0)
+
+    def pending_ids(self, symbol, action):
+        return self.open_order_ids.get((symbol, action), [])
+
+
+def _walk_open_orders(orderStrategies):
+    for order in orderStrategies:
+        if order.get('status') not in TD_CLOSED_ORDER_STATUSES:
+            yield order
+        for child in _walk_open_orders(order.get('childOrderStrategies', [])):
+            yield child
+
+
+
+class Reconciler:
+
+    def __init__(self, snapshot, quantity=30):
+        self.snapshot = snapshot
+        self.quantity = quantity
+        self.budget = snapshot.buying_power
+        self.sent = {}                 # (symbol, action) -> shares ordered through this reconciler
+        self.skipped = []              # buys left out for lack of buying power
+
+    def _position(self, symbol):
+        # Shares we will hold once everything open or already sent has filled
+        s = self.snapshot
+        return (s.held(symbol) + s.pending(symbol, 'BUY') + self.sent.get((symbol, 'BUY'), 0)
+                - s.pending(symbol, 'SELL') - self.sent.get((symbol, 'SELL'), 0))
+
+    def _sellable(self, symbol):
+        # Settled shares not already on their way out. Open buys don't count,
+        # selling them before they fill would go short.
+        s = self.snapshot
+        return s.held(symbol) - s.pending(symbol, 'SELL') - self.sent.get((symbol, 'SELL'), 0)
+
+    def _send(self, orders, symbol, action, shares):
+        shares = int(shares)      # no fractional shares through the API
+        if shares > 0:
+            orders[symbol] = shares
+            self.sent[(symbol, action)] = self.sent.get((symbol, action), 0) + shares
+
+    def sell_orders(self, symbols):
+        # Target 0 shares: sell whatever is held and not already being sold
+        orders = {}
+        for symbol in symbols:
+            self._send(orders, symbol, 'SELL', self._sellable(symbol))
+        return orders
+
+    def buy_orders(self, symbols, prices=None):
+        # Target `quantity` shares: buy the difference. With prices (e.g. the
+        # opens) and a known buying power, buys that no longer fit are skipped.
+        orders = {}
+        for symbol in symbols:
+            shares = self.quantity - self._position(symbol)
+            if shares <= 0:
+                continue
+            price = prices.get(symbol) if prices is not None else None
+            if self.budget is not None and price is not None and not math.isnan(price):
+                cost = shares * price
+                if cost > self.budget:
+                    self.skipped.append(symbol)
+                    continue
+                self.budget -= cost
+            self._send(orders, symbol, 'BUY', shares)
+        return orders
+
+    def orders(self, buys, sells, prices=None):
+        # Returns ({symbol: shares to buy}, {symbol: shares to sell})
+        sellOrders = self.sell_orders(sells)
+        buyOrders = self.buy_orders(buys, prices)
+        return (buyOrders, sellOrders)
+
+    def exit_orders(self, symbols):
+        # Symbols that have left the universe, sold in full. Cancel their
+        # open_buys too, or they fill after the sell.
+        return self.sell_orders(symbols)
+
+    def open_buys(self, symbols):
+        # Order ids of the open BUYs for `symbols`
+        return [orderId for symbol in symbols for orderId in self.snapshot.pending_ids(symbol, 'BUY')]
@@ -0,0 +1,421 @@
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+
+# A stand-in for the parts of the TD Ameritrade API the bot uses, so the
+# Trading / MorningTrades / Kill flows can be timed and tested offline:
+#
+#   POST /v1/oauth2/token
+#   GET  /v1/marketdata/{symbol}/pricehistory
+#   GET  /v1/marketdata/quotes?symbol=A,B,C
+#   GET  /v1/accounts/{accountId}?fields=positions,orders
+#   GET  /v1/orders?accountId=..&fromEnteredTime=..&toEnteredTime=..[&status=FILLED]
+#   POST /v1/accounts/{accountId}/orders
+#   DELETE /v1/accounts/{accountId}/orders/{orderId}
+#
+# Market orders fill straight away. The account can start with positions
+# (--holdings) and with buy orders that never fill on their own
+# (--open-buys), which it reports as WORKING until they're cancelled, so the
+# Kill and exit cancels run end to end:
+#   python simulator.py --run Kill --holdings 20 --open-buys 10
+#
+# Prices are a seeded random walk per symbol, so every run sees the same
+# candles. Latency, the per-minute rate limit (429s) and the error rate (500s)
+# are configurable.
+#
+# Run it on its own:
+#   python simulator.py --port 8080
+#   TDA_API_URL=http://127.0.0.1:8080/v1 ...
+# or run the whole Trading flow against it in one process:
+#   python simulator.py --run Trading
+# ('Trading Fanout' runs its shards on threads through pubsub.LocalPubSub,
+# --shard-size picks how many symbols each one gets)
+
+SIM_ACCOUNT_ID = 123456789
+HISTORY_YEARS = 5
+
+
+class MarketSimulator:
+    # The simulated market and brokerage account. Thread safe, the HTTP
+    # handler threads all share one instance.
+
+    def __init__(self, tickers, seed=0, delayed_open_fraction=0.02, open_delay=1.0,
+                 starting_cash=1000000.0, holdings=None, open_buys=()):
+        self.tickers = list(tickers)
+        self.seed = seed
+        self.delayed_open_fraction = delayed_open_fraction
+        self.open_delay = open_delay
+        self.started = time.time()
+        self.cash = starting_cash
+        self.positions = {}
+        self.orders = []
+        self.next_order_id = 1000000
+        self.lock = threading.Lock()
+
+        today = pd.Timestamp.now(tz='UTC').normalize().tz_localize(None)
+        self.today = today
+        self.days = pd.bdate_range(today - pd.DateOffset(years=HISTORY_YEARS), today)
+        self._paths = {}
+
+        # holdings {symbol: shares}, open_buys: symbols with a 30 share buy left working
+        self.positions.update(holdings or {})
+        for symbol in open_buys:
+            self._record_order(symbol, 'BUY', 30.0, None, status='WORKING')
+
+    def _record_order(self, symbol, instruction, quantity, price, status='FILLED', orderType='MARKET'):
+        # Appends a TDA shaped order, filled at `price` or left open. Returns its orderId.
+        now = pd.Timestamp.now(tz='UTC').strftime('%Y-%m-%dT%H:%M:%S+0000')
+        filled = status == 'FILLED'
+        self.next_order_id += 1
+        order = {
+            'session': 'NORMAL', 'duration': 'DAY', 'orderType': orderType,
+            'complexOrderStrategyType': 'NONE', 'quantity': quantity, 'filledQuantity': quantity if filled else 0.0,
+            'remainingQuantity': 0.0 if filled else quantity, 'requestedDestination': 'AUTO',
+            'destinationLinkName': 'SIM',
+            'orderLegCollection': [{'orderLegType': 'EQUITY', 'legId': 1,
+                                    'instrument': {'assetType': 'EQUITY', 'cusip': '', 'symbol': symbol},
+                                    'instruction': instruction,
+                                    'positionEffect': 'OPENING' if instruction == 'BUY' else 'CLOSING',
+                                    'quantity': quantity}],
+            'orderStrategyType': 'SINGLE', 'orderId': self.next_order_id, 'cancelable': not filled,
+            'editable': False, 'status': status, 'enteredTime': now, 'accountId': SIM_ACCOUNT_ID}
+        if filled:
+            order['closeTime'] = now
+            order['orderActivityCollection'] = [{'activityType': 'EXECUTION', 'executionType': 'FILL',
+                                                 'quantity': quantity, 'orderRemainingQuantity': 0.0,
+                                                 'executionLegs': [{'legId': 1, 'quantity': quantity,
+                                                                    'mismarkedQuantity': 0.0, 'price': price,
+                                                                    'time': now}]}]
+        self.orders.append(order)
+        return self.next_order_id
+
+    def _path(self, symbol):
+        # (open, close) for every business day up to and including today
+        if symbol not in self._paths:
+            rng = np.random.default_rng(zlib.crc32(symbol.encode()) ^ self.seed)
+            start = rng.uniform(20, 400)
+            closes = start * np.exp(np.cumsum(rng.normal(0.0003, 0.018, len(self.days))))
+            opens = np.concatenate([[start], closes[:-1]]) * np.exp(rng.normal(0, 0.006, len(self.days)))
+            self._paths[symbol] = (np.round(opens, 2), np.round(closes, 2))
+        return self._paths[symbol]
+
+    def known(self, symbol):
+        return symbol in self.tickers or len(self.tickers) == 0
+
+    def candles(self, symbol, start_ms, end_ms):
+        opens, closes = self._path(symbol)
+        # TDA stamps daily candles at midnight Central, 05:00 or 06:00 UTC
+        stamps = (self.days.values.astype('datetime64[ms]').astype('int64') + 5*3600*1000)
+        keep = (stamps >= start_ms) & (stamps <= end_ms) & (self.days < self.today)
+        out = []
+        for o, c, s in zip(opens[keep], closes[keep], stamps[keep]):
+            out.append({'open': float(o), 'high': float(max(o, c)), 'low': float(min(o, c)),
+                        'close': float(c), 'volume': 1000000, 'datetime': int(s)})
+        return {'candles': out, 'symbol': symbol, 'empty': len(out) == 0}
+
+    def open_price(self, symbol):
+        opens, closes = self._path(symbol)
+        delayed = (zlib.crc32(symbol.encode()) % 1000) < self.delayed_open_fraction*1000
+        if delayed and time.time() - self.started < self.open_delay:
+            return 0.0
+        return float(opens[-1])
+
+    def quote(self, symbol):
+        opens, closes = self._path(symbol)
+        return {'assetType': 'EQUITY', 'symbol': symbol, 'description': symbol + ' Simulated',
+                'openPrice': self.open_price(symbol), 'lastPrice': float(opens[-1]),
+                'closePrice': float(closes[-2]), 'highPrice': float(opens[-1]), 'lowPrice': float(opens[-1]),
+                'totalVolume': 1000, 'quoteTimeInLong': int(time.time()*1000)}
+
+    def account(self):
+        with self.lock:
+            positions = []
+            marketValue = 0.0
+            for symbol, qty in self.positions.items():
+                price = self._path(symbol)[0][-1]
+                marketValue += qty*price
+                positions.append({'shortQuantity': 0.0, 'averagePrice': float(price), 'longQuantity': float(qty),
+                                  'settledLongQuantity': float(qty), 'settledShortQuantity': 0.0,
+                                  'instrument': {'assetType': 'EQUITY', 'cusip': '', 'symbol': symbol},
+                                  'marketValue': float(qty*price)})
+            return {'securitiesAccount': {
+                        'type': 'MARGIN', 'accountId': str(SIM_ACCOUNT_ID),
+                        'positions': positions,
+                        'orderStrategies': [dict(o) for o in self.orders if o['status'] == 'WORKING'],
+                        'currentBalances': {'cashBalance': self.cash, 'buyingPower': self.cash,
+                                            'liquidationValue': self.cash + marketValue}}}
+
+    def place_order(self, payload):
+        # Market orders fill immediately at todays open. Returns (status, orderId or error)
+        try:
+            legs = payload['orderLegCollection']
+            instruction = legs[0]['instruction']
+            symbol = legs[0]['instrument']['symbol']
+            quantity = float(legs[0]['quantity'])
+        except (KeyError, IndexError, TypeError, ValueError):
+            return (400, 'Malformed order')
+        if not self.known(symbol):
+            return (400, 'Unknown symbol ' + symbol)
+
+        price = float(self._path(symbol)[0][-1])
+        with self.lock:
+            held = self.positions.get(symbol, 0.0)
+            if instruction == 'SELL' and held < quantity:
+                return (400, 'Not enough shares of ' + symbol)
+            self.positions[symbol] = held + quantity if instruction == 'BUY' else held - quantity
+            if self.positions[symbol] == 0:
+                del self.positions[symbol]
+            self.cash += -quantity*price if instruction == 'BUY' else quantity*price
+            orderId = self._record_order(symbol, instruction, quantity, price,
+                                         orderType=payload.get('orderType', 'MARKET'))
+        return (201, orderId)
+
+    def cancel_order(self, orderId):
+        # Returns (status, error or None), like TDA a filled order can't be cancelled
+        with self.lock:
+            for order in self.orders:
+                if order['orderId'] == orderId:
+                    if order['status'] != 'WORKING':
+                        return (400, 'Order {} is {}, not cancelable'.format(orderId, order['status']))
+                    order.update(status='CANCELED', cancelable=False,
+                                 closeTime=pd.Timestamp.now(tz='UTC').strftime('%Y-%m-%dT%H:%M:%S+0000'))
+                    return (200, None)
+        return (404, 'No order {}'.format(orderId))
+
+    def filled_orders(self, start_date, end_date, status=None):
+        # Orders entered between the dates, only those in `status` when given
+        start = pd.Timestamp(start_date).strftime('%Y-%m-%d')
+        end = pd.Timestamp(end_date).strftime('%Y-%m-%d')
+        with self.lock:
+            return [o for o in self.orders if start <= o['enteredTime'][:10] <= end
+                    and (status is None or o['status'] == status)]
+
+
+
+###################
+#  HTTP frontend  #
+###################
+
+class SimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, market, latency=0.05, jitter=0.02, requests_per_minute=120, error_rate=0.0):
+        super().__init__(address, SimulatorHandler)
+        self.market = market
+        self.latency = latency
+        self.jitter = jitter
+        self.requests_per_minute = requests_per_minute
+        self.error_rate = error_rate
+        self.recent = deque()
+        self.counts = {'requests': 0, 'throttled': 0, 'errors': 0}
+        self.throttle_lock = threading.Lock()
+
+    def admit(self):
+        # Returns (status, retry_after) when the request should be rejected
+        with self.throttle_lock:
+            self.counts['requests'] += 1
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] >= 60:
+                self.recent.popleft()
+            if self.requests_per_minute and len(self.recent) >= self.requests_per_minute:
+                self.counts['throttled'] += 1
+                return (429, int(60 - (now - self.recent[0])) + 1)
+            self.recent.append(now)
+            if self.error_rate and random.random() < self.error_rate:
+                self.counts['errors'] += 1
+                return (500, None)
+        return None
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _delay_and_admit(self):
+        server = self.server
+        if server.latency:
+            time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+        rejected = server.admit()
+        if rejected is not None:
+            status, retryAfter = rejected
+            headers = {'Retry-After': str(retryAfter)} if retryAfter else {}
+            self._send(status, {'error': 'Simulated {}'.format(status)}, headers)
+            return False
+        return True
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        if not self._delay_and_admit():
+            return
+        market = self.server.market
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        parts = parsed.path.strip('/').split('/')
+
+        if parts[:2] == ['v1', 'marketdata'] and len(parts) == 4 and parts[3] == 'pricehistory':
+            symbol = parts[2]
+            if not market.known(symbol):
+                return self._send(200, {'candles': [], 'symbol': symbol, 'empty': True})
+            start = int(query.get('startDate', 0))
+            end = int(query.get('endDate', int(time.time()*1000)))
+            return self._send(200, market.candles(symbol, start, end))
+
+        if parts == ['v1', 'marketdata', 'quotes']:
+            symbols = [s for s in query.get('symbol', '').split(',') if s and market.known(s)]
+            return self._send(200, {s: market.quote(s) for s in symbols})
+
+        if parts[:2] == ['v1', 'accounts'] and len(parts) in (2, 3):
+            return self._send(200, market.account())
+
+        if parts == ['v1', 'orders']:
+            return self._send(200, market.filled_orders(query.get('fromEnteredTime', '1970-01-01'),
+                                                        query.get('toEnteredTime', '2100-01-01'),
+                                                        query.get('status')))
+
+        self._send(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if not self._delay_and_admit():
+            return
+        parts = urlparse(self.path).path.strip('/').split('/')
+        body = self._body()
+
+        if parts == ['v1', 'oauth2', 'token']:
+            form = parse_qs(body.decode())
+            token = base64.urlsafe_b64encode(str(time.time()).encode()).decode()
+            out = {'access_token': 'sim-' + token, 'scope': 'PlaceTrades AccountAccess MoveMoney',
+                   'expires_in': 1800, 'token_type': 'Bearer'}
+            if form.get('access_type', [''])[0] == 'offline':
+                out['refresh_token'] = 'sim-refresh-' + token
+                out['refresh_token_expires_in'] = 7776000
+            return self._send(200, out)
+
+        if parts[:2] == ['v1', 'accounts'] and parts[-1] == 'orders':
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                return self._send(400, {'error': 'Invalid JSON'})
+            status, result = self.server.market.place_order(payload)
+            if status != 201:
+                return self._send(status, {'error': result})
+            self.send_response(201)
+            self.send_header('Location', '{}/orders/{}'.format(self.path.rsplit('/orders', 1)[0], result))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self._send(404, {'error': 'Not found'})
+
+
+    def do_DELETE(self):
+        if not self._delay_and_admit():
+            return
+        parts = urlparse(self.path).path.strip('/').split('/')
+
+        if parts[:2] == ['v1', 'accounts'] and len(parts) == 5 and parts[3] == 'orders':
+            try:
+                orderId = int(parts[4])
+            except ValueError:
+                return self._send(400, {'error': 'Invalid order id'})
+            status, error = self.server.market.cancel_order(orderId)
+            if status != 200:
+                return self._send(status, {'error': error})
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self._send(404, {'error': 'Not found'})
+
+
+def start_simulator(tickers, host='127.0.0.1', port=8080, latency=0.05, jitter=0.02,
+                    requests_per_minute=120, error_rate=0.0, delayed_open_fraction=0.02,
+                    open_delay=1.0, seed=0, holdings=None, open_buys=()):
+    # Starts the simulator on a background thread and returns the server,
+    # call server.shutdown() to stop it
+    market = MarketSimulator(tickers, seed=seed, delayed_open_fraction=delayed_open_fraction,
+                             open_delay=open_delay, holdings=holdings, open_buys=open_buys)
+    server = SimulatorServer((host, port), market, latency=latency, jitter=jitter,
+                             requests_per_minute=requests_per_minute, error_rate=error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def read_tickers(path='tickers.txt'):
+    return pd.read_csv(path)['tickers'].values.tolist()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local TD Ameritrade API simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response time, seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='std dev of the response time')
+    parser.add_argument('--rpm', type=int, default=120, help='requests per minute before 429s, 0 for no limit')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that get a 500')
+    parser.add_argument('--delayed-opens', type=float, default=0.02, help='fraction of symbols with a late open')
+    parser.add_argument('--open-delay', type=float, default=1.0, help='seconds before late symbols open')
+    parser.add_argument('--run', default=None, help='run main() with this message against the simulator')
+    parser.add_argument('--client-rpm', type=int, default=None, help='client side quota while using --run')
+    parser.add_argument('--shard-size', type=int, default=None, help='symbols per shard for --run "Trading Fanout"')
+    parser.add_argument('--holdings', type=int, default=0, help='start holding 30 shares of this many symbols')
+    parser.add_argument('--open-buys', type=int, default=0,
+                        help='start with a working 30 share buy for this many symbols (the first held ones)')
+    args = parser.parse_args()
+
+    tickers = read_tickers()
+    server = start_simulator(tickers, host=args.host, port=args.port, latency=args.latency,
+                             jitter=args.jitter, requests_per_minute=args.rpm, error_rate=args.error_rate,
+                             delayed_open_fraction=args.delayed_opens, open_delay=args.open_delay,
+                             holdings={s: 30.0 for s in tickers[:args.holdings]},
+                             open_buys=tickers[:args.open_buys])
+    url = 'http://{}:{}/v1'.format(args.host, args.port)
+    print('Simulator listening on ', url)
+
+    if args.run is None:
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    else:
+        import config
+        import main
+        import pubsub
+        import utils
+        utils.use_simulator(url=url, requests_per_minute=args.client_rpm)
+        pubsub.use_local()
+        if args.shard_size is not None:
+            config.TRADING_SHARD_SIZE = args.shard_size
+        server.market.started = time.time() + 5
+        main.main({'data': base64.b64encode(args.run.encode())}, None)
+        print('Simulator counts: ', server.counts)
+        print('Simulator positions: {}, working orders: {}'.format(
+            len(server.market.positions), sum(o['status'] == 'WORKING' for o in server.market.orders)))
+    server.shutdown()
@@ -0,0 +1,277 @@
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+# numpy / pandas are imported inside the methods that need them, so the
+# Refresh Token handler (tokens only) doesn't load them on a cold start
+
+
+# Where the bot keeps its data, by role. Each role has its own methods:
+#
+#   orders   save_orders(ordersDF) -> rows written, load_orders(start, end, symbols=None)
+#            ordersDF is the utils.parse_transactions frame, deduplicated on orderId
+#   tickers  save_tickers(asof, tickers), load_tickers(asof=None), load_ticker_history(start, end)
+#            confirmed membership snapshots, load_tickers gives the latest one on or before asof
+#            save_proposed_tickers(asof, tickers), load_proposed_tickers() -> (asof, tickers),
+#            clear_proposed_tickers(): the one scraped membership waiting for approval
+#   tokens   save_token(name, value, expires_in=None), load_token(name, with_expiry=False)
+#            -> value (or (value, expires_at)), None once expired
+#
+# get_storage(role) picks the backend from the role's setting in config.py
+# (ROLE_SETTINGS) and refuses one that doesn't keep that role:
+#   sqlite:///relative.db, sqlite:////absolute/path.db or sqlite:///:memory:   every role
+#   bigquery                                                                  orders, through db.py
+#
+# A Cloud Function's /tmp is its own instance's memory, gone with the instance
+# and invisible to the others. The default STORAGE_URL still works there, as
+# a per-instance store (logged once per instance): tokens then come from
+# config.py when an instance starts cold, the universe from tickers.txt, and a
+# ticker proposal lasts as long as the instance that made it. SQLite can't
+# share one file between instances over a network or FUSE mount (e.g. a
+# bucket), so those paths get a rollback journal instead of WAL, for a single
+# writer at a time only.
+
+ROLE_SETTINGS = {'orders': 'ORDERS_STORAGE_URL', 'tickers': 'STORAGE_URL', 'tokens': 'STORAGE_URL'}
+
+ORDER_COLUMNS = ['accountId', 'closeTime', 'enteredTime', 'filledQuantity', 'price', 'orderId',
+                 'orderInstruction', 'symbol', 'positionEffect', 'assetType', 'orderType',
+                 'orderStatus', 'tradeQuantity']
+
+
+
+###################
+#  Local SQLite   #
+###################
+
+class SQLiteStorage:
+
+    ROLES = {'orders', 'tickers', 'tokens'}
+
+    SCHEMA = [
+        '''create table if not exists orders (
+               accountId integer, closeTime text, enteredTime text, filledQuantity real,
+               price real, orderId integer not null, orderInstruction text, symbol text,
+               positionEffect text, assetType text, orderType text, orderStatus text,
+               tradeQuantity real)''',
+        'create index if not exists orders_order_id on orders (orderId)',
+        'create index if not exists orders_entered on orders (enteredTime, symbol)',
+        '''create table if not exists tickers (
+               asof text not null, symbol text not null,
+               primary key (asof, symbol)) without rowid''',
+        '''create table if not exists proposed_tickers (
+               asof text not null, symbol text not null primary key) without rowid''',
+        '''create table if not exists tokens (
+               name text primary key, value text not null, expires_at real, updated_at real)''',
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Token refreshes run in a worker thread (tokens.TokenManager.get_async)
+        # and the daemon serves from several, so every use of the one
+        # connection, temp.wanted included, holds the lock
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL needs shared memory between the processes, which remote filesystems don't give
+        self.conn.execute('pragma journal_mode={}'.format('delete' if _remote_path(path) else 'wal'))
+        self.conn.execute('pragma synchronous=normal')
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _stage_symbols(self, tickers):
+        # Symbols to filter on go through a temp table, not a giant IN list.
+        # Callers hold the lock until they've read the query that uses it.
+        self.conn.execute('create temp table if not exists wanted (symbol text primary key)')
+        self.conn.execute('delete from temp.wanted')
+        self.conn.executemany('insert or ignore into temp.wanted values (?)', [(t,) for t in tickers])
+
+    ### Orders ###
+    def save_orders(self, ordersDF):
+        import pandas as pd
+        if ordersDF.shape[0] == 0:
+            return 0
+        orderIds = [int(i) for i in ordersDF['orderId'].unique()]
+        with self._lock:
+            existing = set()
+            for n in range(0, len(orderIds), 500):
+                chunk = orderIds[n:n+500]
+                query = 'select distinct orderId from orders where orderId in ({})'.format(','.join('?'*len(chunk)))
+                existing.update(r[0] for r in self.conn.execute(query, chunk))
+
+            newOrders = ordersDF[~ordersDF['orderId'].isin(existing)]
+            frame = newOrders[ORDER_COLUMNS].copy()
+            for col in ['closeTime', 'enteredTime']:
+                frame[col] = pd.to_datetime(frame[col], utc=True).dt.strftime('%Y-%m-%dT%H:%M:%S+0000')
+            frame = frame.astype(object).where(frame.notna(), None)
+            with self.conn:
+                self.conn.executemany('insert into orders values ({})'.format(','.join('?'*len(ORDER_COLUMNS))),
+                                      frame.itertuples(index=False, name=None))
+        return frame.shape[0]
+
+    def load_orders(self, start, end, symbols=None):
+        # enteredTime between start and end (dates or timestamps, UTC)
+        import pandas as pd
+        start = pd.Timestamp(start, tz='UTC').strftime('%Y-%m-%dT%H:%M:%S+0000')
+        end = pd.Timestamp(end, tz='UTC')
+        if end == end.normalize():
+            end = end + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+        end = end.strftime('%Y-%m-%dT%H:%M:%S+0000')
+
+        query = 'select {} from orders o where o.enteredTime between ? and ?'.format(
+            ', '.join('o.' + c for c in ORDER_COLUMNS))
+        with self._lock:
+            if symbols is not None:
+                self._stage_symbols(symbols)
+                query += ' and o.symbol in (select symbol from temp.wanted)'
+            rows = self.conn.execute(query + ' order by o.enteredTime, o.orderId', (start, end)).fetchall()
+        ordersDF = pd.DataFrame(rows, columns=ORDER_COLUMNS)
+        ordersDF['closeTime'] = pd.to_datetime(ordersDF['closeTime'], utc=True)
+        ordersDF['enteredTime'] = pd.to_datetime(ordersDF['enteredTime'], utc=True)
+        return ordersDF
+
+    ### Tickers ###
+    def save_tickers(self, asof, tickers):
+        import pandas as pd
+        asof = pd.Timestamp(asof).strftime('%Y-%m-%d')
+        with self._lock, self.conn:
+            self.conn.execute('delete from tickers where asof = ?', (asof,))
+            self.conn.executemany('insert into tickers values (?, ?)', [(asof, t) for t in set(tickers)])
+
+    def load_tickers(self, asof=None):
+        import pandas as pd
+        asof = pd.Timestamp(asof if asof is not None else 'today').strftime('%Y-%m-%d')
+        with self._lock:
+            rows = self.conn.execute(
+                '''select symbol from tickers
+                   where asof = (select max(asof) from tickers where asof <= ?) order by symbol''',
+                (asof,)).fetchall()
+        return [r[0] for r in rows]
+
+    def load_ticker_history(self, start=None, end=None):
+        # Every snapshot between start and end (inclusive) as an (asof, symbol) frame
+        import pandas as pd
+        start = pd.Timestamp(start if start is not None else '1900-01-01').strftime('%Y-%m-%d')
+        end = pd.Timestamp(end if end is not None else 'today').strftime('%Y-%m-%d')
+        with self._lock:
+            rows = self.conn.execute(
+                'select asof, symbol from tickers where asof between ? and ? order by asof, symbol',
+                (start, end)).fetchall()
+        history = pd.DataFrame(rows, columns=['asof', 'symbol'])
+        history['asof'] = pd.to_datetime(history['asof'])
+        return history
+
+    def save_proposed_tickers(self, asof, tickers):
+        # Replaces any earlier proposal
+        import pandas as pd
+        asof = pd.Timestamp(asof).strftime('%Y-%m-%d')
+        with self._lock, self.conn:
+            self.conn.execute('delete from proposed_tickers')
+            self.conn.executemany('insert into proposed_tickers values (?, ?)', [(asof, t) for t in set(tickers)])
+
+    def load_proposed_tickers(self):
+        with self._lock:
+            rows = self.conn.execute('select asof, symbol from proposed_tickers order by symbol').fetchall()
+        if len(rows) == 0:
+            return (None, [])
+        return (rows[0][0], [r[1] for r in rows])
+
+    def clear_proposed_tickers(self):
+        with self._lock, self.conn:
+            self.conn.execute('delete from proposed_tickers')
+
+    ### Tokens ###
+    def save_token(self, name, value, expires_in=None):
+        now = time.time()
+        expiresAt = now + expires_in if expires_in is not None else None
+        with self._lock, self.conn:
+            self.conn.execute('insert or replace into tokens values (?, ?, ?, ?)', (name, value, expiresAt, now))
+
+    def load_token(self, name, with_expiry=False):
+        with self._lock:
+            row = self.conn.execute('select value, expires_at from tokens where name = ?', (name,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return (row[0], row[1]) if with_expiry else row[0]
+
+
+
+##############
+#  BigQuery  #
+##############
+
+class BigQueryStorage:
+    # Orders live in GBQ_ORDERS_TABLE
+
+    ROLES = {'orders'}
+
+    def save_orders(self, ordersDF):
+        import db
+        return db.save_trades_gbq(ordersDF=ordersDF)
+
+    def load_orders(self, start, end, symbols=None):
+        import db
+        return db.load_trades_gbq(start=start, end=end, symbols=symbols)
+
+
+
+_storages = {}
+
+STORAGE_REMOTE_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse', '9p')
+
+
+def in_cloud_function():
+    # Set by the Cloud Functions runtime
+    return 'FUNCTION_TARGET' in os.environ or 'K_SERVICE' in os.environ
+
+
+def _remote_path(path):
+    # True when `path` is on a network or FUSE mount (Linux only, from /proc/mounts)
+    if path == ':memory:':
+        return False
+    path = os.path.abspath(path)
+    (mountPoint, fsType) = ('', '')
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1]
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) > len(mountPoint):
+                    (mountPoint, fsType) = (mount, fields[2])
+    except OSError:
+        return False
+    return fsType.split('.')[0] in STORAGE_REMOTE_FILESYSTEMS
+
+
+def _backend(url):
+    # One backend per URL per process
+    if url not in _storages:
+        if url.startswith('sqlite:///'):
+            path = url[len('sqlite:///'):]
+            if in_cloud_function() and (path == ':memory:' or os.path.abspath(path).startswith('/tmp/')):
+                print('Storage {} is local to this Cloud Function instance, nothing saved there outlives it'.format(url))
+            _storages[url] = SQLiteStorage(path)
+        elif url == 'bigquery':
+            _storages[url] = BigQueryStorage()
+        else:
+            raise ValueError('Unknown storage URL: {}'.format(url))
+    return _storages[url]
+
+
+def get_storage(role, url=None):
+    setting = ROLE_SETTINGS[role]
+    url = url or getattr(config, setting)
+    backend = _backend(url)
+    if role not in backend.ROLES:
+        raise ValueError('{} ({}) cannot keep {}, use a sqlite:// URL'.format(setting, url, role))
+    return backend
@@ -0,0 +1,178 @@
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import backtest
+import candles
+import config
+import universe
+
+
+# Grid search over the strategy parameters with backtest.run_backtest:
+#   span, window                   EMA span and slope window (calc_trade_metrics)
+#   entry / exit thresholds        buy when slope >= entry, sell when slope < exit
+#   prior_filter                   the "prior slope must be negative" buy filter
+#   quantity / dollars             fixed shares per order, or fixed dollars per position
+#
+# The open / close matrices go into shared memory once and every worker maps
+# them, so a pool of N processes holds one copy of the prices rather than N.
+# Work is split by (span, window) so each worker computes the signals once and
+# reuses them for every filter and sizing combination.
+
+SWEEP_RANK_BY = 'sharpe'
+
+_store = None
+_segments = []
+
+
+
+#####################
+#  Shared matrices  #
+#####################
+
+def share_array(values):
+    # Copies `values` into a new shared memory block. Returns (block, spec)
+    values = np.ascontiguousarray(values)
+    block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    view = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+    view[...] = values
+    return (block, (block.name, values.shape, values.dtype.str))
+
+
+def attach_array(spec):
+    (name, shape, dtype) = spec
+    block = shared_memory.SharedMemory(name=name)
+    _segments.append(block)   # keep it mapped for the life of the worker
+    view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    view.flags.writeable = False
+    return view
+
+
+def _init_worker(symbols, days, openSpec, closeSpec):
+    global _store
+    _store = candles.CandleStore(symbols, days, attach_array(openSpec), attach_array(closeSpec))
+
+
+
+##############
+#  Workers   #
+##############
+
+def _run_group(span, window, variants):
+    # One (span, window) signal computation, then every variant on top of it
+    signals = backtest.signal_matrices(_store, span, window)
+    rows = []
+    for v in variants:
+        result = backtest.run_backtest(_store, span=span, window=window, signals=signals, **v)
+        row = {'span': span, 'window': window}
+        row.update(v)
+        row.update(result.summary())
+        rows.append(row)
+    return rows
+
+
+def parameter_grid(spans, windows, entry_thresholds, exit_thresholds, prior_filters, quantities, dollars,
+                   cost_per_share=0.0, slippage_bps=0.0):
+    # {(span, window): [run_backtest keyword dicts]}
+    sizings = [{'quantity': q, 'dollars_per_position': None} for q in quantities]
+    sizings += [{'quantity': backtest.BACKTEST_QUANTITY, 'dollars_per_position': d} for d in dollars]
+    variants = []
+    for entry, exit, prior, sizing in itertools.product(entry_thresholds, exit_thresholds, prior_filters, sizings):
+        v = {'entry_threshold': entry, 'exit_threshold': exit, 'prior_filter': prior,
+             'cost_per_share': cost_per_share, 'slippage_bps': slippage_bps}
+        v.update(sizing)
+        variants.append(v)
+    return {(s, w): variants for s, w in itertools.product(spans, windows)}
+
+
+def run_sweep(store, grid, workers=None, rank_by=SWEEP_RANK_BY):
+    # Returns every run as a frame, best `rank_by` first
+    workers = workers or os.cpu_count()
+    blocks = []
+    try:
+        (openBlock, openSpec) = share_array(store.open)
+        blocks.append(openBlock)
+        (closeBlock, closeSpec) = share_array(store.close)
+        blocks.append(closeBlock)
+
+        rows = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(store.symbols, store.days, openSpec, closeSpec)) as pool:
+            futures = [pool.submit(_run_group, span, window, variants) for (span, window), variants in grid.items()]
+            for future in as_completed(futures):
+                rows.extend(future.result())
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    results = pd.DataFrame(rows)
+    if len(results) > 0:
+        results = results.sort_values(rank_by, ascending=False, na_position='last').reset_index(drop=True)
+        results.index = results.index + 1
+        results.index.name = 'rank'
+    return results
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parameter sweep for the EMA slope strategy')
+    parser.add_argument('--spans', type=int, nargs='+', default=[5, 9, 13, 21])
+    parser.add_argument('--windows', type=int, nargs='+', default=[2, 3, 5])
+    parser.add_argument('--entry-thresholds', type=float, nargs='+', default=[0.0])
+    parser.add_argument('--exit-thresholds', type=float, nargs='+', default=[0.0])
+    parser.add_argument('--prior-filter', choices=['on', 'off', 'both'], default='both')
+    parser.add_argument('--quantities', type=int, nargs='*', default=[backtest.BACKTEST_QUANTITY])
+    parser.add_argument('--dollars', type=float, nargs='*', default=[], help='fixed dollars per position sizings')
+    parser.add_argument('--cost-per-share', type=float, default=0.0)
+    parser.add_argument('--slippage-bps', type=float, default=0.0)
+    parser.add_argument('--workers', type=int, default=None, help='defaults to every core')
+    parser.add_argument('--rank-by', default=SWEEP_RANK_BY)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--tickers', default=None, help='defaults to every symbol ever in the universe')
+    parser.add_argument('--years', type=float, default=5)
+    parser.add_argument('--synthetic', type=int, default=None, metavar='SYMBOLS')
+    parser.add_argument('--output', default=None, help='write the full ranked table to this CSV')
+    args = parser.parse_args()
+
+    if min(args.windows) < 2:
+        raise SystemExit('The slope window needs at least 2 bars')
+
+    if args.synthetic:
+        store = backtest.synthetic_store(args.synthetic, int(args.years * 252))
+    else:
+        if args.tickers:
+            tickers = pd.read_csv(args.tickers)['tickers'].values.tolist()
+        else:
+            tickers = universe.ever_members()
+        endDay = candles.date_to_day(pd.Timestamp.now().normalize()) - 1
+        store = candles.CandleStore.from_cache(candles.CandleCache(config.CANDLE_CACHE_DIR), tickers,
+                                               endDay - int(args.years * 365.25), endDay)
+        if len(store.symbols) == 0:
+            raise SystemExit('No cached candles in {}'.format(config.CANDLE_CACHE_DIR))
+
+    priorFilters = {'on': [True], 'off': [False], 'both': [True, False]}[args.prior_filter]
+    grid = parameter_grid(args.spans, args.windows, args.entry_thresholds, args.exit_thresholds, priorFilters,
+                          args.quantities, args.dollars, args.cost_per_share, args.slippage_bps)
+    nRuns = sum(len(v) for v in grid.values())
+    print('Running {} backtests over {} symbols x {} days on {} workers'.format(
+        nRuns, len(store.symbols), len(store.days), args.workers or os.cpu_count()))
+
+    t1 = time.time()
+    results = run_sweep(store, grid, workers=args.workers, rank_by=args.rank_by)
+    t2 = time.time()
+
+    columns = ['span', 'window', 'entry_threshold', 'exit_threshold', 'prior_filter', 'quantity',
+               'dollars_per_position', 'pnl', 'buy_and_hold_pnl', 'sharpe', 'max_drawdown', 'orders', 'turnover']
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(results[columns].head(args.top))
+    print('Sweep took: ', round(t2-t1, 3), ' seconds')
+    if args.output:
+        results.to_csv(args.output)
+        print('Results written to ', args.output)
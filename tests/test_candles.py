@@ -0,0 +1,86 @@
+import json
+
+import numpy as np
+
+import candles
+
+
+def bar(open, close, datetime, order=('open', 'high', 'low', 'close', 'volume', 'datetime')):
+    values = {'open': open, 'high': close, 'low': close, 'close': close,
+              'volume': 1200300, 'datetime': datetime}
+    return {k: values[k] for k in order}
+
+
+def payload(bars, separators=(', ', ': '), **extra):
+    body = {'candles': bars, 'symbol': 'AAPL', 'empty': len(bars) == 0}
+    body.update(extra)
+    return json.dumps(body, separators=separators).encode()
+
+
+def reference(raw):
+    return candles.candles_to_arrays(json.loads(raw)['candles'])
+
+
+def scan(raw):
+    start = raw.find(b'"candles"')
+    return candles._scan_candles(raw, start, raw.find(b']', start))
+
+
+def assert_decoded(raw, fast=True):
+    decoded = candles.decode_candles(raw)
+    expected = reference(raw)
+    assert decoded[0].dtype == np.int32
+    for (got, want) in zip(decoded, expected):
+        np.testing.assert_array_equal(got, want)
+    assert (scan(raw) is not None) == fast
+
+
+def test_fast_path_matches_json():
+    bars = [bar(130.5, 131.25, 1614578400000), bar(131.0, 129.75, 1614664800000),
+            bar(128.0, 128.5, 1614751200000)]
+    assert_decoded(payload(bars))
+    assert_decoded(payload(bars, separators=(',', ':')))
+
+
+def test_empty_candles():
+    raw = payload([])
+    assert b'"empty": true' in raw
+    (days, opens, closes) = candles.decode_candles(raw)
+    assert len(days) == len(opens) == len(closes) == 0
+
+
+def test_exponents_and_negative_numbers():
+    bars = [bar(1.5e2, -2.5, 1614578400000), bar(1e-05, 3.25E+3, 1.6146648e12)]
+    raw = payload(bars).replace(b'1.5e2', b'1.5E2')
+    assert_decoded(raw)
+    np.testing.assert_array_equal(candles.decode_candles(raw)[1], [150.0, 1e-05])
+
+
+def test_reordered_keys():
+    order = ('datetime', 'volume', 'close', 'low', 'high', 'open')
+    bars = [bar(130.5, 131.25, 1614578400000, order), bar(131.0, 129.75, 1614664800000, order)]
+    assert_decoded(payload(bars))
+    # Keys after the candles, before them, or the last bar in a different order
+    assert_decoded(payload(bars, previousClose=128.0))
+    assert_decoded(json.dumps({'symbol': 'AAPL', 'candles': bars}).encode())
+    mixed = [bar(130.5, 131.25, 1614578400000), bar(131.0, 129.75, 1614664800000),
+             bar(132.0, 130.5, 1614751200000, order)]
+    assert_decoded(payload(mixed), fast=False)
+
+
+def test_unexpected_layouts_fall_back_to_json():
+    # A null price
+    assert_decoded(payload([bar(130.5, 131.25, 1614578400000), bar(None, 129.75, 1614664800000)]), fast=False)
+    assert np.isnan(candles.decode_candles(payload([bar(None, 1.0, 1614578400000)]))[1][0])
+    # A space before the colon
+    assert_decoded(payload([bar(1.0, 2.0, 1614578400000)], separators=(', ', ' : ')), fast=False)
+    # Pretty printed is still the fast path
+    assert_decoded(json.dumps({'candles': [bar(1.0, 2.0, 1614578400000)]}, indent=2).encode())
+
+
+def test_malformed_payloads():
+    assert candles.decode_candles(b'{"error": "Not found"}') is None
+    assert candles.decode_candles(b'{"candles": [{"open": 1.0, "close"') is None
+    assert candles.decode_candles(b'{"candles": [{"open": 1.0, "close": 2.0, "datetime": 0}') is None
+    assert candles.decode_candles(b'<html>Bad Gateway</html>') is None
+    assert candles.decode_candles(b'{"candles": null}') is None
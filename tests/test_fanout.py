@@ -0,0 +1,21 @@
+import fanout
+import ratelimit
+
+
+def test_shards_are_balanced():
+    shards = fanout.split_shards(['S{}'.format(k) for k in range(1001)], shard_size=500)
+    assert [len(shard) for shard in shards] == [334, 334, 333]
+    assert sum(shards, []) == ['S{}'.format(k) for k in range(1001)]
+
+
+def test_no_more_shards_than_requests_per_minute(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'TD_REQUESTS_PER_MINUTE', 60)
+    tickers = ['S{}'.format(k) for k in range(500)]
+    shards = fanout.split_shards(tickers, shard_size=1)
+    assert len(shards) == 60
+    assert sum(shards, []) == tickers
+    # Every shard's bucket still gets a usable rate
+    bucket = ratelimit.TokenBucket('market_data', ratelimit.TD_REQUESTS_PER_MINUTE // len(shards),
+                                   clock=lambda: 0.0)
+    assert bucket._reserve() == 0.0
+    assert bucket._reserve() == 60.0
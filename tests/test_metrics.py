@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+import metrics
+
+
+def ragged_history(seed=0):
+    # Symbols listed on different days with different lengths, one missing open
+    rng = np.random.default_rng(seed)
+    frames = []
+    for (symbol, start, length) in [('AAA', 0, 40), ('BBB', 5, 30), ('CCC', 12, 3), ('DDD', 20, 1)]:
+        days = pd.bdate_range('2021-01-04', periods=60)[start:start + length]
+        closes = 100 + np.cumsum(rng.normal(0, 1, length))
+        opens = closes + rng.normal(0, 0.5, length)
+        frames.append(pd.DataFrame({'symbol': symbol, 'datetime': days, 'open': opens, 'close': closes}))
+    history = pd.concat(frames, ignore_index=True)
+    history.loc[(history['symbol'] == 'AAA') & (history.index == 17), 'open'] = np.nan
+    return history
+
+
+def test_vectorized_metrics_match_reference():
+    assert metrics.check_parity(ragged_history())
+
+
+def test_parity_ignores_row_order():
+    history = ragged_history(seed=1).sample(frac=1, random_state=3).reset_index(drop=True)
+    assert metrics.check_parity(history)
+
+
+def assert_step_matches_recompute(state, history, today):
+    # One step from `state` with todays bars equals a full pass over history + today
+    full = metrics.calc_trade_metrics(pd.concat([history, today], ignore_index=True))
+    expected = full[full['datetime'] == today['datetime'].iloc[0]].sort_values('symbol').reset_index(drop=True)
+    stepped = metrics.step_ema_state(state, today).sort_values('symbol').reset_index(drop=True)
+    assert stepped['symbol'].tolist() == expected['symbol'].tolist()
+    for col in ['EMA_Close', 'EMA_Open', 'slope', 'prior_slope']:
+        np.testing.assert_allclose(stepped[col].values, expected[col].values, rtol=1e-9, atol=1e-9)
+
+
+def split_last_day(history):
+    # (everything before, the rows of) the last day every symbol traded
+    last = history.groupby('symbol')['datetime'].max().min()
+    history = history[history['datetime'] <= last]
+    today = history[history['datetime'] == last].reset_index(drop=True)
+    return (history[history['datetime'] < last].reset_index(drop=True), today)
+
+
+def test_state_step_equals_full_recompute():
+    (history, today) = split_last_day(ragged_history()[lambda h: h['symbol'].isin(['AAA', 'BBB'])])
+    state = metrics.build_ema_state(history)
+    assert_step_matches_recompute(state, history, today)
+
+
+def test_synced_state_equals_full_recompute():
+    # State saved a week ago, stepped through the missing bars by sync_ema_state
+    (history, today) = split_last_day(ragged_history()[lambda h: h['symbol'].isin(['AAA', 'BBB', 'CCC'])])
+    weekAgo = history['datetime'].max() - pd.Timedelta(days=7)
+    saved = metrics.build_ema_state(history[history['datetime'] <= weekAgo])
+    state = metrics.sync_ema_state(saved, history)
+    assert_step_matches_recompute(state, history, today)
+
+
+def test_rebuild_replaces_state_after_an_adjustment():
+    (history, today) = split_last_day(ragged_history()[lambda h: h['symbol'].isin(['AAA', 'BBB'])])
+    saved = metrics.build_ema_state(history)
+    split = history.copy()
+    split.loc[split['symbol'] == 'AAA', ['open', 'close']] /= 4
+    today = today.copy()
+    today.loc[today['symbol'] == 'AAA', ['open', 'close']] /= 4
+    state = metrics.sync_ema_state(saved, split, rebuild=['AAA'])
+    assert_step_matches_recompute(state, split, today)
+
+
+def test_stale_state_gives_no_signal():
+    # BBB's history failed today: its state stops a day short and must not be stepped
+    (history, today) = split_last_day(ragged_history()[lambda h: h['symbol'].isin(['AAA', 'BBB'])])
+    lastDay = metrics.to_day_numbers(history['datetime']).max()
+    stale = history[~((history['symbol'] == 'BBB') & (history['datetime'] == history['datetime'].max()))]
+    state = metrics.build_ema_state(stale)
+    stepped = metrics.step_ema_state(state, today, last_day=lastDay).set_index('symbol')
+    assert np.isnan(stepped.loc['BBB', 'slope'])
+    assert np.isnan(stepped.loc['BBB', 'prior_slope'])
+    assert not np.isnan(stepped.loc['AAA', 'slope'])
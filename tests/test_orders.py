@@ -0,0 +1,167 @@
+import asyncio
+import time
+
+import pytest
+
+import orders
+import ratelimit
+import tokens
+
+
+def account_order(symbol, instruction, quantity, entered, status='FILLED'):
+    return {'status': status, 'enteredTime': entered,
+            'orderLegCollection': [{'instruction': instruction, 'quantity': quantity,
+                                    'instrument': {'symbol': symbol, 'assetType': 'EQUITY'}}]}
+
+
+# 2021-03-01T14:30:00+0000
+SENT = 1614609000.0
+
+
+def test_placed_order_found_after_an_uncertain_failure():
+    accountOrders = [account_order('AAPL', 'BUY', 30, '2021-03-01T14:30:01+0000')]
+    assert orders.placed_order_in(accountOrders, 'AAPL', 'BUY', 30, SENT)
+
+
+def test_other_orders_dont_count_as_placed():
+    accountOrders = [account_order('AAPL', 'SELL', 30, '2021-03-01T14:30:01+0000'),
+                     account_order('AAPL', 'BUY', 10, '2021-03-01T14:30:01+0000'),
+                     account_order('MSFT', 'BUY', 30, '2021-03-01T14:30:01+0000'),
+                     account_order('AAPL', 'BUY', 30, '2021-03-01T14:30:01+0000', status='REJECTED'),
+                     account_order('AAPL', 'BUY', 30, '2021-03-01T14:20:00+0000')]   # an earlier run's
+    assert not orders.placed_order_in(accountOrders, 'AAPL', 'BUY', 30, SENT)
+
+
+
+##########################
+#  OrderSubmitter        #
+##########################
+
+class FakeResponse:
+
+    def __init__(self, status, body=None):
+        self.status = status
+        self.headers = {}
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def json(self, content_type=None):
+        return self.body
+
+
+class PendingPost:
+
+    def __init__(self, reply):
+        self.reply = reply
+
+    async def __aenter__(self):
+        return await self.reply
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    # Replies to order POSTs from `replies` per symbol: a status, an exception
+    # to raise, or (either of those, placed anyway). Account lookups see every
+    # order that was placed. 201 once a symbol's replies run out.
+
+    def __init__(self, replies=None, delay=0.0):
+        self.replies = {symbol: list(r) for symbol, r in (replies or {}).items()}
+        self.delay = delay
+        self.events = []
+        self.posts = []
+        self.placed = []
+
+    async def _post_reply(self, order, headers):
+        leg = order['orderLegCollection'][0]
+        symbol = leg['instrument']['symbol']
+        self.posts.append((symbol, leg['instruction'], headers['Authorization']))
+        self.events.append(('start', symbol))
+        await asyncio.sleep(self.delay)
+        self.events.append(('end', symbol))
+        reply = self.replies.get(symbol, [])
+        reply = reply.pop(0) if len(reply) > 0 else 201
+        if isinstance(reply, tuple):
+            # (status, placed anyway)
+            (reply, ghost) = reply
+            if ghost:
+                self.placed.append(order)
+        elif reply == 201:
+            self.placed.append(order)
+        if isinstance(reply, Exception):
+            raise reply
+        return FakeResponse(reply)
+
+    def post(self, url, json=None, headers=None):
+        return PendingPost(self._post_reply(json, headers))
+
+    def get(self, url, headers=None):
+        now = time.strftime('%Y-%m-%dT%H:%M:%S+0000', time.gmtime())
+        return FakeResponse(200, [dict(o, status='FILLED', enteredTime=now) for o in self.placed])
+
+
+@pytest.fixture
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(orders, 'backoff_delay', lambda attempt, **kwargs: 0.0)
+    monkeypatch.setattr(tokens, 'TOKENS', tokens.TokenManager(fetch=lambda: {'access_token': 'fresh', 'expires_in': 1800},
+                                                             persist=False))
+
+
+def submit(session, sells=(), buys=(), token='token'):
+    async def run():
+        submitter = orders.OrderSubmitter(session, token, url='https://example.test/orders',
+                                          quota=ratelimit.TokenBucket('test', 6000))
+        submitter.sell(list(sells))
+        submitter.buy(list(buys))
+        return await submitter.results()
+    return {(r['symbol'], r['action']): r for r in asyncio.run(run())}
+
+
+def test_buys_wait_for_earlier_sells(no_waiting):
+    session = FakeSession(delay=0.05)
+    results = submit(session, sells=['AAPL', 'MSFT'], buys=['NVDA', 'XOM'])
+    assert all(r['ok'] for r in results.values())
+    lastSellEnd = max(k for k, e in enumerate(session.events) if e in [('end', 'AAPL'), ('end', 'MSFT')])
+    firstBuyStart = min(k for k, e in enumerate(session.events) if e in [('start', 'NVDA'), ('start', 'XOM')])
+    assert firstBuyStart > lastSellEnd
+
+
+def test_uncertain_failure_with_a_placed_order_is_not_resent(no_waiting):
+    # A 503 and a timeout that both reached the book
+    session = FakeSession({'AAPL': [(503, True)], 'MSFT': [(asyncio.TimeoutError(), True)]})
+    results = submit(session, buys=['AAPL', 'MSFT'])
+    for symbol in ['AAPL', 'MSFT']:
+        assert results[(symbol, 'BUY')]['ok']
+        assert results[(symbol, 'BUY')]['found']
+        assert results[(symbol, 'BUY')]['attempts'] == 1
+    assert len(session.posts) == 2
+    assert len(session.placed) == 2
+
+
+def test_uncertain_failure_without_an_order_is_resent(no_waiting):
+    session = FakeSession({'AAPL': [503], 'MSFT': [asyncio.TimeoutError()]})
+    results = submit(session, buys=['AAPL', 'MSFT'])
+    for symbol in ['AAPL', 'MSFT']:
+        assert results[(symbol, 'BUY')]['ok']
+        assert not results[(symbol, 'BUY')]['found']
+        assert results[(symbol, 'BUY')]['attempts'] == 2
+    assert len(session.placed) == 2
+
+
+def test_unauthorized_is_resent_once_with_a_new_token(no_waiting):
+    tokens.TOKENS.seed('expired', 1800)
+    session = FakeSession({'AAPL': [401], 'MSFT': [401, 401]})
+    results = submit(session, buys=['AAPL', 'MSFT'], token=None)
+    assert results[('AAPL', 'BUY')]['ok']
+    assert results[('AAPL', 'BUY')]['attempts'] == 2
+    assert [p[2] for p in session.posts if p[0] == 'AAPL'] == ['Bearer expired', 'Bearer fresh']
+    # A second 401 isn't retried again
+    assert not results[('MSFT', 'BUY')]['ok']
+    assert results[('MSFT', 'BUY')]['status'] == 401
+    assert len([p for p in session.posts if p[0] == 'MSFT']) == 2
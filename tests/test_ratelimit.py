@@ -0,0 +1,135 @@
+import pytest
+
+import ratelimit
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def bucket(per_minute=70, burst=10, clock=None):
+    return ratelimit.TokenBucket('test', per_minute, burst=burst, clock=clock or FakeClock())
+
+
+def test_burst_then_paced():
+    b = bucket(per_minute=70, burst=10)
+    # 60 paced calls a minute on top of the burst: one a second
+    waits = [b._reserve() for _ in range(13)]
+    assert waits[:10] == [0.0] * 10
+    assert waits[10:] == pytest.approx([0.0, 1.0, 2.0])
+    assert b.stats()['waits'] == 2
+
+
+def test_never_more_than_per_minute_in_a_minute():
+    clock = FakeClock()
+    b = bucket(per_minute=70, burst=10, clock=clock)
+    starts = [clock.now + b._reserve() for _ in range(300)]
+    for k in range(len(starts) - 70):
+        assert starts[k + 70] - starts[k] >= 60.0 - 1e-9
+
+
+def test_idle_time_refills_the_burst():
+    clock = FakeClock()
+    b = bucket(per_minute=70, burst=10, clock=clock)
+    for _ in range(20):
+        b._reserve()
+    clock.now += 120
+    assert [b._reserve() for _ in range(10)] == [0.0] * 10
+
+
+def test_throttle_halves_the_rate_and_recovers():
+    clock = FakeClock()
+    b = bucket(per_minute=70, burst=10, clock=clock)
+    b.observe(ratelimit.THROTTLED, retry_after=None)
+    assert b.rate == pytest.approx(b.full_rate / 2)
+    assert b.throttled == 1
+    # Everyone waits out the default backoff
+    assert b._reserve() == pytest.approx(ratelimit.TD_THROTTLE_BACKOFF)
+
+    # Never below 1/16 of the full rate
+    for _ in range(10):
+        b.observe(ratelimit.THROTTLED)
+    assert b.rate == pytest.approx(b.full_rate / 16)
+
+    # Each success wins back TD_RECOVERY of the full rate, up to the full rate
+    b.observe(200)
+    assert b.rate == pytest.approx(b.full_rate / 16 + b.full_rate * ratelimit.TD_RECOVERY)
+    for _ in range(100):
+        b.observe(200)
+    assert b.rate == b.full_rate
+    # Errors other than 429 change nothing
+    b.observe(500)
+    assert b.rate == b.full_rate
+
+
+def test_retry_after_holds_every_caller():
+    clock = FakeClock()
+    b = bucket(per_minute=70, burst=10, clock=clock)
+    b.observe(ratelimit.THROTTLED, retry_after='7')
+    assert b._reserve() == pytest.approx(7.0)
+    clock.now += 7
+    assert b._reserve() == pytest.approx(0.0)
+    # The HTTP date form isn't honoured, the default backoff is used
+    b.observe(ratelimit.THROTTLED, retry_after='Wed, 21 Oct 2015 07:28:00 GMT')
+    assert b._reserve() == pytest.approx(ratelimit.TD_THROTTLE_BACKOFF)
+
+
+def test_small_quotas():
+    clock = FakeClock()
+    # One call a minute: no burst, every call paced
+    b = bucket(per_minute=1, clock=clock)
+    assert [b._reserve() for _ in range(3)] == pytest.approx([0.0, 60.0, 120.0])
+    b = bucket(per_minute=2, clock=clock)
+    assert [b._reserve() for _ in range(3)] == pytest.approx([0.0, 0.0, 60.0])
+    with pytest.raises(ValueError):
+        bucket(per_minute=0)
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeSession:
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+def test_send_retries_throttled_requests(monkeypatch):
+    session = FakeSession([FakeResponse(429, {'Retry-After': '0'}), FakeResponse(429, {'Retry-After': '0'}),
+                          FakeResponse(200)])
+    monkeypatch.setattr(ratelimit, '_session', session)
+    b = bucket(per_minute=600)
+    r = ratelimit.send(b, 'GET', 'https://example.test/quotes')
+    assert r.status_code == 200
+    assert session.calls == 3
+    assert b.throttled == 2
+
+
+def test_send_gives_up_after_the_retries(monkeypatch):
+    session = FakeSession([FakeResponse(429, {'Retry-After': '0'})] * 3)
+    monkeypatch.setattr(ratelimit, '_session', session)
+    b = bucket(per_minute=600)
+    r = ratelimit.send(b, 'GET', 'https://example.test/quotes', retries=2)
+    assert r.status_code == 429
+    assert session.calls == 3
+
+
+def test_send_does_not_retry_other_errors(monkeypatch):
+    session = FakeSession([FakeResponse(500), FakeResponse(200)])
+    monkeypatch.setattr(ratelimit, '_session', session)
+    assert ratelimit.send(bucket(per_minute=600), 'GET', 'https://example.test/quotes').status_code == 500
+    assert session.calls == 1
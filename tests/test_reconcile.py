@@ -0,0 +1,63 @@
+import reconcile
+
+
+def open_order(orderId, symbol, instruction, quantity, remaining):
+    return {'orderId': orderId, 'status': 'WORKING', 'remainingQuantity': remaining,
+            'orderLegCollection': [{'instruction': instruction, 'quantity': quantity,
+                                    'instrument': {'symbol': symbol, 'assetType': 'EQUITY'}}]}
+
+
+def account():
+    # AAPL: 30 held, 10 of them being sold. MSFT: 5 held, 25 more still to fill.
+    # NVDA: nothing held yet, a buy of 30 open.
+    return {'securitiesAccount': {
+        'positions': [{'longQuantity': 30, 'instrument': {'symbol': 'AAPL'}},
+                      {'longQuantity': 5, 'instrument': {'symbol': 'MSFT'}}],
+        'orderStrategies': [open_order(1, 'AAPL', 'SELL', 10, 10),
+                            open_order(2, 'MSFT', 'BUY', 30, 25),
+                            open_order(3, 'NVDA', 'BUY', 30, 30),
+                            dict(open_order(4, 'NVDA', 'BUY', 30, 0), status='FILLED')],
+        'currentBalances': {'buyingPower': 1000.0}}}
+
+
+def test_snapshot_from_account():
+    snapshot = reconcile.AccountSnapshot.from_account(account())
+    assert snapshot.positions == {'AAPL': 30, 'MSFT': 5}
+    assert snapshot.pending('AAPL', 'SELL') == 10
+    assert snapshot.pending('MSFT', 'BUY') == 25
+    assert snapshot.pending_ids('NVDA', 'BUY') == [3]
+    assert snapshot.buying_power == 1000.0
+
+
+def test_sells_only_count_settled_shares():
+    reconciler = reconcile.Reconciler(reconcile.AccountSnapshot.from_account(account()))
+    # The open MSFT and NVDA buys aren't shares we hold yet
+    assert reconciler.sell_orders(['AAPL', 'MSFT', 'NVDA']) == {'AAPL': 20, 'MSFT': 5}
+    # Already sent, nothing left to sell
+    assert reconciler.exit_orders(['AAPL', 'MSFT']) == {}
+
+
+def test_exits_cancel_open_buys():
+    reconciler = reconcile.Reconciler(reconcile.AccountSnapshot.from_account(account()))
+    assert reconciler.exit_orders(['MSFT', 'NVDA']) == {'MSFT': 5}
+    assert reconciler.open_buys(['MSFT', 'NVDA']) == [2, 3]
+    assert reconciler.open_buys(['AAPL']) == []
+
+
+def test_buys_net_of_held_open_and_sent():
+    reconciler = reconcile.Reconciler(reconcile.AccountSnapshot.from_account(account()), quantity=30)
+    prices = {'AAPL': 10.0, 'MSFT': 10.0, 'NVDA': 10.0, 'TSLA': 10.0}
+    (buys, sells) = reconciler.orders(['AAPL', 'MSFT', 'NVDA', 'TSLA'], [], prices)
+    # AAPL 30 - 10 being sold, MSFT and NVDA already at 30 with their open buys
+    assert buys == {'AAPL': 10, 'TSLA': 30}
+    assert sells == {}
+    assert reconciler.budget == 1000.0 - 400.0
+    # A second batch doesn't order the same symbols again
+    assert reconciler.orders(['AAPL', 'TSLA'], [], prices) == ({}, {})
+
+
+def test_buys_skipped_past_buying_power():
+    reconciler = reconcile.Reconciler(reconcile.AccountSnapshot(buying_power=500.0), quantity=30)
+    buys = reconciler.buy_orders(['AAPL', 'MSFT'], {'AAPL': 10.0, 'MSFT': 10.0})
+    assert buys == {'AAPL': 30}
+    assert reconciler.skipped == ['MSFT']
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import config
+import tokens
+
+
+class FakeTokenEndpoint:
+    # Stands in for request_access_token, counting the calls
+
+    def __init__(self, expires_in=1800, delay=0.0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        time.sleep(self.delay)
+        with self._lock:
+            self.calls += 1
+            return {'access_token': 'token-{}'.format(self.calls), 'expires_in': self.expires_in}
+
+
+@pytest.fixture
+def token_storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'STORAGE_URL', 'sqlite:///' + str(tmp_path / 'tokens.db'))
+
+
+def test_token_reused_until_close_to_expiry():
+    fetch = FakeTokenEndpoint()
+    manager = tokens.TokenManager(fetch=fetch, persist=False, margin=300)
+    assert manager.get() == 'token-1'
+    assert manager.get() == 'token-1'
+    assert fetch.calls == 1
+    assert 1700 <= manager.expires_in() <= 1800
+
+    # Inside the margin counts as expired
+    manager.expires_at = time.time() + 100
+    assert not manager.fresh()
+    assert manager.get() == 'token-2'
+    assert fetch.calls == 2
+
+
+def test_one_refresh_for_concurrent_sync_and_async_callers():
+    fetch = FakeTokenEndpoint(delay=0.2)
+    manager = tokens.TokenManager(fetch=fetch, persist=False)
+    results = []
+
+    def sync_caller():
+        results.append(manager.get())
+
+    async def async_callers():
+        return await asyncio.gather(*[manager.get_async() for _ in range(8)])
+
+    threads = [threading.Thread(target=sync_caller) for _ in range(8)]
+    for t in threads:
+        t.start()
+    results.extend(asyncio.run(async_callers()))
+    for t in threads:
+        t.join()
+
+    assert fetch.calls == 1
+    assert results == ['token-1'] * 16
+
+
+def test_invalidated_token_is_replaced():
+    fetch = FakeTokenEndpoint()
+    manager = tokens.TokenManager(fetch=fetch, persist=False)
+    token = manager.get()
+    assert manager.resolve(token) == token
+    manager.invalidate(token)
+    assert manager.resolve(token) == 'token-2'
+    # Tokens it never issued are sent as given
+    assert manager.resolve('someone-elses') == 'someone-elses'
+
+
+def test_token_persisted_for_the_next_run(token_storage):
+    first = tokens.TokenManager(fetch=FakeTokenEndpoint())
+    token = first.get()
+
+    fetch = FakeTokenEndpoint()
+    second = tokens.TokenManager(fetch=fetch)
+    assert second.get() == token
+    assert fetch.calls == 0
+
+    # A saved token the API rejected isn't loaded again
+    second.invalidate(token)
+    assert second.get() == 'token-1'
+    assert fetch.calls == 1
+
+
+def test_saved_refresh_token_wins_over_config(token_storage, monkeypatch):
+    monkeypatch.setattr(config, 'TD_REFRESH_TOKEN', 'from-config')
+    assert tokens.get_refresh_token() == 'from-config'
+    assert tokens.save_token('refresh_token', 'from-storage', expires_in=7776000)
+    assert tokens.get_refresh_token() == 'from-storage'
+
+
+def test_tokens_work_without_storage(monkeypatch):
+    monkeypatch.setattr(config, 'STORAGE_URL', 'unknown://nowhere')
+    monkeypatch.setattr(config, 'TD_REFRESH_TOKEN', 'from-config')
+    assert tokens.get_refresh_token() == 'from-config'
+    assert not tokens.save_token('refresh_token', 'new')
+
+    fetch = FakeTokenEndpoint()
+    manager = tokens.TokenManager(fetch=fetch)
+    assert manager.get() == 'token-1'
+    assert manager.get() == 'token-1'
+    assert fetch.calls == 1
@@ -0,0 +1,44 @@
+import os
+
+import pandas as pd
+
+import metrics
+import trading
+
+
+def small_state():
+    days = pd.bdate_range('2021-01-04', periods=10)
+    history = pd.DataFrame({'symbol': 'AAA', 'datetime': days,
+                            'open': range(100, 110), 'close': range(101, 111)})
+    return metrics.build_ema_state(history)
+
+
+def test_loaded_state_is_kept_for_the_next_run(tmp_path, monkeypatch):
+    path = str(tmp_path / 'ema_state.npz')
+    monkeypatch.setattr(trading, '_states', {})
+    small_state().save(path)
+
+    first = trading.load_state(path)
+    assert first is not None
+    assert trading._states[path][1] is first
+    # The daemon's warm up loads it, Trading gets the same object without reading the file
+    assert trading.load_state(path) is first
+
+
+def test_changed_state_file_is_read_again(tmp_path, monkeypatch):
+    path = str(tmp_path / 'ema_state.npz')
+    monkeypatch.setattr(trading, '_states', {})
+    small_state().save(path)
+    first = trading.load_state(path)
+
+    small_state().save(path)
+    os.utime(path, (0, 0))
+    second = trading.load_state(path)
+    assert second is not first
+    assert list(second.symbols) == ['AAA']
+
+
+def test_missing_state_is_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(trading, '_states', {})
+    assert trading.load_state(str(tmp_path / 'missing.npz')) is None
+    assert trading._states == {}
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import db
+import storage
+import utils
+
+
+def leg(legId, instruction, symbol, quantity):
+    return {'legId': legId, 'orderLegType': 'EQUITY', 'instruction': instruction, 'quantity': quantity,
+            'positionEffect': 'OPENING' if instruction == 'BUY' else 'CLOSING',
+            'instrument': {'symbol': symbol, 'assetType': 'EQUITY'}}
+
+
+def execution(legId, quantity, price):
+    return {'legId': legId, 'quantity': quantity, 'price': price, 'time': '2021-03-01T14:30:02+0000'}
+
+
+def order(orderId, legs, executions=(), status='FILLED', children=None, **fields):
+    o = {'accountId': 123456789, 'orderId': orderId, 'orderType': 'MARKET', 'status': status,
+         'enteredTime': '2021-03-01T14:30:01+0000', 'closeTime': '2021-03-01T14:30:02+0000',
+         'quantity': sum(l['quantity'] for l in legs), 'filledQuantity': sum(e['quantity'] for e in executions),
+         'orderLegCollection': legs,
+         'orderActivityCollection': [{'activityType': 'EXECUTION', 'executionLegs': list(executions)}]}
+    if children is not None:
+        o['childOrderStrategies'] = children
+    o.update(fields)
+    return o
+
+
+def rows(ordersDF, *cols):
+    return [tuple(r) for r in ordersDF[list(cols)].itertuples(index=False, name=None)]
+
+
+def test_single_fill():
+    ordersDF = utils.parse_transactions([order(1001, [leg(1, 'BUY', 'AAPL', 30)], [execution(1, 30, 121.5)])])
+    assert list(ordersDF.columns) == storage.ORDER_COLUMNS
+    assert rows(ordersDF, 'orderId', 'symbol', 'orderInstruction', 'filledQuantity', 'price', 'tradeQuantity') == \
+        [(1001, 'AAPL', 'BUY', 30.0, 121.5, 30.0)]
+    assert ordersDF['accountId'].dtype == np.int64
+    assert ordersDF['enteredTime'][0] == pd.Timestamp('2021-03-01 14:30:01', tz='UTC')
+    assert ordersDF['positionEffect'][0] == 'OPENING'
+    assert ordersDF['assetType'][0] == 'EQUITY'
+
+
+def test_multi_leg_partial_fill():
+    # Two legs, the first filled in two executions, the second only partly
+    legs = [leg(1, 'BUY', 'AAPL', 30), leg(2, 'SELL', 'MSFT', 20)]
+    executions = [execution(1, 10, 121.5), execution(1, 20, 121.75), execution(2, 5, 230.0)]
+    ordersDF = utils.parse_transactions([order(1002, legs, executions, status='WORKING')])
+    assert rows(ordersDF, 'orderId', 'symbol', 'orderInstruction', 'filledQuantity', 'price', 'tradeQuantity') == [
+        (1002, 'AAPL', 'BUY', 10.0, 121.5, 30.0),
+        (1002, 'AAPL', 'BUY', 20.0, 121.75, 30.0),
+        (1002, 'MSFT', 'SELL', 5.0, 230.0, 20.0)]
+    assert set(ordersDF['orderStatus']) == {'WORKING'}
+
+
+def test_nested_oco_children():
+    # A trigger order with an OCO of two exits, one of which filled
+    stop = order(1005, [leg(1, 'SELL', 'AAPL', 30)], status='CANCELED', orderType='STOP')
+    limit = order(1004, [leg(1, 'SELL', 'AAPL', 30)], [execution(1, 30, 125.0)], orderType='LIMIT')
+    oco = order(1003, [], status='FILLED', orderStrategyType='OCO', children=[limit, stop])
+    parent = order(1002, [leg(1, 'BUY', 'AAPL', 30)], [execution(1, 30, 121.5)], children=[oco])
+    ordersDF = utils.parse_transactions([parent, order(1006, [leg(1, 'BUY', 'MSFT', 10)], [execution(1, 10, 230.0)])])
+    assert rows(ordersDF, 'orderId', 'orderInstruction', 'orderType', 'orderStatus', 'filledQuantity') == [
+        (1002, 'BUY', 'MARKET', 'FILLED', 30.0),
+        (1004, 'SELL', 'LIMIT', 'FILLED', 30.0),
+        (1005, 'SELL', 'STOP', 'CANCELED', 0.0),
+        (1006, 'BUY', 'MARKET', 'FILLED', 10.0)]
+    # The cancelled stop never executed, so it has no price
+    np.testing.assert_array_equal(ordersDF['price'], [121.5, 125.0, np.nan, 230.0])
+
+
+def test_no_orders():
+    ordersDF = utils.parse_transactions([])
+    assert ordersDF.shape == (0, len(storage.ORDER_COLUMNS))
+
+
+
+###############################
+#  BigQuery orderId dedupe    #
+###############################
+
+@pytest.fixture
+def fake_bigquery(monkeypatch):
+    # Stands in for the table: its orderIds, and what each load job appended
+    table = {'ids': {1001}, 'queried': [], 'loaded': []}
+
+    def existing(client, ordersDF, table_name=None):
+        table['queried'].append(sorted(set(ordersDF['orderId'])))
+        return [i for i in ordersDF['orderId'].unique() if i in table['ids']]
+
+    def load(client, ordersDF, table_name, write_disposition):
+        table['loaded'].append(ordersDF.copy())
+        table['ids'].update(ordersDF['orderId'])
+
+    monkeypatch.setattr(db.service_account.Credentials, 'from_service_account_info', lambda info: None)
+    monkeypatch.setattr(db, '_client', lambda credentials: None)
+    monkeypatch.setattr(db, '_existing_order_ids', existing)
+    monkeypatch.setattr(db, '_load_dataframe', load)
+    return table
+
+
+def test_order_index_round_trip(tmp_path):
+    path = str(tmp_path / 'order_index.npy')
+    index = db.OrderIdIndex(path)
+    index.add([3, 1, 2, 2])
+    index.save()
+    assert list(db.OrderIdIndex(path).contains([1, 2, 4])) == [True, True, False]
+
+
+def test_unreadable_order_index_is_ignored(tmp_path):
+    path = tmp_path / 'order_index.npy'
+    path.write_bytes(b'not an index')
+    assert len(db.OrderIdIndex(str(path)).ids) == 0
+
+
+def test_save_trades_skips_saved_orders(tmp_path, fake_bigquery):
+    index = db.OrderIdIndex(str(tmp_path / 'order_index.npy'))
+    legs = [leg(1, 'BUY', 'AAPL', 30), leg(2, 'SELL', 'MSFT', 20)]
+    ordersDF = utils.parse_transactions([
+        order(1001, [leg(1, 'BUY', 'NVDA', 30)], [execution(1, 30, 500.0)]),
+        order(1002, legs, [execution(1, 30, 121.5), execution(2, 20, 230.0)])])
+
+    # 1001 is already in the table, both rows of 1002 go in one load job
+    assert db.save_trades_gbq(ordersDF.copy(), index=index) == 2
+    assert fake_bigquery['queried'] == [[1001, 1002]]
+    assert list(fake_bigquery['loaded'][0]['orderId']) == [1002, 1002]
+    assert list(index.contains([1001, 1002])) == [True, True]
+
+    # Everything is in the index now, BigQuery isn't asked again
+    index = db.OrderIdIndex(str(tmp_path / 'order_index.npy'))
+    assert db.save_trades_gbq(ordersDF.copy(), index=index) == 0
+    assert len(fake_bigquery['queried']) == 1
+    assert len(fake_bigquery['loaded']) == 1
@@ -0,0 +1,76 @@
+import pytest
+
+import config
+import universe
+
+
+BASELINE = ['AAPL', 'MSFT', 'NVDA', 'XOM']
+
+
+@pytest.fixture
+def scraped(tmp_path, monkeypatch):
+    # tickers.txt and storage in tmp_path, the index page replaced by `scraped`
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'tickers.txt').write_text('Tickers\n' + '\n'.join(BASELINE) + '\n')
+    monkeypatch.setattr(config, 'STORAGE_URL', 'sqlite:///' + str(tmp_path / 'universe.db'))
+    monkeypatch.setattr(universe, 'UNIVERSE_MIN_SIZE', 1)
+
+    page = {'tickers': list(BASELINE), 'modified': True}
+    monkeypatch.setattr(universe, 'fetch_page', lambda url=None, cache_dir=None: ('', page['modified']))
+    monkeypatch.setattr(universe, 'parse_constituents', lambda html: page['tickers'])
+    return page
+
+
+def test_first_check_seeds_from_tickers_file(scraped):
+    scraped['tickers'] = BASELINE[:3] + ['TSLA']
+    (tickers, added, removed) = universe.refresh_universe('2021-03-01')
+    assert (added, removed) == (['TSLA'], ['XOM'])
+    # The scrape is only proposed, the snapshot is tickers.txt
+    assert universe.load_universe('2021-03-01') == BASELINE
+
+
+def test_changes_wait_for_approval(scraped):
+    universe.refresh_universe('2021-03-01')
+    scraped['tickers'] = BASELINE[:3] + ['TSLA']
+    assert universe.refresh_universe('2021-03-02')[1:] == (['TSLA'], ['XOM'])
+    assert universe.load_universe('2021-03-02') == BASELINE
+    assert universe.dropped_members(['XOM'], '2021-03-02') == []
+
+    assert universe.approve_universe('2021-03-03') == (['TSLA'], ['XOM'])
+    assert universe.load_universe('2021-03-03') == ['AAPL', 'MSFT', 'NVDA', 'TSLA']
+    assert universe.load_universe('2021-03-02') == BASELINE
+    # Nothing left to approve
+    assert universe.approve_universe('2021-03-04') is None
+
+
+def test_proposal_cleared_when_the_index_catches_up(scraped):
+    universe.refresh_universe('2021-03-01')
+    scraped['tickers'] = BASELINE + ['TSLA']
+    universe.refresh_universe('2021-03-02')
+    scraped['tickers'] = list(BASELINE)
+    assert universe.refresh_universe('2021-03-03')[1:] == ([], [])
+    assert universe.approve_universe('2021-03-04') is None
+
+
+def test_dropped_members(scraped):
+    # No snapshot yet, nothing is sold
+    assert universe.dropped_members(['XOM', 'GME']) == []
+
+    universe.refresh_universe('2021-03-01')
+    scraped['tickers'] = BASELINE[:3]
+    universe.refresh_universe('2021-03-02')
+    universe.approve_universe('2021-03-02')
+    # XOM left the index, GME was never in it, AAPL still is
+    assert universe.dropped_members(['AAPL', 'XOM', 'GME'], '2021-03-02') == ['XOM']
+    assert universe.dropped_members(['AAPL', 'XOM', 'GME'], '2021-03-01') == []
+
+
+def test_tickers_file_without_storage(scraped, monkeypatch):
+    monkeypatch.setattr(config, 'STORAGE_URL', 'unknown://nowhere')
+    assert universe.load_universe() == BASELINE
+    assert universe.ever_members() == sorted(BASELINE)
+    assert universe.dropped_members(['XOM']) == []
+
+    scraped['tickers'] = BASELINE[:3]
+    assert universe.refresh_universe('2021-03-01')[1:] == ([], ['XOM'])
+    assert universe.approve_universe() is None
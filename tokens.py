@@ -0,0 +1,198 @@
+import asyncio
+import contextvars
+import json
+import threading
+import time
+
+import requests
+
+import config
+import storage
+import tracing
+
+
+TD_TOKEN_REFRESH_MARGIN = 300   # seconds, replace the access token this long before it expires
+
+
+# TDA access tokens last 30 minutes. Every handler used to POST for a new one
+# up front and long runs could outlive it. TOKENS hands out one cached token
+# to every request helper (sync or async), refreshes it once ahead of expiry
+# no matter how many tasks notice at the same time, and persists it through
+# storage so the next invocation can reuse it. Without storage (it can't be
+# opened or read) tokens still work, from config.py and memory.
+
+
+
+#########################
+### Token endpoints  ####
+#########################
+
+def load_token(name, with_expiry=False):
+    # A saved token, None when there is none or storage is unavailable
+    try:
+        return storage.get_storage('tokens').load_token(name, with_expiry=with_expiry)
+    except Exception as e:
+        print('Could not load {} from storage: {!r}'.format(name, e))
+        return None
+
+
+def save_token(name, value, expires_in=None):
+    # Returns whether the token was saved, storage being unavailable isn't fatal
+    try:
+        storage.get_storage('tokens').save_token(name, value, expires_in=expires_in)
+        return True
+    except Exception as e:
+        print('Could not save {} to storage: {!r}'.format(name, e))
+        return False
+
+
+def get_refresh_token():
+    # The latest refresh token saved by the Refresh Token handler, else the one in config.py
+    refreshToken = load_token('refresh_token')
+    return refreshToken or config.TD_REFRESH_TOKEN
+
+
+def request_access_token():
+    # A brand new access token straight from TDA
+    url = '{}/oauth2/token'.format(config.TD_API_URL)
+    payload = {'grant_type': config.TD_GRANT_TYPE,
+              'client_id': config.TD_CLIENT_ID,
+              'refresh_token': get_refresh_token()
+    }
+    r = requests.post(url, data=payload, timeout=10, hooks=tracing.REQUESTS_HOOKS)
+    return json.loads(r.content)
+
+
+def request_new_refresh_token():
+    # TDA refresh tokens expire every 90 days, this trades the current one for a new one
+    url = '{}/oauth2/token'.format(config.TD_API_URL)
+    payload = {'grant_type': config.TD_GRANT_TYPE,
+              'client_id': config.TD_CLIENT_ID,
+              'refresh_token': get_refresh_token(),
+               'access_type': 'offline'
+    }
+    r = requests.post(url, data=payload, timeout=10, hooks=tracing.REQUESTS_HOOKS)
+    return json.loads(r.content)
+
+
+
+#####################
+### Token manager ###
+#####################
+
+class TokenManager:
+
+    def __init__(self, fetch=request_access_token, name='access_token', margin=TD_TOKEN_REFRESH_MARGIN, persist=True):
+        self.fetch = fetch
+        self.name = name
+        self.margin = margin
+        self.persist = persist
+        self.token = None
+        self.expires_at = 0.0        # wall clock, so a persisted expiry means the same thing next run
+        self._issued = set()         # tokens handed out by this manager, see resolve()
+        self._rejected = None
+        self._lock = threading.Lock()
+        self._asyncLock = None
+        self._asyncLoop = None
+
+    def fresh(self):
+        return self.token is not None and time.time() < self.expires_at - self.margin
+
+    def expires_in(self):
+        return max(0, int(self.expires_at - time.time()))
+
+    def get(self):
+        # Blocking, at most one refresh at a time across threads
+        if self.fresh():
+            return self.token
+        with self._lock:
+            if not self.fresh():
+                self._load()
+            if not self.fresh():
+                self._refresh()
+            return self.token
+
+    async def get_async(self):
+        # Tasks that find the token stale queue on one lock, the first one
+        # refreshes in a worker thread and the rest get its token
+        if self.fresh():
+            return self.token
+        async with self._async_lock():
+            if not self.fresh():
+                # copy_context keeps the refresh in this invocation's trace
+                await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run, self.get)
+        return self.token
+
+    def resolve(self, token=None):
+        # The token to actually send. Tokens this manager handed out (or None)
+        # are swapped for the current one, anything else is used as given.
+        if token is None or token in self._issued:
+            return self.get()
+        return token
+
+    async def resolve_async(self, token=None):
+        if token is None or token in self._issued:
+            return await self.get_async()
+        return token
+
+    def seed(self, token, expires_in):
+        # Adopt a token fetched elsewhere, e.g. passed in by a caller
+        with self._lock:
+            self._issued.add(token)
+            expiresAt = time.time() + expires_in
+            if expiresAt > self.expires_at:
+                self.token = token
+                self.expires_at = expiresAt
+
+    def invalidate(self, token):
+        # The API rejected `token` (401), the next get() fetches a new one
+        with self._lock:
+            if token == self.token:
+                self._rejected = token
+                self.expires_at = 0.0
+
+    def access(self):
+        # Same shape as the TDA token response
+        token = self.get()
+        return {'access_token': token, 'expires_in': self.expires_in()}
+
+    def _async_lock(self):
+        # asyncio.Lock belongs to one loop, and each asyncio.run makes a new one
+        loop = asyncio.get_running_loop()
+        if self._asyncLoop is not loop:
+            self._asyncLock = asyncio.Lock()
+            self._asyncLoop = loop
+        return self._asyncLock
+
+    def _load(self):
+        if not self.persist:
+            return
+        saved = load_token(self.name, with_expiry=True)
+        if saved is None or saved[0] == self._rejected or saved[1] is None:
+            return
+        (self.token, self.expires_at) = saved
+        self._issued.add(self.token)
+
+    def _refresh(self):
+        print('getting new token')
+        tracing.count('token_refreshes')
+        with tracing.span('token_refresh'):
+            newAccess = self.fetch()
+        if 'access_token' not in newAccess:
+            raise RuntimeError('Could not get an access token: {}'.format(newAccess))
+        self.token = newAccess['access_token']
+        self.expires_at = time.time() + newAccess['expires_in']
+        self._issued.add(self.token)
+        if self.persist:
+            save_token(self.name, self.token, expires_in=newAccess['expires_in'])
+
+
+TOKENS = TokenManager()
+
+
+def auth_header(token=None):
+    return {'Authorization': 'Bearer ' + TOKENS.resolve(token)}
+
+
+async def auth_header_async(token=None):
+    return {'Authorization': 'Bearer ' + await TOKENS.resolve_async(token)}
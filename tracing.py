@@ -0,0 +1,213 @@
+import contextvars
+import json
+import os
+import re
+import time
+
+import config
+
+
+# One trace per main() invocation: timed spans for each stage, every HTTP call
+# (endpoint, status, latency) and counters for retries and failures. finish()
+# prints it as a single JSON line, which Cloud Logging keeps as a structured
+# record, and appends it to config.TRACE_PATH so the 9:30 numbers can be
+# trended over weeks.
+#
+#   trace = tracing.start('Trading')
+#   with tracing.span('history_fetch'):
+#       ...
+#   tracing.count('order_retries')
+#   tracing.annotate('open_to_first_order', 0.8)
+#   tracing.finish()
+#
+# Outside a trace every call is a cheap no-op, so library code can always
+# call span / count / record_http.
+
+_current = contextvars.ContextVar('trace', default=None)
+
+# Symbols and account ids would make every URL unique
+ENDPOINT_PATTERNS = [
+    (re.compile(r'/marketdata/[^/]+/pricehistory'), '/marketdata/{symbol}/pricehistory'),
+    (re.compile(r'/accounts/[^/]*'), '/accounts/{account}'),
+]
+
+
+
+class Span:
+    def __init__(self, name, parent, offset):
+        self.name = name
+        self.parent = parent
+        self.offset = offset
+        self.seconds = None
+
+
+class Trace:
+
+    def __init__(self, message):
+        self.message = message
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.http = []
+        self.counters = {}
+        self.annotations = {}
+        self.error = None
+        self._stack = []
+
+    def to_record(self):
+        stages = {}
+        for s in self.spans:
+            if s.seconds is not None:
+                stages[s.name] = round(stages.get(s.name, 0) + s.seconds, 6)
+        return {'type': 'trading_bot_trace',
+                'message': self.message,
+                'started': self.started,
+                'seconds': round(time.perf_counter() - self.t0, 6),
+                'error': self.error,
+                'stages': stages,
+                'spans': [{'name': s.name, 'parent': s.parent, 'offset': round(s.offset, 6),
+                           'seconds': None if s.seconds is None else round(s.seconds, 6)} for s in self.spans],
+                'http': summarize_http(self.http),
+                'http_calls': self.http,
+                'counters': self.counters,
+                'annotations': self.annotations}
+
+
+
+#########################
+### Recording helpers ###
+#########################
+
+def start(message):
+    trace = Trace(message)
+    _current.set(trace)
+    return trace
+
+
+def current():
+    return _current.get()
+
+
+class span:
+    # with tracing.span('quotes') as s: ...  then s.seconds
+    def __init__(self, name):
+        self.name = name
+        self.span = None
+
+    def __enter__(self):
+        trace = _current.get()
+        self.t1 = time.perf_counter()
+        if trace is not None:
+            parent = trace._stack[-1].name if len(trace._stack) > 0 else None
+            self.span = Span(self.name, parent, self.t1 - trace.t0)
+            trace.spans.append(self.span)
+            trace._stack.append(self.span)
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.seconds = time.perf_counter() - self.t1
+        trace = _current.get()
+        if self.span is not None:
+            self.span.seconds = self.seconds
+            if trace is not None and self.span in trace._stack:
+                trace._stack.remove(self.span)
+        return False
+
+
+def count(name, n=1):
+    trace = _current.get()
+    if trace is not None:
+        trace.counters[name] = trace.counters.get(name, 0) + n
+
+
+def annotate(name, value):
+    # Free form values worth trending, e.g. seconds from the open to the first order
+    trace = _current.get()
+    if trace is not None:
+        trace.annotations[name] = value
+
+
+def endpoint(url):
+    path = url.split('?')[0]
+    path = path[len(config.TD_API_URL):] if path.startswith(config.TD_API_URL) else path
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return path
+
+
+def record_http(method, url, status, seconds):
+    trace = _current.get()
+    if trace is not None:
+        trace.http.append([method, endpoint(str(url)), status, round(seconds*1000, 2)])
+
+
+def summarize_http(calls):
+    # {endpoint: {calls, statuses, p50_ms, p95_ms, max_ms}}
+    grouped = {}
+    for method, path, status, ms in calls:
+        grouped.setdefault(method + ' ' + path, []).append((status, ms))
+    summary = {}
+    for key, rows in grouped.items():
+        latencies = sorted(ms for _, ms in rows)
+        statuses = {}
+        for status, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        summary[key] = {'calls': len(rows), 'statuses': statuses,
+                        'p50_ms': latencies[len(latencies)//2],
+                        'p95_ms': latencies[min(len(latencies)-1, int(len(latencies)*.95))],
+                        'max_ms': latencies[-1]}
+    return summary
+
+
+def finish(error=None, emit=True):
+    # Ends the current trace, returns its record
+    trace = _current.get()
+    if trace is None:
+        return None
+    trace.error = error
+    record = trace.to_record()
+    _current.set(None)
+    if emit:
+        line = json.dumps(record, default=str)
+        print(line)
+        if getattr(config, 'TRACE_PATH', None):
+            try:
+                os.makedirs(os.path.dirname(config.TRACE_PATH) or '.', exist_ok=True)
+                with open(config.TRACE_PATH, 'a') as f:
+                    f.write(line + '\n')
+            except OSError as e:
+                print('Could not save trace: ', e)
+    return record
+
+
+
+###########################
+### HTTP client hooks   ###
+###########################
+
+def _requests_hook(response, *args, **kwargs):
+    record_http(response.request.method, response.url, response.status_code, response.elapsed.total_seconds())
+    return response
+
+# requests.get(url, headers=..., hooks=tracing.REQUESTS_HOOKS)
+REQUESTS_HOOKS = {'response': _requests_hook}
+
+
+def aiohttp_trace_config():
+    # aiohttp.ClientSession(trace_configs=[tracing.aiohttp_trace_config()])
+    import aiohttp
+
+    async def on_start(session, ctx, params):
+        ctx.t1 = time.perf_counter()
+
+    async def on_end(session, ctx, params):
+        record_http(params.method, params.url, params.response.status, time.perf_counter() - ctx.t1)
+
+    async def on_exception(session, ctx, params):
+        record_http(params.method, params.url, type(params.exception).__name__, time.perf_counter() - ctx.t1)
+
+    traceConfig = aiohttp.TraceConfig()
+    traceConfig.on_request_start.append(on_start)
+    traceConfig.on_request_end.append(on_end)
+    traceConfig.on_request_exception.append(on_exception)
+    return traceConfig
@@ -0,0 +1,209 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+import pandas as pd
+
+import candles
+import config
+import metrics
+import orders
+import reconcile
+import tracing
+import universe
+import utils
+
+
+
+# The Trading run is split in two. Everything that doesn't depend on todays
+# open is done in prepare_trading before 9:30, so execute_trading only has to
+# get the quotes, take one EMA step per ticker, pick the trades and send them.
+# Quotes are polled until every symbol has an opening price and each batch of
+# newly opened symbols is traded straight away.
+
+class TradingPlan:
+    # Everything prepare_trading gathers before the open. store is None when
+    # the history was assembled elsewhere (see fanout.py), only state is needed
+    # to trade.
+    def __init__(self, tickers, store, today_day, state, positions, orders, failure_list, exits=(), reconciler=None):
+        self.tickers = tickers
+        self.store = store
+        self.today_day = today_day
+        self.state = state
+        self.positions = positions
+        self.orders = orders
+        self.failure_list = failure_list
+        self.exits = list(exits)      # held symbols that have left the universe, sold at the open
+        self.reconciler = reconciler  # turns buys / sells into share counts against the account snapshot
+
+
+
+##############################
+#  Phase 1: before the open  #
+##############################
+
+def prepare_trading(token, tickers, expires_in, dayWindow=3, quantity=30):
+    t1 = time.time()
+    (store, today_day, state, failure_list) = prepare_state(token, tickers, expires_in, dayWindow=dayWindow)
+    (positions, exits, reconciler, payloads) = prepare_orders(token, store.symbols, quantity=quantity)
+    t2 = time.time()
+    print('Time spent preparing before the open: ', round(t2-t1, 3), ' seconds')
+    # Only symbols whose history is up to date are quoted and traded
+    return TradingPlan(list(store.symbols), store, today_day, state, positions, payloads, failure_list, exits, reconciler)
+
+
+# The last EMA state saved or loaded per path, kept for the next run of a
+# resident process (daemon.py) unless the file changed underneath it.
+# EMA_STATE_PATH itself only saves the rebuild where it outlives the run (the
+# daemon, a local run): a Cloud Function's /tmp starts empty on every cold
+# start. The fan-out keeps its merged state in SHARD_DIR instead.
+_states = {}
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def load_state(path, dayWindow=3):
+    cached = _states.get(path)
+    mtime = _mtime(path)
+    if cached is not None and cached[0] == mtime and cached[1].window == dayWindow:
+        return cached[1]
+    state = metrics.EmaState.load(path, window=dayWindow)
+    if state is not None:
+        _states[path] = (mtime, state)
+    return state
+
+
+def save_state(state, path):
+    state.save(path)
+    _states[path] = (_mtime(path), state)
+
+
+def prepare_state(token, tickers, expires_in, dayWindow=3, quota=None):
+    # Returns (store, today_day, state, failure_list): the history matrix with
+    # todays column left empty for the opening quotes, and the EMA / slope
+    # state as of yesterday, stepped forward from the saved state when possible
+    (store, today_day, failure_list, adjusted) = utils.get_history_store(token, tickers, expires_in, quota=quota)
+
+    with tracing.span('ema_state'):
+        history = store.to_frame()
+        state = load_state(config.EMA_STATE_PATH, dayWindow=dayWindow)
+        state = metrics.sync_ema_state(state, history, window=dayWindow, rebuild=adjusted)
+        save_state(state, config.EMA_STATE_PATH)
+    return (store, today_day, state, failure_list)
+
+
+def prepare_orders(token, symbols, quantity=30):
+    # Returns (positions, exits, reconciler, payloads) for the account as it is now
+    print('Getting current positions: ')
+    with tracing.span('positions'):
+        snapshot = utils.get_account_snapshot(token=token)
+    positions = snapshot.symbols()
+    reconciler = reconcile.Reconciler(snapshot, quantity=quantity)
+    exits = universe.dropped_members(positions)
+    if len(exits) > 0:
+        print('Held symbols no longer in the index, selling at the open: ', exits)
+        # Their open buys would fill after the exit sells
+        openBuys = reconciler.open_buys(exits)
+        if len(openBuys) > 0:
+            print('Cancelling open buys of exiting symbols: ', len(openBuys))
+            utils.cancel_orders(token, openBuys)
+
+    # Every order we could possibly send today, ready to post
+    payloads = {}
+    for ticker in symbols:
+        payloads[(ticker, 'BUY')] = orders.build_order(ticker, 'BUY', quantity)
+        payloads[(ticker, 'SELL')] = orders.build_order(ticker, 'SELL', quantity)
+    return (positions, exits, reconciler, payloads)
+
+
+
+#############################
+#  Phase 2: after the open  #
+#############################
+
+def execute_trading(plan, token, deadline=utils.TD_OPEN_DEADLINE):
+    # Returns (buys, sells, todays metrics, order results)
+    with tracing.span('wait_for_open'):
+        utils.wait_for_market_open()
+    return asyncio.run(_execute_trading_async(plan, token, deadline))
+
+
+async def _execute_trading_async(plan, token, deadline):
+    market_open = utils.get_market_open(seconds_after=0).timestamp()
+    today = candles.day_to_datetime([plan.today_day])[0]
+    # State that stopped short of the latest bar (its history failed today)
+    # gives no signal, rather than a step across the missing days
+    lastDay = int(plan.state.last_day.max()) if len(plan.state) > 0 else None
+
+    t1 = time.time()
+    timings = {}
+    buys = []
+    sells = []
+    metricFrames = []
+    async with aiohttp.ClientSession(trace_configs=[tracing.aiohttp_trace_config()]) as session:
+        submitter = orders.OrderSubmitter(session, token, orders=plan.orders, timings=timings)
+        # Names that left the index don't need a quote, sell them right away
+        exitOrders = plan.reconciler.exit_orders(plan.exits)
+        submitter.sell(list(exitOrders), quantities=exitOrders)
+        sells.extend(exitOrders)
+        # Each symbol is decided and its order sent as soon as its open is known,
+        # instead of waiting for the slowest opening print
+        print('Get todays quotes...')
+        async for quotes in utils.acquire_open_prices(session, token, plan.tickers, deadline=deadline):
+            timings.setdefault('first_quote', time.time())
+            quotes['datetime'] = today
+            if plan.store is not None:
+                plan.store.set_day(plan.today_day, quotes['symbol'].values, quotes['open'].values, quotes['close'].values)
+
+            with tracing.span('metrics'):
+                todaysMetrics = metrics.step_ema_state(plan.state, quotes, last_day=lastDay)
+            with tracing.span('find_trades'):
+                (roundBuys, roundSells) = utils.find_trades(data_frame=todaysMetrics, token=token,
+                                                            tickers=plan.tickers, current_positions=plan.positions)
+            # Exact share counts net of what's held, open and already sent
+            (buyOrders, sellOrders) = plan.reconciler.orders(roundBuys, roundSells,
+                                                             prices=dict(zip(quotes['symbol'], quotes['open'])))
+            timings.setdefault('first_decision', time.time())
+            metricFrames.append(todaysMetrics)
+            buys.extend(buyOrders)
+            sells.extend(sellOrders)
+
+            # Buys wait for every sell sent so far
+            submitter.sell(list(sellOrders), quantities=sellOrders)
+            submitter.buy(list(buyOrders), quantities=buyOrders)
+
+        t2 = time.time()
+        with tracing.span('submission_drain'):
+            results = await submitter.results()
+    t3 = time.time()
+
+    if len(plan.reconciler.skipped) > 0:
+        print('Buys skipped, not enough buying power: ', plan.reconciler.skipped)
+        tracing.count('buys_skipped_buying_power', len(plan.reconciler.skipped))
+    print('Symbols to buy: ', len(buys), buys)
+    print('Symbols to sell: ', len(sells), sells)
+    orders.print_failures(results)
+    if 'first_quote' in timings:
+        print('First opening prices after the open: ', round(timings['first_quote']-market_open, 3), ' seconds')
+        print('First trade decisions after the open: ', round(timings['first_decision']-market_open, 3), ' seconds')
+        tracing.annotate('open_to_first_quote', round(timings['first_quote']-market_open, 3))
+        tracing.annotate('open_to_first_decision', round(timings['first_decision']-market_open, 3))
+    print('All opening prices in (or deadline hit) after: ', round(t2-t1, 3), ' seconds')
+    if 'first_order_sent' in timings:
+        print('Open to first order: ', round(timings['first_order_sent']-market_open, 3), ' seconds')
+        tracing.annotate('open_to_first_order', round(timings['first_order_sent']-market_open, 3))
+    print('Open to last order done: ', round(t3-market_open, 3), ' seconds')
+    tracing.annotate('open_to_last_order', round(t3-market_open, 3))
+    tracing.annotate('buys', len(buys))
+    tracing.annotate('sells', len(sells))
+
+    if len(metricFrames) == 0:
+        metricFrames.append(metrics.step_ema_state(plan.state, pd.DataFrame(columns=['symbol', 'open', 'close', 'datetime'])))
+    todaysMetrics = pd.concat(metricFrames, ignore_index=True)
+    return (buys, sells, todaysMetrics, results)
@@ -0,0 +1,262 @@
+import json
+import os
+import time
+
+import requests
+
+import config
+import storage
+import tracing
+
+
+# The trading universe is the S&P 500 as listed on Wikipedia. The Ticker check
+# fetches the page with If-None-Match / If-Modified-Since, so a quiet night
+# costs one 304 and only the constituents table is parsed when it did change.
+# The first check seeds the snapshots with tickers.txt. A scraped membership
+# that differs from the current snapshot is only proposed (and emailed), it
+# becomes a dated snapshot once approved with the 'Approve Tickers' message.
+# Everything else asks for the approved membership in effect on a date:
+#
+#   universe.load_universe()                 today's tickers (tickers.txt until the first snapshot)
+#   universe.load_universe('2021-03-01')     as of that day
+#   universe.dropped_members(positions)      held symbols that have since left the index
+#   universe.approve_universe()              apply the pending proposal
+#   universe.membership_matrix(symbols, days)  symbols x days bool, for the backtester
+
+TICKERS_FILE = 'tickers.txt'
+UNIVERSE_MAX_SYMBOL_LENGTH = 4
+UNIVERSE_MIN_SIZE = 400        # fewer constituents than this means the page layout changed, not the index
+
+
+
+#####################
+### The index page ##
+#####################
+
+def _cache_paths(cache_dir):
+    return (os.path.join(cache_dir, 'constituents.html'), os.path.join(cache_dir, 'constituents.json'))
+
+
+def _write_atomic(path, text):
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'w') as f:
+        f.write(text)
+    os.replace(tmpPath, path)
+
+
+def fetch_page(url=None, cache_dir=None):
+    # Returns (html, modified). The validators from the last 200 are sent back
+    # so an unchanged page comes back as an empty 304 and the cached copy is used.
+    url = url or config.UNIVERSE_URL
+    cache_dir = cache_dir or config.UNIVERSE_CACHE_DIR
+    (htmlPath, metaPath) = _cache_paths(cache_dir)
+
+    headers = {}
+    meta = {}
+    if os.path.exists(htmlPath) and os.path.exists(metaPath):
+        with open(metaPath) as f:
+            meta = json.load(f)
+        if meta.get('url') == url:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+    r = requests.get(url, headers=headers, timeout=30, hooks=tracing.REQUESTS_HOOKS)
+    if r.status_code == 304 and len(headers) > 0:
+        tracing.count('universe_not_modified')
+        with open(htmlPath) as f:
+            return (f.read(), False)
+    r.raise_for_status()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_atomic(htmlPath, r.text)
+    _write_atomic(metaPath, json.dumps({'url': url,
+                                        'etag': r.headers.get('ETag'),
+                                        'last_modified': r.headers.get('Last-Modified'),
+                                        'fetched': time.time()}))
+    return (r.text, True)
+
+
+def parse_constituents(html):
+    # Symbols from the first column of the constituents table. Only that table
+    # is handed to the parser, not the rest of the page.
+    from bs4 import BeautifulSoup
+
+    anchor = html.find('id="constituents"')
+    start = html.rfind('<table', 0, anchor)
+    end = html.find('</table>', anchor)
+    if anchor < 0 or start < 0 or end < 0:
+        raise ValueError('No constituents table on the page')
+
+    table = BeautifulSoup(html[start:end + len('</table>')], 'lxml')
+    symbols = []
+    for row in table.find_all('tr'):
+        cell = row.find('td')
+        if cell is not None:
+            symbols.append(cell.get_text(strip=True))
+    return symbols
+
+
+def tradable(symbols):
+    # No share classes (BRK.B) and at most 4 letters
+    return [s for s in symbols if '.' not in s and len(s) <= UNIVERSE_MAX_SYMBOL_LENGTH]
+
+
+
+#########################
+### Membership history ##
+#########################
+
+def read_tickers_file(path=TICKERS_FILE):
+    with open(path) as f:
+        lines = [line.strip() for line in f.read().splitlines()]
+    return [line for line in lines[1:] if line]
+
+
+def _storage():
+    # The tickers storage, None when it can't be opened. Trading, Kill and the
+    # daemon then run on tickers.txt rather than fail.
+    try:
+        return storage.get_storage('tickers')
+    except Exception as e:
+        print('Ticker storage unavailable, using {}: {!r}'.format(TICKERS_FILE, e))
+        return None
+
+
+def _snapshot(asof=None):
+    backend = _storage()
+    try:
+        return backend.load_tickers(asof) if backend is not None else []
+    except Exception as e:
+        print('Could not load the ticker snapshot, using {}: {!r}'.format(TICKERS_FILE, e))
+        return []
+
+
+def _history(end=None):
+    backend = _storage()
+    try:
+        return backend.load_ticker_history(end=end) if backend is not None else None
+    except Exception as e:
+        print('Could not load the ticker history: {!r}'.format(e))
+        return None
+
+
+def load_universe(asof=None):
+    # The membership in effect on `asof` (today by default): the latest
+    # snapshot on or before it, else tickers.txt (also when storage is unavailable)
+    tickers = _snapshot(asof)
+    if len(tickers) == 0:
+        tickers = read_tickers_file()
+    return tickers
+
+
+def ever_members(asof=None):
+    # Every symbol that has been in the universe up to `asof`, tickers.txt included
+    members = set(read_tickers_file())
+    history = _history(end=asof)
+    if history is not None:
+        members.update(history['symbol'])
+    return sorted(members)
+
+
+def dropped_members(held, asof=None):
+    # Held symbols that used to be in the universe but no longer are. Anything
+    # that was never in it (e.g. a discretionary trade) is left alone, and
+    # nothing is dropped until there is an approved snapshot.
+    snapshot = _snapshot(asof)
+    if len(snapshot) == 0:
+        return []
+    current = set(snapshot)
+    candidates = [s for s in held if s not in current]
+    if len(candidates) == 0:
+        return []
+    past = set(ever_members(asof))
+    return sorted(s for s in candidates if s in past)
+
+
+def refresh_universe(asof=None, url=None, cache_dir=None):
+    # Nightly check. Returns (tickers, added, removed), the scraped membership
+    # against the current snapshot. The first check saves tickers.txt as the
+    # first snapshot. A change is saved as the proposal waiting for
+    # approve_universe, it isn't traded until then. Without storage the
+    # changes are only reported against tickers.txt.
+    asof = asof or time.strftime('%Y-%m-%d')
+    backend = _storage()
+    previous = _snapshot(asof)
+    seeded = len(previous) == 0
+    if seeded:
+        previous = sorted(set(read_tickers_file()))
+        if backend is not None:
+            backend.save_tickers(asof, previous)
+            tracing.count('universe_snapshots')
+            print('Seeded the universe with {} tickers from {}'.format(len(previous), TICKERS_FILE))
+
+    with tracing.span('universe_fetch'):
+        (html, modified) = fetch_page(url, cache_dir)
+    if not modified and not seeded:
+        print('Index page not modified since the last check')
+        return (previous, [], [])
+
+    with tracing.span('universe_parse'):
+        tickers = tradable(parse_constituents(html))
+    if len(tickers) < UNIVERSE_MIN_SIZE:
+        raise ValueError('Only {} constituents parsed, not proposing them'.format(len(tickers)))
+
+    added = sorted(set(tickers) - set(previous))
+    removed = sorted(set(previous) - set(tickers))
+    if backend is None:
+        print('Ticker changes not saved for approval, update {} instead'.format(TICKERS_FILE))
+    elif len(added) > 0 or len(removed) > 0:
+        backend.save_proposed_tickers(asof, tickers)
+        tracing.count('universe_proposals')
+    else:
+        # The index caught up with the snapshot, nothing left to approve
+        backend.clear_proposed_tickers()
+    return (tickers, added, removed)
+
+
+def approve_universe(asof=None):
+    # Makes the pending proposal the snapshot from `asof` (today by default).
+    # Returns (added, removed) against the snapshot it replaces, None when
+    # nothing was waiting.
+    asof = asof or time.strftime('%Y-%m-%d')
+    backend = _storage()
+    if backend is None:
+        return None
+    (proposedAsof, tickers) = backend.load_proposed_tickers()
+    if len(tickers) == 0:
+        return None
+    previous = set(load_universe(asof))
+    backend.save_tickers(asof, tickers)
+    backend.clear_proposed_tickers()
+    tracing.count('universe_snapshots')
+    print('Approved the universe proposed on {}: {} tickers'.format(proposedAsof, len(tickers)))
+    return (sorted(set(tickers) - previous), sorted(previous - set(tickers)))
+
+
+def membership_matrix(symbols, days, history=None):
+    # symbols x days bool: was the symbol in the universe on that day (days as
+    # in candles.date_to_day). A snapshot holds until the next one, days before
+    # the first snapshot use the first one. No history at all means everyone
+    # is a member.
+    import numpy as np
+
+    if history is None:
+        history = _history()
+    symbols = np.asarray(symbols)
+    days = np.asarray(days)
+    if history is None or len(history) == 0:
+        return np.ones((len(symbols), len(days)), dtype='bool')
+
+    asofDays = history['asof'].values.astype('datetime64[D]').astype('int64')
+    snapDays = np.unique(asofDays)
+    snapIdx = np.searchsorted(snapDays, asofDays)
+    symbolIdx = {s: i for i, s in enumerate(symbols)}
+    rows = history['symbol'].map(symbolIdx)
+    known = rows.notna().values
+
+    snapshots = np.zeros((len(symbols), len(snapDays)), dtype='bool')
+    snapshots[rows[known].astype('int64').values, snapIdx[known]] = True
+    effective = np.clip(np.searchsorted(snapDays, days, side='right') - 1, 0, None)
+    return snapshots[:, effective]
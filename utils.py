@@ -1,18 +1,58 @@
 
 import config
+import candles
+import metrics
+import orders as orders_engine
+import ratelimit
+import reconcile
+import storage
+import tokens
+import tracing
+import universe
 
 import pandas as pd
-import requests
 import json
 import numpy as np
 from dateutil.relativedelta import relativedelta
 import time
 import urllib.parse
-import re
-from bs4 import BeautifulSoup
 import aiohttp
 import asyncio
-from scipy.stats import linregress
+import os
+
+
+
+###########################
+### API base URL switch ###
+###########################
+
+# Set TDA_API_URL (e.g. http://127.0.0.1:8080/v1) to point every request at
+# the local simulator instead of TD Ameritrade, see simulator.py
+if os.environ.get('TDA_API_URL'):
+    config.TD_API_URL = os.environ['TDA_API_URL']
+
+# When set, used instead of todays 9:30 ET open (pd.Timestamp, tz aware)
+MARKET_OPEN_OVERRIDE = None
+
+
+def use_simulator(url='http://127.0.0.1:8080/v1', open_in_seconds=5, data_dir='/tmp/trading_bot_sim',
+                  requests_per_minute=None):
+    # Points the bot at a local simulator, with its own candle cache, EMA
+    # state and local storage, and pretends the market opens `open_in_seconds` from now.
+    # requests_per_minute overrides the client side quota for faster runs.
+    config.TD_API_URL = url
+    config.CANDLE_CACHE_DIR = os.path.join(data_dir, 'candles')
+    config.EMA_STATE_PATH = os.path.join(data_dir, 'ema_state.npz')
+    config.SHARD_DIR = os.path.join(data_dir, 'shards')
+    config.STORAGE_URL = 'sqlite:///' + os.path.join(data_dir, 'trading_bot.db')
+    config.ORDERS_STORAGE_URL = config.STORAGE_URL
+    tokens.TOKENS = tokens.TokenManager()
+    os.makedirs(data_dir, exist_ok=True)
+
+    global MARKET_OPEN_OVERRIDE
+    MARKET_OPEN_OVERRIDE = pd.Timestamp.now(tz='America/New_York') + pd.Timedelta(seconds=open_in_seconds)
+    if requests_per_minute is not None:
+        ratelimit.configure(requests_per_minute, requests_per_minute)
 
 
 
@@ -20,7 +60,7 @@ from scipy.stats import linregress
 ### Order functions ####
 ########################
 def make_buy_order(symbol, token):
-    url = 'https://api.tdameritrade.com/v1/accounts/{}/orders'.format(config.TD_MARGIN_ACCOUNT)
+    url = '{}/accounts/{}/orders'.format(config.TD_API_URL, config.TD_MARGIN_ACCOUNT)
 
     order = {
       "orderType": "MARKET",
@@ -40,14 +80,14 @@ def make_buy_order(symbol, token):
       ]
     }    
     
-    headers= {'Authorization': 'Bearer '+ token}
-    r = requests.post(url, json=order, headers=headers)
+    headers= tokens.auth_header(token)
+    r = ratelimit.send(ratelimit.ORDERS, 'POST', url, json=order, headers=headers)
     return r.status_code
     
     
 
 def make_sell_order(symbol, token):
-    url = 'https://api.tdameritrade.com/v1/accounts/{}/orders'.format(config.TD_MARGIN_ACCOUNT)
+    url = '{}/accounts/{}/orders'.format(config.TD_API_URL, config.TD_MARGIN_ACCOUNT)
 
     order = {
       "orderType": "MARKET",
@@ -67,11 +107,25 @@ def make_sell_order(symbol, token):
       ]
     }    
     
-    headers= {'Authorization': 'Bearer '+ token}
-    r = requests.post(url, json=order, headers=headers)
+    headers= tokens.auth_header(token)
+    r = ratelimit.send(ratelimit.ORDERS, 'POST', url, json=order, headers=headers)
     return r.status_code
 
 
+def cancel_orders(token, orderIds):
+    # Cancels open orders by id, returns the ids TDA wouldn't cancel (e.g.
+    # already filled)
+    headers = tokens.auth_header(token)
+    failed = []
+    for orderId in orderIds:
+        url = '{}/accounts/{}/orders/{}'.format(config.TD_API_URL, config.TD_MARGIN_ACCOUNT, orderId)
+        r = ratelimit.send(ratelimit.ORDERS, 'DELETE', url, headers=headers)
+        if r.status_code >= 300:
+            print('Could not cancel order {}: {} {}'.format(orderId, r.status_code, r.text))
+            failed.append(orderId)
+    return failed
+
+
 
 ################################
 #### GET OPEN MARKET QUOTES ###
@@ -79,11 +133,11 @@ def make_sell_order(symbol, token):
 def get_quotes(token, tickers):
     allSymbolsEncoded = urllib.parse.quote(','.join(tickers), )
 
-    url = 'https://api.tdameritrade.com/v1/marketdata/quotes??apikey={}&symbol={}'.format(config.TD_CLIENT_ID,
+    url = '{}/marketdata/quotes?apikey={}&symbol={}'.format(config.TD_API_URL, config.TD_CLIENT_ID,
                                                                                          allSymbolsEncoded)
-    payload= {'Authorization': 'Bearer '+token}
+    payload= tokens.auth_header(token)
     
-    r = requests.get(url, headers=payload)
+    r = ratelimit.send(ratelimit.MARKET_DATA, 'GET', url, headers=payload)
     
     return json.loads(r.content)
     
@@ -93,15 +147,16 @@ def get_quotes(token, tickers):
 ### GET PRICE HISTORY ###
 #########################
 def get_price_history(ticker, token, start_date, end_date): 
-    url = 'https://api.tdameritrade.com/v1/marketdata/{}/pricehistory?apikey={}&periodType=month&frequencyType=daily&startDate={}&endDate={}'.format(
+    url = '{}/marketdata/{}/pricehistory?apikey={}&periodType=month&frequencyType=daily&startDate={}&endDate={}'.format(
+        config.TD_API_URL,
         ticker, 
         config.TD_CLIENT_ID,
         start_date,
         end_date
     )
  
-    payload= {'Authorization': 'Bearer '+token}
-    r = requests.get(url, data=payload)
+    payload= tokens.auth_header(token)
+    r = ratelimit.send(ratelimit.MARKET_DATA, 'GET', url, headers=payload)
     return json.loads(r.content)
     
 
@@ -111,10 +166,10 @@ def get_price_history(ticker, token, start_date, end_date):
 def get_positions(token):
     
     # New Account, no margin
-    url = 'https://api.tdameritrade.com/v1/accounts/{}?fields=positions'.format(config.TD_MARGIN_ACCOUNT)
+    url = '{}/accounts/{}?fields=positions'.format(config.TD_API_URL, config.TD_MARGIN_ACCOUNT)
     
-    payload= {'Authorization': 'Bearer '+token}
-    r = requests.get(url, headers=payload)
+    payload= tokens.auth_header(token)
+    r = ratelimit.send(ratelimit.MARKET_DATA, 'GET', url, headers=payload)
     
     accountInfo = json.loads(r.content)
     current_positions = []
@@ -130,19 +185,37 @@ def get_positions(token):
 
 
 
+def get_account_snapshot(token):
+    # Positions with quantities, open orders and buying power in one call
+    url = '{}/accounts/{}?fields=positions,orders'.format(config.TD_API_URL, config.TD_MARGIN_ACCOUNT)
+    
+    payload= tokens.auth_header(token)
+    r = ratelimit.send(ratelimit.MARKET_DATA, 'GET', url, headers=payload)
+    
+    accountInfo = json.loads(r.content)
+    return reconcile.AccountSnapshot.from_account(accountInfo)
+
+
+def get_position_quantities(token):
+    # {symbol: shares held long}, empty if the account has no positions
+    return get_account_snapshot(token).positions
+
+
+
 ##########################
 #### GET TRANSACTIONS ####
 ##########################
 
 def get_transactions(start_date, end_date, token):
     # historical transactions between dates
-    url = 'https://api.tdameritrade.com/v1/orders?accountId={}&fromEnteredTime={}&toEnteredTime={}&status=FILLED'.format(
+    url = '{}/orders?accountId={}&fromEnteredTime={}&toEnteredTime={}&status=FILLED'.format(
+        config.TD_API_URL,
         config.TD_MARGIN_ACCOUNT,
         start_date,
         end_date
     )
-    payload= {'Authorization': 'Bearer '+token}
-    r = requests.get(url, headers=payload)
+    payload= tokens.auth_header(token)
+    r = ratelimit.send(ratelimit.MARKET_DATA, 'GET', url, headers=payload)
     histOrders = json.loads(r.content)
     return histOrders
 
@@ -152,13 +225,8 @@ def get_transactions(start_date, end_date, token):
 ### GET ACCESS TOKEN ###
 ########################
 def get_access_token():
-    url = 'https://api.tdameritrade.com/v1/oauth2/token'
-    payload = {'grant_type': config.TD_GRANT_TYPE, 
-              'client_id': config.TD_CLIENT_ID,
-              'refresh_token': config.TD_REFRESH_TOKEN
-    }
-    r = requests.post(url, data=payload, timeout=10)
-    return json.loads(r.content)
+    # Cached and refreshed ahead of expiry by tokens.TOKENS, same shape as the TDA response
+    return tokens.TOKENS.access()
    
 
     
@@ -184,9 +252,11 @@ def get_dates(nMonths = 3):
 ###################
 ### FIND TRADES ###
 ###################
-def find_trades(data_frame, token, tickers):
+def find_trades(data_frame, token, tickers, current_positions=None):
+    # current_positions can be passed in when they were already pulled before the open,
+    # any collection of symbols ({symbol: shares} works too)
     
-    stock_data = data_frame.copy(deep=True)
+    stock_data = data_frame
 
     today = pd.to_datetime('today').strftime('%Y-%m-%d')
 
@@ -210,10 +280,11 @@ def find_trades(data_frame, token, tickers):
     sellSymbols = sellTickersDF['symbol'].values.tolist()
 
         
-    print('Getting current positions: ')
-    current_positions = get_positions(token=token)
+    if current_positions is None:
+        print('Getting current positions: ')
+        current_positions = get_positions(token=token)
     print('Number of current positions: ', len(current_positions))
-    print('Positions: ', current_positions)
+    print('Positions: ', list(current_positions))
 
 
     print('Getting BUY and SELL orders...')
@@ -226,8 +297,9 @@ def find_trades(data_frame, token, tickers):
         return (buySymbols, sellSymbols)
     
     else: 
-        positionsToSell = [s for s in sellSymbols if s in [p for p in current_positions]]
-        positionsToBuy = [x for x in buySymbols if x not in [y for y in current_positions]]
+        held = set(current_positions)
+        positionsToSell = [s for s in sellSymbols if s in held]
+        positionsToBuy = [x for x in buySymbols if x not in held]
         t5 = pd.to_datetime('today')
         print("Time spent getting todays trades: ", t5-t4)
         return (positionsToBuy, positionsToSell)
@@ -285,58 +357,171 @@ def make_trades(positionsToBuy, positionsToSell, token):
     return (positionsToBuy,positionsToSell)    
 
 
-async def make_trades_async(buySymbolsList, sellSymbolsList, token):
+async def make_trades_async(buySymbolsList, sellSymbolsList, token, orders=None, timings=None):
+    # orders: optional prebuilt payloads keyed by (ticker, trade_action)
+    # timings: optional dict, gets 'first_order_sent' (epoch seconds) filled in
+    # Returns one result dict per order, see orders.OrderSubmitter
 
     print('Symbols to buy: ',len(buySymbolsList), buySymbolsList)
     print('Symbols to sell: ',len(sellSymbolsList), sellSymbolsList)
 
-    buyDict = dict.fromkeys(buySymbolsList, "BUY")
-    sellDict = dict.fromkeys(sellSymbolsList, "SELL")
-    trades_dict = {**sellDict, **buyDict}
-    
-    url = 'https://api.tdameritrade.com/v1/accounts/{}/orders'.format(config.TD_MARGIN_ACCOUNT)
-    
-    async with aiohttp.ClientSession() as session:
-        # Sell first
-        post_tasks = []
-        
-        # prepare the coroutines that post
-        for ticker, trade_action in trades_dict.items():
-            post_tasks.append(do_post(session, url, ticker, trade_action, token))
-            
-        # now execute them all at once
-        await asyncio.gather(*post_tasks)
-
-    
-    
-async def do_post(session, url, ticker, trade_action, token):
-    async with session.post(url, 
-                            json ={"orderType": "MARKET",
-                                   "session": "NORMAL",
-                                    "duration": "DAY",
-                                    "orderStrategyType": "SINGLE",
-                                    "orderLegCollection": [{
-                                          "instruction": trade_action,
-                                          "quantity": 30,
-                                          "instrument": {
-                                            "symbol": ticker,
-                                            "assetType": "EQUITY"
-                                          }
-                                    }]
-                                  },
-                            headers= {'Authorization': 'Bearer '+ token}
-                           ) as response:
-        if response.status != 201:
-            print("Failed to make trade for {}".format(ticker))
-        
+    async with aiohttp.ClientSession(trace_configs=[tracing.aiohttp_trace_config()]) as session:
+        # Sell first, the buys wait until every sell has gone through
+        submitter = orders_engine.OrderSubmitter(session, token, orders=orders, timings=timings)
+        submitter.sell(sellSymbolsList)
+        submitter.buy(buySymbolsList)
+        results = await submitter.results()
+
+    orders_engine.print_failures(results)
+    return results
+
+
+
+###################################
+### ASYNC PRICE HISTORY FETCHER ###
+###################################
+
+TD_MAX_IN_FLIGHT = 10
+
+
+async def fetch_price_history(session, quota, semaphore, token, ticker, start_date, end_date):
+    url = '{}/marketdata/{}/pricehistory?apikey={}&periodType=month&frequencyType=daily&startDate={}&endDate={}'.format(
+        config.TD_API_URL,
+        ticker, 
+        config.TD_CLIENT_ID,
+        start_date,
+        end_date
+    )
+    async with semaphore:
+        refreshed = False
+        throttles = 0
+        while True:
+            headers = await tokens.auth_header_async(token)
+            await quota.acquire_async()
+            async with session.get(url, headers=headers) as response:
+                quota.observe(response.status, response.headers.get('Retry-After'))
+                if response.status == 401 and not refreshed:
+                    refreshed = True
+                    tracing.count('unauthorized')
+                    # Expired under us, every task waiting on the token gets the new one
+                    tokens.TOKENS.invalidate(headers['Authorization'][len('Bearer '):])
+                    continue
+                if response.status == ratelimit.THROTTLED and throttles < ratelimit.TD_THROTTLE_RETRIES:
+                    # The bucket now holds everyone back until Retry-After
+                    throttles += 1
+                    continue
+                # Straight from the response bytes to arrays, see candles.decode_candles
+                return candles.decode_candles(await response.read())
+
+
+async def get_price_histories_async(tickers, token, expires_in, start_date, end_date, failure_list,
+                                    max_in_flight=TD_MAX_IN_FLIGHT, quota=None, start_dates=None):
+    # Returns {symbol: (days, opens, closes)}. Symbols that fail are appended to failure_list.
+    # start_dates optionally overrides start_date per symbol (epoch ms).
+    start_dates = start_dates or {}
+    quota = quota or ratelimit.MARKET_DATA
+    semaphore = asyncio.Semaphore(max_in_flight)
+    if token is not None and expires_in is not None:
+        tokens.TOKENS.seed(token, expires_in)
+
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    async with aiohttp.ClientSession(connector=connector, trace_configs=[tracing.aiohttp_trace_config()]) as session:
+        fetch_tasks = [fetch_price_history(session, quota, semaphore, token, t, 
+                                           start_dates.get(t, start_date), end_date) 
+                       for t in tickers]
+        results = await asyncio.gather(*fetch_tasks, return_exceptions=True)
+
+    histories = {}
+    for symbol, result in zip(tickers, results):
+        if isinstance(result, Exception) or result is None:
+            print('Couldnt retrieve data for: ', symbol)
+            tracing.count('history_failures')
+            failure_list.append(symbol)
+        else:
+            histories[symbol] = result
+    return histories
+
+
+
+##################################
+### OPENING PRICE ACQUISITION ###
+##################################
+
+TD_QUOTE_BATCH_SIZE = 100
+TD_OPEN_DEADLINE = 30       # seconds to keep polling for missing opening prices
+TD_OPEN_POLL_INTERVAL = 0.25
+
+
+async def fetch_quotes(session, token, tickers):
+    allSymbolsEncoded = urllib.parse.quote(','.join(tickers), )
+    url = '{}/marketdata/quotes?apikey={}&symbol={}'.format(config.TD_API_URL, config.TD_CLIENT_ID,
+                                                                                         allSymbolsEncoded)
+    for attempt in range(ratelimit.TD_THROTTLE_RETRIES + 1):
+        await ratelimit.MARKET_DATA.acquire_async()
+        async with session.get(url, headers=await tokens.auth_header_async(token)) as response:
+            ratelimit.MARKET_DATA.observe(response.status, response.headers.get('Retry-After'))
+            if response.status != ratelimit.THROTTLED:
+                return candles.decode_quotes(await response.read())
+    return ([], np.zeros(0), np.zeros(0))
+
+
+async def acquire_open_prices(session, token, tickers, deadline=TD_OPEN_DEADLINE, 
+                              batch_size=TD_QUOTE_BATCH_SIZE, poll_interval=TD_OPEN_POLL_INTERVAL):
+    # Async generator. Quotes the universe in parallel batches and yields a
+    # symbol, open, close frame each time new symbols have a usable openPrice.
+    # Only the symbols still missing an open are quoted again, until `deadline`
+    # seconds have passed. Symbols that never open are printed and left out.
+    missing = list(dict.fromkeys(tickers))
+    stopAt = time.monotonic() + deadline
+    attempt = 0
+    while len(missing) > 0:
+        attempt += 1
+        batches = [missing[i:i+batch_size] for i in range(0, len(missing), batch_size)]
+        with tracing.span('quotes'):
+            results = await asyncio.gather(*[fetch_quotes(session, token, b) for b in batches], 
+                                           return_exceptions=True)
+        tracing.count('quote_polls')
+        opened = []
+        for result in results:
+            if isinstance(result, Exception):
+                print('Quote request failed: ', result)
+                tracing.count('quote_failures')
+                continue
+            (symbols, opens, lasts) = result
+            with np.errstate(invalid='ignore'):
+                valid = np.isfinite(opens) & (opens > 0)
+            if valid.any():
+                opened.append(pd.DataFrame({'symbol': np.array(symbols, dtype='object')[valid],
+                                            'open': opens[valid], 'close': lasts[valid]}))
+
+        if len(opened) > 0:
+            opened = pd.concat(opened, ignore_index=True)
+            openedSet = set(opened['symbol'])
+            missing = [s for s in missing if s not in openedSet]
+            yield opened
+
+        if len(missing) == 0:
+            break
+        if time.monotonic() + poll_interval > stopAt:
+            print('No opening price after {} attempts for: '.format(attempt), missing)
+            tracing.count('quote_missing_open', len(missing))
+            break
+        await asyncio.sleep(poll_interval)
+
 
 
 ##########################
 #####  THE WORKHORSE  ####
 #####  GET STOCK DATA ####
 ##########################
-def get_stocks(token, tickers, expires_in):
-
+def get_history_store(token, tickers, expires_in, refresh=False, repair=False, quota=None):
+    # Everything get_stocks does before the open. Returns (store, today_day, failure_list, adjusted)
+    # where store has an empty column for today waiting on the opening quotes and
+    # adjusted lists the symbols whose history TDA rewrote (a split or dividend)
+    # since we cached it, so their saved EMA state has to be rebuilt.
+    # refresh: ignore the local candle cache and pull the full window again
+    # repair:  refetch the full window for symbols with holes in their cached history
+    # quota:   a ratelimit bucket for the history requests, ratelimit.MARKET_DATA by default
     
     (today_date, 
      sdate, 
@@ -347,71 +532,79 @@ def get_stocks(token, tickers, expires_in):
     
     
     failure_list=[]
-    fullDateDF = pd.DataFrame(columns = ['open', 'close', 'datetime', 'symbol'])
     
-    # Get current time.  We'll need to get a new token 
+    # Only ask the API for the days after the last cached bar, plus that bar as a check
     t1 = pd.to_datetime('today')
-    throttleTracker1 = pd.to_datetime('today')
-    for n,t in enumerate(tickers):
-        
-        
-        if ( (n>0) & (n % 22 ==0) ):
-            print(n)
-            if (n % 110 == 0):
-                throttleTracker2 = pd.to_datetime('today')
-                secondsPassed = (throttleTracker2-throttleTracker1).total_seconds()
-                if secondsPassed < 60: 
-                    print('Interation: ', n)
-                    print('Need to slow down, pausing for : ', 60-secondsPassed, ' seconds')
-                    time.sleep(60-secondsPassed)
-                    throttleTracker1 = pd.to_datetime('today')
-
-            
-
-        # Determine if we need to get 
-        t2 = pd.to_datetime('today')
-        seconds_passed = (t2-t1).total_seconds()
-        if (seconds_passed > expires_in*.90): 
-            print('getting new token')
-            print((t2-t1).total_seconds())
-            newAccess = get_access_token()
-            t1 = pd.to_datetime('today')
-            access_token = newAccess['access_token']
-            expires_in = newAccess['expires_in']
-
-        symbol = t
-        try:
-
-            hist_data = get_price_history(ticker=symbol, 
-                                          token=token, 
-                                          start_date=int(sdate), 
-                                          end_date=int(edate))
-            
-            hist_data = pd.read_json(json.dumps(hist_data['candles']), orient='records')
-            hist_data['datetime'] = pd.to_datetime(hist_data['datetime'].dt.strftime("%Y-%m-%d"))
-            hist_data = hist_data.sort_values(by='datetime', ascending=False).reset_index(drop=True)
-            hist_data['symbol'] = symbol
-            hist_data = hist_data[['open', 'close', 'datetime', 'symbol']]
-            
-            try: 
-                fullDateDF = fullDateDF.append(hist_data, ignore_index=True)
-                
-            except: 
+    start_day = candles.epoch_ms_to_day(sdate)
+    end_day = candles.epoch_ms_to_day(edate)
+    cache = candles.get_cache(config.CANDLE_CACHE_DIR)
+    fetchPlan = cache.plan_fetch(tickers, start_day, end_day, refresh=refresh, repair=repair)
+    print('Symbols needing new candles: ', len(fetchPlan))
+
+    # Pull them concurrently, paced by the TDA per-minute quota
+    start_dates = {s: candles.day_to_epoch_ms(d) for s, d in fetchPlan.items()}
+    tracing.count('history_symbols_fetched', len(fetchPlan))
+    with tracing.span('history_fetch'):
+        histories = asyncio.run(get_price_histories_async(tickers=list(fetchPlan), 
+                                                          token=token,
+                                                          expires_in=expires_in,
+                                                          start_date=int(sdate),
+                                                          end_date=int(edate),
+                                                          failure_list=failure_list,
+                                                          start_dates=start_dates,
+                                                          quota=quota))
+
+    adjusted = []
+    with tracing.span('cache_update'):
+        for symbol, hist_data in histories.items():
+            try:
+                if not cache.update(symbol, hist_data, fetched_from=fetchPlan[symbol]):
+                    adjusted.append(symbol)
+            except:
                 print('Failed to combine data for: ', symbol)
                 failure_list.append(symbol)
 
-        except:
-            print('Couldnt retrieve data for: ', symbol)
-            failure_list.append(symbol)
+    # Cached bars on the old scale would show a split as a crash, so those
+    # symbols start over from the full window
+    if len(adjusted) > 0:
+        print('Price history adjusted since it was cached, refetching: ', adjusted)
+        tracing.count('history_adjusted', len(adjusted))
+        with tracing.span('history_refetch'):
+            refetched = asyncio.run(get_price_histories_async(tickers=adjusted,
+                                                              token=token,
+                                                              expires_in=expires_in,
+                                                              start_date=int(sdate),
+                                                              end_date=int(edate),
+                                                              failure_list=failure_list,
+                                                              quota=quota))
+        for symbol, hist_data in refetched.items():
+            cache.update(symbol, hist_data, fetched_from=start_day, replace=True)
+
+    # A symbol we couldn't bring up to date is left out rather than traded on stale bars.
+    # Todays column is reserved now and filled from the opening quotes.
+    failedSet = set(failure_list)
+    today_day = candles.date_to_day(today_date)
+    with tracing.span('history_assembly'):
+        store = candles.CandleStore.from_cache(cache, [t for t in tickers if t not in failedSet], 
+                                               start_day, end_day, extra_days=[today_day])
             
-    t3 = pd.to_datetime('today')    
-    print('Time to finish getting historical data: ', t3-t1)  
+    t2 = pd.to_datetime('today')    
+    print('Time to finish getting historical data: ', t2-t1)  
+    return (store, today_day, failure_list, adjusted)
+
+
+def get_market_open(seconds_after=1):
+    # Todays open in Eastern time, plus the small delay we give the opening prints
+    if MARKET_OPEN_OVERRIDE is not None:
+        return MARKET_OPEN_OVERRIDE + pd.Timedelta(seconds=seconds_after)
+    today = pd.to_datetime('today').strftime('%Y-%m-%d')
+    return pd.Timestamp(today + ' 9:30:00', tz='America/New_York') + pd.Timedelta(seconds=seconds_after)
 
-    
-    # Put in the time delay here to wait 9:30am EST    
 
-    market_open = pd.Timestamp(pd.to_datetime('today').strftime('%Y-%m-%d')+ ' 9:30:01', tz='America/New_York') #Add one second
-    current_time = pd.Timestamp(pd.to_datetime('today'), tz='UTC').tz_convert('America/New_York') #UTC by default, convert to Easter
+def wait_for_market_open(seconds_after=1):
+    # Put in the time delay here to wait 9:30am EST    
+    market_open = get_market_open(seconds_after) #Add one second
+    current_time = pd.Timestamp.now(tz='America/New_York')
     time_to_wait = (market_open - current_time).total_seconds()
     print('Market opens at: ', market_open)
     print('Current time (Eastern): ', current_time)
@@ -421,70 +614,56 @@ def get_stocks(token, tickers, expires_in):
         print('pause for {} seconds..'.format(pauseAmount))
         time.sleep(pauseAmount)
 
-    
+
+def get_todays_quotes(token, tickers):
+    # Opening quotes as a symbol, open, close frame
+    current_quotes = get_quotes(token=token, tickers=tickers)
+    (symbols, opens, lasts) = candles.decode_quotes(current_quotes)
+    return pd.DataFrame({'open': opens, 'close': lasts, 'symbol': symbols})
+
+
+def get_stocks(token, tickers, expires_in, refresh=False, repair=False):
+    # Returns (frame, adjusted), hand adjusted to calc_todays_metrics as rebuild
+
+    (store, today_day, failure_list, adjusted) = get_history_store(token, tickers, expires_in, 
+                                                                   refresh=refresh, repair=repair)
+    t3 = pd.to_datetime('today')    
+
+    wait_for_market_open()
     
     # Now I need to go get todays data: 
     print('Get todays quotes...')
-    current_quotes = get_quotes(token=token, tickers=tickers)
-    currentQuoteDF = pd.read_json(json.dumps(current_quotes), orient='index')
-    currentQuoteDF = currentQuoteDF[['openPrice', 'lastPrice', 'symbol']].reset_index(drop=True)
-    currentQuoteDF['datetime'] = today_date.strftime(format='%Y-%m-%d')
+    currentQuoteDF = get_todays_quotes(token=token, tickers=tickers)
     print(currentQuoteDF)
-    currentQuoteDF = currentQuoteDF.rename(columns ={'openPrice': 'open', 'lastPrice': 'close'})
     
     # Put the historical data and the new current market data
-    fullDateDF = fullDateDF.append(currentQuoteDF, ignore_index=True, sort=False
-                                  ).drop_duplicates().reset_index(drop=True
-                                  ).sort_values(by=['symbol', 'datetime'], ascending=False
-                                  ).reset_index(drop=True)
-    
-    fullDateDF['datetime'] = pd.to_datetime(fullDateDF['datetime'])
+    store.set_day(today_day, currentQuoteDF['symbol'].values, 
+                  currentQuoteDF['open'].values, currentQuoteDF['close'].values)
+    fullDateDF = store.to_frame()
     
     t4 = pd.to_datetime('today')    
     print('Time spent getting current market quotes: ', t4-t3)  
     
     print("Done!")
     
-    return fullDateDF
+    return (fullDateDF, adjusted)
 
 
 #############################
 #       Trade Metrics       #
 #############################
 
-def get_slope(array):
-    y = np.array(array)
-    x = np.arange(len(y))
-    slope, intercept, r_value, p_value, std_err = linregress(x,y)
-    return slope
-
 def calc_trade_metrics(stock_data, dayWindow=3):
     
     print('Calculating trade metrics...')
     t1=pd.to_datetime('today')
-    # Sort the data first
-    stock_data = stock_data.sort_values(by=['symbol', 'datetime'], ascending=True).reset_index(drop=True)
-    
-    # Now let's start calculating metrics
-    stock_data['EMA_Close'] = stock_data.groupby('symbol')['close'].apply(lambda x: x.ewm(span=9).mean())
-    stock_data['EMA_Open'] = stock_data.groupby('symbol')['open'].apply(lambda x: x.ewm(span=9).mean())
-    
-    stock_data = stock_data.sort_values(by=['symbol', 'datetime'], ascending=False).reset_index(drop=True)
 
-    # 3 Day window for calculating the slope
-    stock_data['slope'] = stock_data.sort_values(by=['symbol', 'datetime'], ascending=True
-                                       ).groupby('symbol')['EMA_Open'
-                                       ].rolling(window=dayWindow
-                                       ).apply(get_slope, raw=False
-                                       ).reset_index(0, drop=True)
-    
-    
-    # This is really only necessary when first starting the model. 
-    # What we're doing here is to only buy the stocks that are transitioning from
-    # a downward slope to a upward slope.
-    # If a stock is already on an upward slope, we're going to skip it. 
-    stock_data['prior_slope'] = stock_data.groupby('symbol')['slope'].apply(lambda x: x.shift(-1))
-    stock_data['prior_slope_sign'] = np.sign(stock_data['prior_slope'])
+    # EMA_Close, EMA_Open, slope, prior_slope, prior_slope_sign in one vectorized pass.
+    # metrics.check_parity compares this against the original groupby/linregress version.
+    # prior_slope is only really necessary when first starting the model: we only
+    # buy the stocks that are transitioning from a downward slope to a upward slope.
+    stock_data = metrics.calc_trade_metrics(stock_data, dayWindow=dayWindow)
+
     t2=pd.to_datetime('today')
     print('Time calculating todays trades: ', (t2-t1))
     print(stock_data.head(1))
@@ -493,6 +672,32 @@ def calc_trade_metrics(stock_data, dayWindow=3):
 
 
 
+def calc_todays_metrics(stock_data, dayWindow=3, rebuild=None):
+    # Same columns as calc_trade_metrics but only for todays rows. The EMA sums are
+    # saved between runs, so this is one recurrence step per ticker rather than a
+    # pass over the whole history. Missing or stale state is rebuilt from stock_data.
+    
+    print('Calculating todays trade metrics...')
+    t1=pd.to_datetime('today')
+    today = pd.to_datetime(pd.to_datetime('today').strftime('%Y-%m-%d'))
+    dates = pd.to_datetime(stock_data['datetime'])
+    history = stock_data[dates < today]
+    todays = stock_data[dates == today]
+
+    state = metrics.EmaState.load(config.EMA_STATE_PATH, window=dayWindow)
+    state = metrics.sync_ema_state(state, history, window=dayWindow, rebuild=rebuild)
+    state.save(config.EMA_STATE_PATH)
+    t2=pd.to_datetime('today')
+    print('Time syncing EMA state: ', (t2-t1))
+
+    lastDay = metrics.to_day_numbers(history['datetime']).max() if len(history) > 0 else None
+    todaysMetrics = metrics.step_ema_state(state, todays, last_day=lastDay)
+    t3=pd.to_datetime('today')
+    print('Time calculating todays trades: ', (t3-t2))
+    return todaysMetrics
+
+
+
 ###################
 # Historical Trades 
 ###################
@@ -503,46 +708,73 @@ def get_historical_trades_DF(start_date, end_date, token):
     historicalTrades = get_transactions(start_date=start_date, 
                                         end_date=end_date, 
                                         token = token)
-    
-    # Create the DF
-    ordersDF = pd.DataFrame(columns=['accountId', 'closeTime', 'enteredTime', 'filledQuantity' ,
-                                 'price', 'orderId', 'orderInstruction', 'symbol', 'positionEffect', 
-                                'assetType', 'orderType', 'orderStatus', 'tradeQuantity'])
-    
-    # Loop through the transactions and save into the DF
-    for i, o in enumerate(historicalTrades):
-        ordersDF.loc[i, 'accountId'] = o['accountId']
-        ordersDF.loc[i, 'closeTime'] = o['closeTime']
-        ordersDF.loc[i, 'enteredTime'] = o['enteredTime']
-        ordersDF.loc[i, 'filledQuantity'] = o['filledQuantity']
-
-        # TODO: if I begin to order more than 1 share I will need
-        #       to loop through the order activitiy execution leegs
-        ordersDF.loc[i, 'price'] = o['orderActivityCollection'][0]['executionLegs'][0]['price']
-        ordersDF.loc[i, 'orderId'] = o['orderId']
-        # TODO: need to loop through order leg connection if have more than 1 share
-        ordersDF.loc[i, 'orderInstruction'] = o['orderLegCollection'][0]['instruction']
-        ordersDF.loc[i, 'symbol'] = o['orderLegCollection'][0]['instrument']['symbol']
-        ordersDF.loc[i, 'positionEffect'] = o['orderLegCollection'][0]['positionEffect']
-        ordersDF.loc[i, 'assetType'] = o['orderLegCollection'][0]['orderLegType'] #Asset Type
-        ordersDF.loc[i, 'orderType'] = o['orderType']
-        ordersDF.loc[i, 'orderStatus'] = o['status']
-        ordersDF.loc[i, 'tradeQuantity'] = o['quantity']
-         
-    # Set the variable types for the DB
-    ordersDF['accountId'] = ordersDF['accountId'].astype('int')
-    ordersDF['closeTime'] = pd.to_datetime(ordersDF['closeTime'])
-    ordersDF['enteredTime'] = pd.to_datetime(ordersDF['enteredTime'])
-    ordersDF['filledQuantity'] = ordersDF['filledQuantity'].astype('float')
-    ordersDF['price'] = ordersDF['price'].astype('float')
-    ordersDF['orderId'] = ordersDF['orderId'].astype('int')
-    ordersDF['orderInstruction'] = ordersDF['orderInstruction'].astype('str')
-    ordersDF['symbol'] = ordersDF['symbol'].astype('str')
-    ordersDF['positionEffect'] = ordersDF['positionEffect'].astype('str')
-    ordersDF['assetType'] = ordersDF['assetType'].astype('str')
-    ordersDF['orderType'] = ordersDF['orderType'].astype('str')
-    ordersDF['orderStatus'] = ordersDF['orderStatus'].astype('str')
-    ordersDF['tradeQuantity'] = ordersDF['tradeQuantity'].astype('float')
+    return parse_transactions(historicalTrades)
+
+
+TDA_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+
+def _walk_orders(historicalTrades):
+    # Orders plus any nested child orders (OCO / TRIGGER strategies)
+    stack = list(reversed(historicalTrades))
+    while stack:
+        o = stack.pop()
+        yield o
+        stack.extend(reversed(o.get('childOrderStrategies', [])))
+
+
+def parse_transactions(historicalTrades):
+    # Orders JSON from get_transactions -> one row per execution leg, typed for the DB.
+    # filledQuantity / price are the fill, tradeQuantity is what the matching
+    # order leg asked for. Orders without executions get one row per order leg
+    # with no price.
+    cols = {c: [] for c in storage.ORDER_COLUMNS}
+
+    for o in _walk_orders(historicalTrades):
+        legs = o.get('orderLegCollection', [])
+        legsById = {leg.get('legId', n+1): leg for n, leg in enumerate(legs)}
+
+        fills = []
+        for activity in o.get('orderActivityCollection', []):
+            if activity.get('activityType', 'EXECUTION') != 'EXECUTION':
+                continue
+            for ex in activity.get('executionLegs', []):
+                leg = legsById.get(ex.get('legId'), legs[0] if len(legs) > 0 else {})
+                fills.append((leg, ex.get('quantity', np.nan), ex.get('price', np.nan)))
+        if len(fills) == 0:
+            fills = [(leg, o.get('filledQuantity', np.nan), np.nan) for leg in legs]
+
+        for (leg, filled, price) in fills:
+            cols['accountId'].append(o['accountId'])
+            cols['closeTime'].append(o.get('closeTime'))
+            cols['enteredTime'].append(o.get('enteredTime'))
+            cols['filledQuantity'].append(filled)
+            cols['price'].append(price)
+            cols['orderId'].append(o['orderId'])
+            cols['orderInstruction'].append(leg.get('instruction'))
+            cols['symbol'].append(leg.get('instrument', {}).get('symbol'))
+            cols['positionEffect'].append(leg.get('positionEffect'))
+            cols['assetType'].append(leg.get('orderLegType')) #Asset Type
+            cols['orderType'].append(o.get('orderType'))
+            cols['orderStatus'].append(o.get('status'))
+            cols['tradeQuantity'].append(leg.get('quantity', o.get('quantity', np.nan)))
+
+    # Set the variable types for the DB, same as db._formatTradesForDB
+    ordersDF = pd.DataFrame({
+        'accountId': np.array(cols['accountId'], dtype='int64'),
+        'closeTime': pd.to_datetime(cols['closeTime'], format=TDA_TIME_FORMAT),
+        'enteredTime': pd.to_datetime(cols['enteredTime'], format=TDA_TIME_FORMAT),
+        'filledQuantity': np.array(cols['filledQuantity'], dtype='float64'),
+        'price': np.array(cols['price'], dtype='float64'),
+        'orderId': np.array(cols['orderId'], dtype='int64'),
+        'orderInstruction': np.array(cols['orderInstruction'], dtype='str').astype(object),
+        'symbol': np.array(cols['symbol'], dtype='str').astype(object),
+        'positionEffect': np.array(cols['positionEffect'], dtype='str').astype(object),
+        'assetType': np.array(cols['assetType'], dtype='str').astype(object),
+        'orderType': np.array(cols['orderType'], dtype='str').astype(object),
+        'orderStatus': np.array(cols['orderStatus'], dtype='str').astype(object),
+        'tradeQuantity': np.array(cols['tradeQuantity'], dtype='float64'),
+    }, columns=storage.ORDER_COLUMNS)
 
     return ordersDF
    
@@ -552,24 +784,37 @@ def get_historical_trades_DF(start_date, end_date, token):
 ###########################
 
 def shut_it_down(token, tickers):
-    # TODO: make this run async. This sells using the old/slow methods.     
-    # Get current positions: 
+    # Sells the full quantity of every position in tickers, all at once.
+    # Returns the symbols that failed to sell.
     print('Getting current positions: ')
-    current_positions = get_positions(token=token)
-    print('Number of current positions: ', len(current_positions) )
-    positionsToSell = [s for s in current_positions if s in [p for p in tickers]]
+    snapshot = get_account_snapshot(token=token)
+    print('Number of current positions: ', len(snapshot.positions) )
+    tickerSet = set(tickers)
+    reconciler = reconcile.Reconciler(snapshot)
+    # Open buys would fill after the sells, cancel them first
+    openBuys = reconciler.open_buys(sorted(tickerSet))
+    if len(openBuys) > 0:
+        print('Cancelling open buys: ', len(openBuys))
+        cancel_orders(token, openBuys)
+    # Settled shares net of sells that are already open
+    positionsToSell = reconciler.exit_orders(s for s in snapshot.positions if s in tickerSet)
     print('Number of positions to sell: ', len(positionsToSell) )
-    failedToSell = []
-    if ( len(positionsToSell) >0):
-        for s in positionsToSell: 
-                theOrder = make_sell_order(s, token)
-                if theOrder!=201:
-                    print('Failed to SELL: ', s, ', had code: ', theOrder)
-                    failedToSell.append(s)   
 
+    results = asyncio.run(liquidate_async(positionsToSell, token))
+    failedToSell = [r['symbol'] for r in orders_engine.print_failures(results)]
     return failedToSell
 
 
+async def liquidate_async(positionsToSell, token):
+    # positionsToSell: {symbol: quantity}. Returns one result dict per order.
+    payloads = {(s, 'SELL'): orders_engine.build_order(s, 'SELL', quantity=int(q)) 
+                for s, q in positionsToSell.items()}
+    async with aiohttp.ClientSession(trace_configs=[tracing.aiohttp_trace_config()]) as session:
+        submitter = orders_engine.OrderSubmitter(session, token, orders=payloads)
+        submitter.sell(list(positionsToSell))
+        return await submitter.results()
+
+
     
 ##################################################
             ###### TICKER CHECK ######
@@ -577,30 +822,13 @@ def shut_it_down(token, tickers):
 
 
 def get_sp500_tickers():
-    url = 'https://en.wikipedia.org/wiki/List_of_S%26P_500_companies'
-    page_html = BeautifulSoup(requests.get(url).text, 'lxml')
-    stock_table = page_html.find(id='constituents')
-    nyse_ticker_elements = page_html.find_all("a", href=re.compile("nyse"))
-    nas_ticker_elements = page_html.find_all("a", href=re.compile("nasdaq"))
-    all_tickers = nyse_ticker_elements + nas_ticker_elements
-    tickers = []
-    for t in all_tickers: 
-        tickers.append(t.text)
-    filtered_tickers = [x for x in tickers if '.' not in x]
-    # Now double check to make sure there's a max of 4 letters, remove otherwise
-    final_tickers = [x for x in filtered_tickers if len(x)<=4]
-    return final_tickers
+    # Current index members from the constituents table, see universe.py
+    (html, modified) = universe.fetch_page()
+    return universe.tradable(universe.parse_constituents(html))
 
 #######################
 ## New Refresh Token ##
 #######################
 
 def get_new_refresh_token(token):
-    url = 'https://api.tdameritrade.com/v1/oauth2/token'
-    payload = {'grant_type': config.TD_GRANT_TYPE, 
-              'client_id': config.TD_CLIENT_ID,
-              'refresh_token': config.TD_REFRESH_TOKEN,
-               'access_type': 'offline'
-    }
-    r = requests.post(url, data=payload, timeout=10)
-    return json.loads(r.content)
+    return tokens.request_new_refresh_token()